@@ -0,0 +1,189 @@
+#
+# Benchmark for the native /drive engine. It starts a local stand-in for
+# Google Drive that imitates the large-file flow: uc?export=download answers
+# with the virus-scan warning page, whose download form (confirm token and
+# uuid) leads to the file, served with Content-Disposition, Range support
+# and a per-connection speed cap. It measures resolving, single-connection
+# (how gdown fetches) against multi-connection downloads, and resuming an
+# interrupted download.
+#
+# Usage: python -m benchmarks.bench_drive [size_mib] [per_conn_kib_s]
+#
+
+import os
+import sys
+import time
+import uuid
+import shutil
+import asyncio
+import hashlib
+import tempfile
+import threading
+from urllib.parse import urlparse, parse_qs, quote
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from modules import drive_engine, aio_downloader
+from modules.utils import DownloadCancelled
+from modules.http_downloader import SegmentState
+
+SIZE = int(sys.argv[1]) * 1024 * 1024 if len(sys.argv) > 1 else 64 * 1024 * 1024
+RATE = int(sys.argv[2]) * 1024 if len(sys.argv) > 2 else 4 * 1024 * 1024
+PAYLOAD = os.urandom(1024 * 1024) * (SIZE // (1024 * 1024))
+FILE_ID = "1AbCdEfGhIjKlMnOpQrStUvWxYz012345"
+RESOURCE_KEY = "0-bench"
+FILENAME = "Quarterly report – final.bin"
+
+WARNING_PAGE = """<!DOCTYPE html><html><head><title>Google Drive - Virus scan warning</title></head>
+<body><div class="uc-main"><p class="uc-warning-caption">Google Drive can't scan this file for viruses.</p>
+<form id="download-form" action="{action}" method="get">
+<input type="submit" id="uc-download-link" class="goog-inline-block jfk-button" value="Download anyway"/>
+<input type="hidden" name="id" value="{id}"><input type="hidden" name="export" value="download">
+<input type="hidden" name="confirm" value="t"><input type="hidden" name="uuid" value="{uuid}">
+</form></div></body></html>"""
+
+class FakeDrive(BaseHTTPRequestHandler):
+    """
+    uc?export=download checks the resource key and returns the warning page;
+    /download serves PAYLOAD for confirm tokens the page handed out, at RATE
+    bytes/s per connection.
+    """
+    protocol_version = "HTTP/1.1"
+    tokens = set()
+
+    def log_message(self, *args):
+        pass
+
+    def _html(self, status, body):
+        body = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        if query.get("id") != FILE_ID:
+            return self._html(404, "<title>Not Found</title>")
+        if url.path == "/uc":
+            if (query.get("resourcekey") != RESOURCE_KEY
+                    and self.headers.get("X-Goog-Drive-Resource-Keys") != f"{FILE_ID}/{RESOURCE_KEY}"):
+                return self._html(404, "<title>Not Found</title>")
+            token = uuid.uuid4().hex
+            self.tokens.add(token)
+            action = f"http://{self.headers['Host']}/download"
+            return self._html(200, WARNING_PAGE.format(action=action, id=FILE_ID, uuid=token))
+        if url.path == "/download" and query.get("confirm") == "t" and query.get("uuid") in self.tokens:
+            return self._serve()
+        self._html(403, "<title>Forbidden</title>")
+
+    def _serve(self):
+        header = self.headers.get("Range")
+        if header and header.startswith("bytes="):
+            start, _, end = header[6:].partition("-")
+            start, end = int(start), min(int(end) if end else len(PAYLOAD) - 1, len(PAYLOAD) - 1)
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(PAYLOAD)}")
+        else:
+            start, end = 0, len(PAYLOAD) - 1
+            self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Disposition",
+                         f"attachment; filename=\"report.bin\"; filename*=UTF-8''{quote(FILENAME)}")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+
+        step = 64 * 1024
+        began = time.time()
+        sent = 0
+        try:
+            for pos in range(start, end + 1, step):
+                block = PAYLOAD[pos:min(pos + step, end + 1)]
+                self.wfile.write(block)
+                sent += len(block)
+                ahead = sent / RATE - (time.time() - began)
+                if ahead > 0:
+                    time.sleep(ahead)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+def run(coro_fn):
+    """Runs a coroutine on a fresh loop, closing the shared session after"""
+    async def wrapped():
+        try:
+            return await coro_fn()
+        finally:
+            await aio_downloader.close_session()
+    return asyncio.run(wrapped())
+
+def check(path):
+    assert os.path.basename(path) == drive_engine.sanitize_filename(FILENAME), f"unexpected name {path}"
+    with open(path, "rb") as f:
+        assert hashlib.sha1(f.read()).digest() == hashlib.sha1(PAYLOAD).digest(), "content mismatch"
+
+def timed_download(label, base, workdir, connections):
+    drive_engine.invalidate(FILE_ID, RESOURCE_KEY)
+    start = time.time()
+    path, _ = run(lambda: drive_engine.download(FILE_ID, RESOURCE_KEY, workdir,
+                                                connections=connections, base_url=base))
+    elapsed = time.time() - start
+    check(path)
+    print(f"{label:<28} {elapsed:7.2f}s  {SIZE / elapsed / 1024 / 1024:8.2f} MiB/s")
+    os.remove(path)
+
+def resume(base, workdir, connections):
+    """
+    Interrupts a download halfway, then resumes it with a fresh confirm
+    token; only the ranges missing from the segment state are fetched.
+    """
+    drive_engine.invalidate(FILE_ID, RESOURCE_KEY)
+    seen = [0]
+
+    def progress(done, total):
+        seen[0] = done
+
+    try:
+        run(lambda: drive_engine.download(FILE_ID, RESOURCE_KEY, workdir, connections=connections,
+                                          progress=progress, should_cancel=lambda: seen[0] >= SIZE // 2,
+                                          base_url=base))
+        raise AssertionError("the download was not interrupted")
+    except DownloadCancelled:
+        pass
+
+    drive_engine.invalidate(FILE_ID, RESOURCE_KEY)
+    meta = run(lambda: drive_engine.resolve(FILE_ID, RESOURCE_KEY, base))
+    kept = SegmentState.load(os.path.join(workdir, meta["name"]), meta).completed()
+    start = time.time()
+    path, _ = run(lambda: drive_engine.download(FILE_ID, RESOURCE_KEY, workdir,
+                                                connections=connections, base_url=base))
+    elapsed = time.time() - start
+    check(path)
+    mib = 1024 * 1024
+    print(f"{'resume x' + str(connections):<28} {elapsed:7.2f}s  "
+          f"{kept / mib:.1f} MiB kept from the interrupted run, {(SIZE - kept) / mib:.1f} MiB fetched")
+    os.remove(path)
+
+if __name__ == "__main__":
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeDrive)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_port}"
+    workdir = tempfile.mkdtemp()
+
+    print(f"{SIZE // (1024 * 1024)} MiB payload, {RATE // 1024} KiB/s per connection\n")
+    try:
+        start = time.time()
+        meta = run(lambda: drive_engine.resolve(FILE_ID, RESOURCE_KEY, base))
+        print(f"{'resolve (warning page)':<28} {(time.time() - start) * 1000:7.1f}ms  "
+              f"{meta['name']!r}, {meta['size']} bytes, ranges={meta['ranges']}")
+        start = time.time()
+        run(lambda: drive_engine.resolve(FILE_ID, RESOURCE_KEY, base))
+        print(f"{'resolve (cached)':<28} {(time.time() - start) * 1000:7.1f}ms\n")
+
+        timed_download("single connection (gdown)", base, workdir, 1)
+        for n in (4, 8, 16):
+            timed_download(f"native x{n}", base, workdir, n)
+        resume(base, workdir, 8)
+    finally:
+        server.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
@@ -0,0 +1,121 @@
+#
+# Benchmark for the /leech download engines. It starts a local HTTP server
+# that throttles every connection (like many file hosts do) and compares the
+# old single-stream path with the segmented engine at several segment counts.
+#
+# Usage: python -m benchmarks.bench_leech [size_mib] [per_conn_kib_s]
+#
+
+import os
+import sys
+import asyncio
+import time
+import shutil
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import requests
+
+from modules import http_downloader, aio_downloader
+
+SIZE = int(sys.argv[1]) * 1024 * 1024 if len(sys.argv) > 1 else 64 * 1024 * 1024
+RATE = int(sys.argv[2]) * 1024 if len(sys.argv) > 2 else 4 * 1024 * 1024
+PAYLOAD = os.urandom(1024 * 1024) * (SIZE // (1024 * 1024))
+
+class ThrottledHandler(BaseHTTPRequestHandler):
+    """
+    Serves PAYLOAD with Range support, capped at RATE bytes/s per connection.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _range(self):
+        header = self.headers.get("Range")
+        if not header or not header.startswith("bytes="):
+            return None
+        start, _, end = header[6:].partition("-")
+        start = int(start)
+        end = int(end) if end else len(PAYLOAD) - 1
+        return start, min(end, len(PAYLOAD) - 1)
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(PAYLOAD)))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+
+    def do_GET(self):
+        rng = self._range()
+        if rng:
+            start, end = rng
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(PAYLOAD)}")
+        else:
+            start, end = 0, len(PAYLOAD) - 1
+            self.send_response(200)
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+
+        step = 64 * 1024
+        began = time.time()
+        sent = 0
+        try:
+            for pos in range(start, end + 1, step):
+                block = PAYLOAD[pos:min(pos + step, end + 1)]
+                self.wfile.write(block)
+                sent += len(block)
+                ahead = sent / RATE - (time.time() - began)
+                if ahead > 0:
+                    time.sleep(ahead)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+def old_download(url, filepath):
+    """
+    The previous /leech implementation: one stream, 8 KiB chunks.
+    """
+    with requests.get(url, stream=True) as r:
+        r.raise_for_status()
+        with open(filepath, "wb") as f:
+            for chunk in r.iter_content(chunk_size=8192):
+                f.write(chunk)
+
+def aio_download(url, filepath, segments):
+    """
+    Runs the asyncio engine on a fresh loop, closing the shared session after.
+    """
+    async def run():
+        try:
+            await aio_downloader.download(url, filepath, segments=segments)
+        finally:
+            await aio_downloader.close_session()
+    asyncio.run(run())
+
+def timed(label, fn, filepath):
+    start = time.time()
+    fn()
+    elapsed = time.time() - start
+    assert os.path.getsize(filepath) == SIZE, f"{label}: size mismatch"
+    print(f"{label:<24} {elapsed:7.2f}s  {SIZE / elapsed / 1024 / 1024:8.2f} MiB/s")
+    os.remove(filepath)
+
+if __name__ == "__main__":
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ThrottledHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/payload.bin"
+    workdir = tempfile.mkdtemp()
+    target = os.path.join(workdir, "payload.bin")
+
+    print(f"{SIZE // (1024 * 1024)} MiB payload, {RATE // 1024} KiB/s per connection\n")
+    try:
+        timed("single stream (old)", lambda: old_download(url, target), target)
+        for n in (1, 2, 4, 8, 16):
+            timed(f"segmented x{n}", lambda: http_downloader.download(url, target, segments=n), target)
+        for n in (1, 4, 16):
+            timed(f"aiohttp x{n}", lambda: aio_download(url, target, n), target)
+    finally:
+        server.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
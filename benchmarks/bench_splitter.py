@@ -0,0 +1,101 @@
+#
+# Benchmark for file_splitter: throughput and peak RSS of the old
+# read-whole-part implementation against the streaming one. Each run
+# happens in its own child process so its peak RSS can be measured alone.
+#
+# Usage: python -m benchmarks.bench_splitter [size_mib] [part_mib]
+#
+
+import os
+import sys
+import time
+import shutil
+import resource
+import tempfile
+import subprocess
+
+from modules.file_splitter import split_file, merge_files
+
+def old_split_file(file_path, chunk_size):
+    """
+    The previous split_file: reads each whole part into memory.
+    """
+    base_name, ext = os.path.splitext(file_path)
+    part_num = 1
+    part_paths = []
+    with open(file_path, 'rb') as f:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            part_path = f"{base_name}_part{part_num}{ext}"
+            with open(part_path, 'wb') as out_f:
+                out_f.write(data)
+            part_paths.append(part_path)
+            part_num += 1
+    return part_paths
+
+def old_merge_files(file_parts):
+    """
+    The previous merge_files: reads each whole part into memory.
+    """
+    base_name_part, ext = os.path.splitext(file_parts[0])
+    merged_path = f"{base_name_part.rsplit('_part', 1)[0]}{ext}"
+    with open(merged_path, 'wb') as out_f:
+        for part in file_parts:
+            with open(part, 'rb') as in_f:
+                out_f.write(in_f.read())
+    return merged_path
+
+IMPLEMENTATIONS = {
+    "old": (old_split_file, old_merge_files),
+    "new": (split_file, merge_files),
+}
+
+def child(impl, file_path, chunk_size):
+    """
+    Runs one split + merge round and prints timings and peak RSS.
+    """
+    split, merge = IMPLEMENTATIONS[impl]
+    size = os.path.getsize(file_path)
+
+    start = time.time()
+    parts = split(file_path, chunk_size)
+    split_time = time.time() - start
+
+    os.rename(file_path, file_path + ".orig")
+    start = time.time()
+    merged = merge(parts)
+    merge_time = time.time() - start
+
+    assert os.path.getsize(merged) == size
+    for p in parts:
+        os.remove(p)
+    os.rename(file_path + ".orig", file_path)
+
+    peak_mib = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KiB on Linux
+    mib = size / 1024 / 1024
+    print(f"{impl:<4} split {mib / split_time:8.1f} MiB/s   merge {mib / merge_time:8.1f} MiB/s   peak RSS {peak_mib:8.1f} MiB")
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--child":
+        child(sys.argv[2], sys.argv[3], int(sys.argv[4]))
+        sys.exit(0)
+
+    size_mib = int(sys.argv[1]) if len(sys.argv) > 1 else 3072
+    part_mib = int(sys.argv[2]) if len(sys.argv) > 2 else 1024
+    workdir = tempfile.mkdtemp(dir=os.getcwd())
+    file_path = os.path.join(workdir, "bench.bin")
+
+    print(f"Writing {size_mib} MiB test file, {part_mib} MiB parts...\n")
+    block = os.urandom(1024 * 1024)
+    with open(file_path, "wb") as f:
+        for _ in range(size_mib):
+            f.write(block)
+
+    try:
+        for impl in ("old", "new"):
+            subprocess.run([sys.executable, "-m", "benchmarks.bench_splitter", "--child",
+                            impl, file_path, str(part_mib * 1024 * 1024)], check=True)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
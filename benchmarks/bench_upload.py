@@ -0,0 +1,37 @@
+#
+# Benchmark for the multi-session upload engine. It logs in with the bot's
+# credentials, uploads the same random file with Pyrogram's single-session
+# save_file and then with 1, 2, 4 and 8 pooled sessions, and prints MB/s.
+# Files are only saved to Telegram, never sent to a chat.
+#
+# Usage: python -m benchmarks.bench_upload [size_mib] [session counts...]
+# Needs API_ID, API_HASH and BOT_TOKEN in the environment.
+#
+
+import os
+import sys
+import asyncio
+
+from modules.fast_upload import FastUploadClient, benchmark
+
+SIZE_MB = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+COUNTS = tuple(int(n) for n in sys.argv[2:]) or (1, 2, 4, 8)
+
+async def main():
+    client = FastUploadClient(
+        "bench_upload",
+        api_id=int(os.environ["API_ID"]),
+        api_hash=os.environ["API_HASH"],
+        bot_token=os.environ["BOT_TOKEN"],
+        in_memory=True,
+    )
+    async with client:
+        results = await benchmark(client, SIZE_MB, COUNTS)
+
+    print(f"{SIZE_MB} MiB upload\n")
+    for sessions, speed in results.items():
+        label = "pyrogram save_file (old)" if sessions == 0 else f"{sessions} sessions"
+        print(f"{label:<26} {speed:8.1f} MB/s")
+
+if __name__ == "__main__":
+    asyncio.run(main())
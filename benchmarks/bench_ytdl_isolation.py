@@ -0,0 +1,134 @@
+#
+# Benchmark for yt-dlp job isolation. It serves pages with an embedded video
+# from a local HTTP server and runs N /ytdl-style jobs at once (extraction,
+# download with progress hooks), first in threads of the bot process
+# (YTDL_ISOLATION=thread) and then in worker processes (process). Meanwhile
+# a probe coroutine sleeps 10 ms at a time on the event loop and records how
+# late it wakes up: the lag every other handler and upload callback of the
+# bot would see.
+#
+# Usage: python -m benchmarks.bench_ytdl_isolation [jobs] [size_mib] [per_conn_kib_s]
+#
+
+import os
+import sys
+import time
+import shutil
+import asyncio
+import tempfile
+import statistics
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from modules import ytdl_workers, tasks
+from modules.ytdlp import fetch_media
+
+JOBS = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+SIZE = int(sys.argv[2]) * 1024 * 1024 if len(sys.argv) > 2 else 16 * 1024 * 1024
+RATE = int(sys.argv[3]) * 1024 if len(sys.argv) > 3 else 8 * 1024 * 1024
+PAYLOAD = os.urandom(1024 * 1024) * (SIZE // (1024 * 1024))
+PROBE_INTERVAL = 0.01  # seconds
+
+class SiteHandler(BaseHTTPRequestHandler):
+    """
+    /watch/<n> is a page embedding /clip-<n>.mp4; clips are PAYLOAD,
+    capped at RATE bytes/s per connection.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.startswith("/watch/"):
+            n = self.path.rsplit("/", 1)[1]
+            page = f"<html><head><title>Clip {n}</title></head><body><video src='/clip-{n}.mp4'></video></body></html>".encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html")
+            self.send_header("Content-Length", str(len(page)))
+            self.end_headers()
+            self.wfile.write(page)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "video/mp4")
+        self.send_header("Content-Length", str(len(PAYLOAD)))
+        self.end_headers()
+        step = 64 * 1024
+        began = time.time()
+        try:
+            for pos in range(0, len(PAYLOAD), step):
+                self.wfile.write(PAYLOAD[pos:pos + step])
+                ahead = (pos + step) / RATE - (time.time() - began)
+                if ahead > 0:
+                    time.sleep(ahead)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+async def probe(lags, stop):
+    """Records how late each PROBE_INTERVAL sleep wakes up, in ms"""
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        start = loop.time()
+        await asyncio.sleep(PROBE_INTERVAL)
+        lags.append((loop.time() - start - PROBE_INTERVAL) * 1000)
+
+async def run_jobs(mode, base, workdir):
+    ytdl_workers.ISOLATION = mode
+    ytdl_workers.pool = ytdl_workers.WorkerPool(size=JOBS)
+    # As many threads as jobs, so both modes run all jobs at once
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=JOBS))
+
+    def hook(d):
+        # About what /ytdl's progress hook does per event
+        if d["status"] == "downloading":
+            f"{d.get('_percent_str', '')} {d.get('downloaded_bytes', 0)} {d.get('_speed_str', '')}"
+
+    async def job(n):
+        task = tasks.register("ytdl", 0, 0, f"{base}/watch/{n}")
+        path = os.path.join(workdir, mode, str(n))
+        os.makedirs(path, exist_ok=True)
+        try:
+            full_path, _, _ = await fetch_media(task, task.url, path, None, hook, "best", "native")
+            assert os.path.getsize(full_path) == SIZE, f"job {n}: size mismatch"
+        finally:
+            tasks.remove(task)
+
+    if mode == "process":
+        # Start the workers first: their start-up is paid once per bot run
+        await asyncio.gather(*(job(n) for n in range(JOBS)))
+
+    lags, stop = [], asyncio.Event()
+    prober = asyncio.create_task(probe(lags, stop))
+    start = time.perf_counter()
+    await asyncio.gather(*(job(n) for n in range(JOBS, 2 * JOBS)))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await prober
+    await ytdl_workers.pool.close()
+    return elapsed, lags
+
+def main():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SiteHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_port}"
+    workdir = tempfile.mkdtemp()
+
+    results = {}
+    try:
+        for mode in ("thread", "process"):
+            results[mode] = asyncio.run(run_jobs(mode, base, workdir))
+    finally:
+        server.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    # Printed last, after yt-dlp's own console output
+    print(f"\n\n{JOBS} concurrent jobs, {SIZE // (1024 * 1024)} MiB each, {RATE // 1024} KiB/s per connection\n")
+    print(f"{'mode':<10} {'wall s':>8} {'mean lag ms':>12} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for mode, (elapsed, lags) in results.items():
+        lags.sort()
+        print(f"{mode:<10} {elapsed:8.2f} {statistics.mean(lags):12.2f} "
+              f"{lags[int(len(lags) * 0.95)]:8.2f} {lags[int(len(lags) * 0.99)]:8.2f} {lags[-1]:8.2f}")
+
+if __name__ == "__main__":
+    main()
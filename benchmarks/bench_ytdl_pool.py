@@ -0,0 +1,75 @@
+#
+# Benchmark for the yt-dlp instance pool. It serves a small page with an
+# embedded video from a local HTTP server and extracts it (without
+# downloading) over and over, once with a brand new YoutubeDL per call like
+# /ytdl used to do, and once with instances checked out of the pool.
+# Printed latencies are per call, so they leave out the network entirely.
+#
+# Usage: python -m benchmarks.bench_ytdl_pool [iterations]
+#
+
+import sys
+import time
+import statistics
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import yt_dlp
+
+from modules.ytdl_pool import YtdlPool
+from modules.ytdlp import LIST_OPTS
+
+ITERATIONS = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+PAGE = b"<html><head><title>Bench</title></head><body><video src='/clip.mp4'></video></body></html>"
+
+class PageHandler(BaseHTTPRequestHandler):
+    """
+    Serves PAGE for every path; the video itself is never fetched.
+    """
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(PAGE)))
+        self.end_headers()
+        self.wfile.write(PAGE)
+
+def measure(extract):
+    timings = []
+    for _ in range(ITERATIONS):
+        start = time.perf_counter()
+        extract()
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+def main():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), PageHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/watch"
+    opts = {**LIST_OPTS, "no_warnings": True}
+
+    def cold():
+        with yt_dlp.YoutubeDL(opts) as ydl:
+            ydl.extract_info(url, download=False)
+
+    pool = YtdlPool()
+    def pooled():
+        with pool.checkout("list", opts) as ydl:
+            ydl.extract_info(url, download=False)
+
+    cold()  # import the extractor modules once, outside both measurements
+    results = {"cold YoutubeDL (old)": measure(cold), "pooled YoutubeDL": measure(pooled)}
+    pool.close()
+    server.shutdown()
+
+    print(f"{ITERATIONS} extractions per mode\n")
+    print(f"{'mode':<22} {'median ms':>10} {'p95 ms':>10} {'first ms':>10}")
+    for mode, timings in results.items():
+        p95 = sorted(timings)[int(len(timings) * 0.95) - 1]
+        print(f"{mode:<22} {statistics.median(timings):10.1f} {p95:10.1f} {timings[0]:10.1f}")
+    print(f"\npool: {pool.created} instance(s) built, {pool.reused} reuses")
+
+if __name__ == "__main__":
+    main()
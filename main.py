@@ -2,14 +2,17 @@ import os
 import logging
 import threading
 from flask import Flask , jsonify
-from pyrogram import Client, filters
+from pyrogram import filters, idle
 from pyrogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton
 
 # Importing all necessary modules
-from modules.leech import register_leech_handlers, ACTIVE_TASKS as LEECH_TASKS
-from modules.ytdlp import register_ytdl_handlers, ACTIVE_TASKS as YTDL_TASKS
-from modules.drive import register_drive_handlers, ACTIVE_TASKS as DRIVE_TASKS
-from modules.utils import ensure_dirs, cancel_task
+from modules.leech import register_leech_handlers
+from modules.ytdlp import register_ytdl_handlers, warm_ytdl_pool
+from modules.drive import register_drive_handlers
+from modules.playlist import register_playlist_handlers
+from modules.utils import ensure_dirs
+from modules import tasks, journal, aio_downloader, part_uploader, scheduler, ytdl_workers
+from modules.fast_upload import FastUploadClient
 from modules.cookies import register_cookie_handlers
 
 logging.basicConfig(level=logging.INFO)
@@ -40,15 +43,19 @@ def run_flask():
 # ----------------------------------------------------
 
 
-app = Client(
+# Big uploads are spread over a pool of media sessions (see fast_upload.py)
+app = FastUploadClient(
     "colab_leech_bot",
     api_id=API_ID,
     api_hash=API_HASH,
     bot_token=BOT_TOKEN,
+    # Pyrogram's default of 1 runs every save_file bot-wide one at a time;
+    # each upload slot may have UPLOAD_PARALLEL_PARTS parts going at once
+    max_concurrent_transmissions=part_uploader.PARALLEL_PARTS * scheduler.UPLOAD_SLOTS,
 )
 
-def home_keyboard():
-    tasks_count = len(LEECH_TASKS) + len(YTDL_TASKS) + len(DRIVE_TASKS)
+def home_keyboard(user_id):
+    tasks_count = tasks.count(user_id)
     return InlineKeyboardMarkup([
         [
             InlineKeyboardButton("➕ Add cookies.txt", callback_data="cookies:add"),
@@ -62,7 +69,7 @@ def home_keyboard():
             InlineKeyboardButton("📂 Drive File (send /drive <url>)", callback_data="noop")
         ],
         [
-            InlineKeyboardButton(f"⛔ Cancel all ({tasks_count})", callback_data="cancel_all")
+            InlineKeyboardButton(f"⛔ Cancel my tasks ({tasks_count})", callback_data="cancel_all")
         ]
     ])
 
@@ -74,19 +81,23 @@ async def start_cmd(_, m: Message):
         "✅ Features:\n"
         "  • Direct file download: `/leech <url>`\n"
         "  • Video download: `/ytdl <url>`\n"
-        "  • Drive download: `/drive <url>`\n"
+        "  • Whole playlist or channel: `/ytpl <url> [quality]`\n"
+        "  • Drive download: `/drive <file or folder url>`\n"
+        "  • Repeat links are resent instantly (add `--nocache` to force a fresh download)\n"
         "  • Cookies management\n"
-        "  • Cancel ongoing downloads\n",
-        reply_markup=home_keyboard(),
+        "  • Cancel your ongoing downloads: `/cancel`\n",
+        reply_markup=home_keyboard(m.from_user.id),
         disable_web_page_preview=True
     )
 
 @app.on_message(filters.command("cancel"))
 async def cancel_cmd(_, m: Message):
-    cancel_task(LEECH_TASKS)
-    cancel_task(YTDL_TASKS)
-    cancel_task(DRIVE_TASKS)
-    await m.reply_text("⛔ All ongoing download processes have been cancelled.")
+    # Only the caller's own tasks are cancelled
+    cancelled = tasks.cancel_user(m.from_user.id)
+    if cancelled:
+        await m.reply_text(f"⛔ Cancelled {cancelled} of your ongoing tasks.")
+    else:
+        await m.reply_text("ℹ️ You have no ongoing tasks.")
 
 @app.on_callback_query(filters.regex("^noop$"))
 async def ignore_noop(_, cq):
@@ -94,10 +105,8 @@ async def ignore_noop(_, cq):
 
 @app.on_callback_query(filters.regex("^cancel_all$"))
 async def cancel_all_cb(_, cq):
-    cancel_task(LEECH_TASKS)
-    cancel_task(YTDL_TASKS)
-    cancel_task(DRIVE_TASKS)
-    await cq.answer("⛔ All ongoing download processes cancelled.", show_alert=True)
+    cancelled = tasks.cancel_user(cq.from_user.id)
+    await cq.answer(f"⛔ Cancelled {cancelled} of your ongoing tasks.", show_alert=True)
 
 @app.on_callback_query(filters.regex(r"^cookies:(add|remove)$"))
 async def cookies_cb(_, cq):
@@ -112,11 +121,28 @@ register_cookie_handlers(app)
 register_leech_handlers(app)
 register_ytdl_handlers(app)
 register_drive_handlers(app)
+register_playlist_handlers(app)
+
+async def main():
+    await app.start()
+    # Jobs the previous run left unfinished (e.g. a dyno restart) start again
+    try:
+        await journal.recover(app)
+    except Exception as e:
+        log.error(f"Could not resume journaled jobs: {e}", exc_info=True)
+    await idle()
+    # Jobs still running stay unfinished in the journal, for the next start
+    await journal.shutdown()
+    await aio_downloader.close_session()
+    await ytdl_workers.close()
+    await app.stop()
 
 if __name__ == "__main__":
     ensure_dirs()
     log.info("Starting bot…")
     # Start Flask keepalive in a thread
     threading.Thread(target=run_flask).start()
+    # Prepare yt-dlp instances while the bot connects
+    threading.Thread(target=warm_ytdl_pool, daemon=True).start()
     # Run Pyrogram bot
-    app.run()
+    app.run(main())
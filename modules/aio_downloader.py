@@ -0,0 +1,244 @@
+#
+# This module is the asyncio counterpart of http_downloader. Transfers run
+# on the event loop over one process-wide aiohttp session (keep-alive pool,
+# DNS cache, per-host connection limits) instead of one executor thread
+# per download. Disk writes go through a small shared writer pool, and
+# resume state uses the same sidecar format as the threaded engine.
+#
+
+import os
+import time
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import aiohttp
+
+from .utils import DownloadCancelled
+from .http_downloader import (
+    SEGMENTS, CHUNK_SIZE, RETRIES, ResourceChanged, SegmentState,
+    plan_segments, preallocate, discard, running,
+)
+
+log = logging.getLogger("aio_downloader")
+
+# ---------------- Tunables (overridable from the environment) ----------------
+MAX_CONNECTIONS = int(os.environ.get("HTTP_MAX_CONNECTIONS", "256"))
+MAX_PER_HOST = int(os.environ.get("HTTP_MAX_PER_HOST", "16"))
+DNS_CACHE_TTL = 300  # seconds
+WRITER_THREADS = int(os.environ.get("HTTP_WRITER_THREADS", "4"))
+TIMEOUT = aiohttp.ClientTimeout(total=None, connect=15, sock_read=60)
+
+_session = None
+_writer_pool = ThreadPoolExecutor(max_workers=WRITER_THREADS, thread_name_prefix="writer")
+
+def get_session():
+    """
+    Returns the shared ClientSession, creating it on first use.
+    Must be called from the running event loop.
+    """
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=MAX_CONNECTIONS,
+            limit_per_host=MAX_PER_HOST,
+            ttl_dns_cache=DNS_CACHE_TTL,
+            keepalive_timeout=60,
+        )
+        _session = aiohttp.ClientSession(connector=connector, timeout=TIMEOUT)
+    return _session
+
+async def close_session():
+    """Closes the shared session, e.g. on shutdown"""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+async def probe(url):
+    """
+    Async version of http_downloader.probe: final URL, size, Range support
+    and the ETag/Last-Modified validators.
+    """
+    session = get_session()
+    info = {"url": url, "size": 0, "ranges": False, "etag": None, "last_modified": None}
+
+    try:
+        async with session.head(url, allow_redirects=True) as r:
+            if r.ok:
+                info["url"] = str(r.url)
+                info["size"] = int(r.headers.get("content-length", 0) or 0)
+    except aiohttp.ClientError as e:
+        log.info(f"HEAD failed for {url}: {e}")
+
+    async with session.get(info["url"], headers={"Range": "bytes=0-0"}) as r:
+        r.raise_for_status()
+        info["url"] = str(r.url)
+        info["etag"] = r.headers.get("etag")
+        info["last_modified"] = r.headers.get("last-modified")
+        content_range = r.headers.get("content-range", "")
+        if r.status == 206 and "/" in content_range:
+            total = content_range.rsplit("/", 1)[1]
+            if total.isdigit():
+                info["size"] = int(total)
+                info["ranges"] = True
+
+    return info
+
+async def _blocking(func, *args):
+    """Runs blocking disk I/O on the shared writer pool"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_writer_pool, func, *args)
+
+async def _write(fd, data, offset):
+    """Writes `data` at `offset` on the shared writer pool"""
+    await _blocking(os.pwrite, fd, data, offset)
+
+async def _save(state):
+    """Saves the segment state file on the writer pool"""
+    # Stamped now, so segments don't queue more saves while this one runs
+    state.last_flush = time.time()
+    await _blocking(state.save)
+
+async def _fetch_range(url, fd, start, end, chunk_size, progress, should_cancel, state, base=0):
+    """
+    Downloads bytes [base + start, base + end] of the remote file into
+    offsets [start, end] of the open file `fd`.
+    """
+    headers = {"Range": f"bytes={base + start}-{base + end}"}
+    if state.validator:
+        headers["If-Range"] = state.validator
+    pos = start
+    async with get_session().get(url, headers=headers) as r:
+        r.raise_for_status()
+        if r.status != 206:
+            raise ResourceChanged(f"Server did not return bytes {start}-{end} (HTTP {r.status})")
+        async for chunk in r.content.iter_chunked(chunk_size):
+            if should_cancel and should_cancel():
+                raise DownloadCancelled()
+            chunk = chunk[:end + 1 - pos]
+            await _write(fd, chunk, pos)
+            pos += len(chunk)
+            state.advance(start, pos, save=False)
+            if state.flush_due():
+                await _save(state)
+            progress(len(chunk))
+    if pos <= end:
+        raise Exception(f"Connection closed early at byte {pos} of segment {start}-{end}")
+    state.finish(start, end, save=False)
+    await _save(state)
+
+async def _fetch_stream(url, fd, chunk_size, progress, should_cancel):
+    """
+    Single-connection fallback for servers that don't support ranges.
+    """
+    pos = 0
+    async with get_session().get(url) as r:
+        r.raise_for_status()
+        async for chunk in r.content.iter_chunked(chunk_size):
+            if should_cancel and should_cancel():
+                raise DownloadCancelled()
+            await _write(fd, chunk, pos)
+            pos += len(chunk)
+            progress(len(chunk))
+    return pos
+
+async def _download_once(url, filepath, segments, chunk_size, progress, should_cancel,
+                         window=None, info=None, on_ranges=None):
+    """
+    A single download attempt; see `download`.
+    """
+    info = dict(info) if info else await probe(url)
+    base = 0
+    if window:
+        if not info["ranges"]:
+            raise Exception("Server does not support ranged downloads")
+        base, last = window
+        info["size"] = last - base + 1
+    done = 0
+    state = None
+
+    def advance(n):
+        nonlocal done
+        done += n
+        if progress:
+            progress(done, info["size"])
+        if on_ranges and state is not None:
+            # In the remote file's offsets, also for a window
+            on_ranges([(base + start, base + end) for start, end in state.ranges()])
+
+    if not info["ranges"] or info["size"] <= 0:
+        log.info(f"Single-stream download for {url}")
+        await _blocking(discard, filepath)
+        fd = await _blocking(os.open, filepath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            return await _fetch_stream(info["url"], fd, chunk_size, advance, should_cancel)
+        finally:
+            os.close(fd)
+
+    state = await _blocking(SegmentState.load, filepath, info)
+    if state is None:
+        await _blocking(preallocate, filepath, info["size"])
+        state = SegmentState(filepath, info["url"], info["size"], info["etag"], info["last_modified"])
+        await _save(state)
+    else:
+        log.info(f"Resuming {filepath}: {state.completed()} of {info['size']} bytes already on disk")
+
+    done = state.completed()
+    ranges = plan_segments(info["size"], segments, state.done)
+    log.info(f"Segmented download for {url}: {len(ranges)} ranges, {info['size']} bytes")
+
+    fd = await _blocking(os.open, filepath, os.O_WRONLY)
+    try:
+        tasks = [
+            asyncio.create_task(_fetch_range(info["url"], fd, start, end, chunk_size,
+                                             advance, should_cancel, state, base))
+            for start, end in ranges
+        ]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException as e:
+            # Stop the sibling segments before the file descriptor is closed
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if isinstance(e, ResourceChanged):
+                await _blocking(discard, filepath)
+            else:
+                await _save(state)
+            raise
+    finally:
+        os.close(fd)
+
+    await _blocking(state.remove)
+    return done
+
+async def download(url, filepath, segments=SEGMENTS, chunk_size=CHUNK_SIZE,
+                   progress=None, should_cancel=None, retries=RETRIES, window=None, info=None,
+                   on_ranges=None):
+    """
+    Downloads `url` to `filepath` on the event loop, using `segments`
+    parallel ranged connections from the shared pool when the server allows
+    it. Failed attempts are retried and resume from the saved segment state.
+
+    :param progress: Optional callable(downloaded, total), called on the event loop.
+    :param should_cancel: Optional callable returning True to abort the download.
+    :param window: Optional inclusive (start, end) byte range of the remote
+                   file to fetch into `filepath`, e.g. one upload-sized part.
+    :param info: A result of `probe` to reuse for the first attempt.
+    :param on_ranges: Optional callable(ranges) receiving the merged inclusive
+                      (start, end) byte ranges of the remote file that are
+                      on disk, as they grow (segmented downloads only).
+    :return: The total number of bytes on disk.
+    """
+    with running(filepath):
+        for attempt in range(1, retries + 1):
+            try:
+                return await _download_once(url, filepath, segments, chunk_size, progress,
+                                            should_cancel, window, info if attempt == 1 else None, on_ranges)
+            except DownloadCancelled:
+                raise
+            except Exception as e:
+                if attempt >= retries:
+                    raise
+                log.warning(f"Download attempt {attempt}/{retries} for {url} failed: {e}. Resuming...")
+                await asyncio.sleep(min(2 ** attempt, 30))
@@ -0,0 +1,142 @@
+#
+# This module keeps users' cookies.txt files. They used to be written to
+# data/cookies and copied to MongoDB with blocking pymongo calls on the
+# event loop, and were never read back, so a restart that wiped the disk
+# lost everyone's cookies. Now:
+#
+#   - MongoDB is the durable copy, reached through the asyncio client
+#     (utils.async_db, bounded connection pool),
+#   - the cookies.txt text of the last COOKIE_CACHE_ENTRIES users is kept
+#     in memory (users without cookies too, so they don't cost a query),
+#   - `path_for` recreates the cookies.txt file yt-dlp reads when it is
+#     missing, from memory or MongoDB,
+#   - saving or removing cookies replaces the user's cached entry.
+#
+
+import os
+import glob
+import asyncio
+import logging
+from collections import OrderedDict
+from yt_dlp.cookies import YoutubeDLCookieJar
+
+from .utils import COOKIES_DIR, async_db, data_paths
+
+log = logging.getLogger("cookie_store")
+
+# ---------------- Tunables (overridable from the environment) ----------------
+CACHE_ENTRIES = int(os.environ.get("COOKIE_CACHE_ENTRIES", "256"))
+
+class CookieError(Exception):
+    """The file is not a usable cookies.txt"""
+    pass
+
+class _Entry:
+    """A user's cookies.txt text (None without cookies)"""
+    def __init__(self, text):
+        self.text = text
+
+_cache = OrderedDict()  # user_id -> _Entry, most recently used last
+
+def _remember(user_id, entry):
+    _cache[user_id] = entry
+    _cache.move_to_end(user_id)
+    while len(_cache) > CACHE_ENTRIES:
+        _cache.popitem(last=False)
+
+def _write(path, text):
+    """
+    Parses `text` the way yt-dlp will and writes it to `path` atomically.
+    Blocking; run it in a thread.
+
+    :return: The parsed YoutubeDLCookieJar.
+    :raises CookieError: If yt-dlp can't read it.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(text)
+    jar = YoutubeDLCookieJar(tmp)
+    try:
+        jar.load(ignore_discard=True, ignore_expires=True)
+    except Exception as e:
+        os.remove(tmp)
+        raise CookieError(f"This is not a Netscape-format cookies.txt: {e}")
+    os.replace(tmp, path)
+    return jar
+
+async def _entry(user_id):
+    """The cached entry of `user_id`, loading it from MongoDB on a miss"""
+    entry = _cache.get(user_id)
+    if entry is not None:
+        _cache.move_to_end(user_id)
+        return entry
+    text = None
+    db = async_db()
+    if db is not None:
+        doc = await db.cookies.find_one({"user_id": user_id}, {"cookies": 1})
+        text = doc.get("cookies") if doc else None
+    entry = _Entry(text)
+    _remember(user_id, entry)
+    return entry
+
+async def save(user_id, text):
+    """
+    Stores a user's cookies.txt on disk, in the cache and in MongoDB.
+
+    :return: The number of cookies in it.
+    :raises CookieError: If the file is not a usable cookies.txt.
+    :raises Exception: If MongoDB failed; the local copy is saved anyway.
+    """
+    jar = await asyncio.to_thread(_write, data_paths(user_id)["cookies"], text)
+    _remember(user_id, _Entry(text))
+    db = async_db()
+    if db is not None:
+        await db.cookies.update_one({"user_id": user_id}, {"$set": {"cookies": text}}, upsert=True)
+    return len(jar)
+
+async def remove(user_id):
+    """
+    Deletes a user's cookies everywhere.
+
+    :return: True if there was anything to delete.
+    """
+    _remember(user_id, _Entry(None))
+    removed = False
+    for path in glob.glob(os.path.join(glob.escape(COOKIES_DIR), f"{user_id}_*.txt")):
+        try:
+            os.remove(path)
+            removed = True
+        except OSError as e:
+            log.warning(f"Could not remove {path}: {e}")
+    db = async_db()
+    if db is not None:
+        try:
+            result = await db.cookies.delete_one({"user_id": user_id})
+            removed = removed or result.deleted_count > 0
+        except Exception as e:
+            log.error(f"Could not remove the cookies of user {user_id} from MongoDB: {e}")
+    return removed
+
+async def path_for(user_id):
+    """
+    The path of the user's cookies.txt, recreated from the cache or MongoDB
+    if it isn't on disk (e.g. after a restart), or None without cookies.
+    """
+    path = data_paths(user_id)["cookies"]
+    if os.path.exists(path):
+        return path
+    try:
+        entry = await _entry(user_id)
+    except Exception as e:
+        log.error(f"Could not load the cookies of user {user_id} from MongoDB: {e}")
+        return None
+    if entry.text is None:
+        return None
+    try:
+        await asyncio.to_thread(_write, path, entry.text)
+    except CookieError as e:
+        log.error(f"Stored cookies of user {user_id} are unusable: {e}")
+        return None
+    log.info(f"Restored cookies.txt of user {user_id}")
+    return path
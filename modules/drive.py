@@ -1,14 +1,18 @@
 #
-# This module handles the /drive command for downloading direct file
-# links from services like Google Drive using the gdown library.
+# This module handles the /drive command for downloading Google Drive
+# files. Links are resolved and fetched by the native drive_engine
+# (ranged, multi-connection, resumable, with byte progress); gdown is the
+# fallback when that fails to resolve a link or DRIVE_ENGINE=gdown.
+# Folder links are handed to drive_folder.
 #
 
 import os
-import uuid
+import sys
+import glob
 import logging
 import asyncio
-import re
 import time
+import shutil
 from pyrogram import Client, filters
 from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton, Message
 
@@ -17,13 +21,19 @@ import gdown.exceptions
 import gdown
 
 from .utils import data_paths, ensure_dirs, humanbytes, DownloadCancelled, safe_edit_text
-from .file_splitter import split_file
+from .file_splitter import FileRange, file_ranges
+from .part_uploader import upload_parts, progress_text
+from . import file_cache, singleflight
+from .scheduler import scheduler, queue_text, priority_for
+from . import staging, tasks, drive_engine, journal
+from .drive_folder import download_folder
+from .edits import dispatcher as edit_dispatcher
 
 log = logging.getLogger("drive")
-ACTIVE_TASKS = {} # This is for drive tasks
 
 # ---------------- Telegram-safe split size ----------------
 MAX_SIZE = 1900 * 1024 * 1024 # 1900 MiB ≈ 1.86 GiB
+PROGRESS_INTERVAL = 1  # seconds between download progress edits
 
 def cancel_btn(tid):
     """
@@ -45,212 +55,334 @@ def register_drive_handlers(app: Client):
     async def cmd_drive(_, m: Message):
         args = m.text.split(maxsplit=1)
         if len(args) < 2:
-            return await m.reply("Usage: `/drive <file URL>`")
+            return await m.reply("Usage: `/drive <file or folder URL>`")
         
-        url = args[1].strip()
+        url, no_cache = file_cache.split_bypass_flag(args[1])
+        if not url:
+            return await m.reply("Usage: `/drive <file or folder URL>`")
         user_id = m.from_user.id
-        paths = data_paths(user_id)
         ensure_dirs()
         
-        tid = str(uuid.uuid4())[:8]
-        ACTIVE_TASKS[tid] = {"user_id": user_id, "url": url, "msg_id": None, "cancel": False}
+        task = tasks.register("drive", user_id, m.chat.id, url, no_cache=no_cache)
         
         # The initial message explains the download/upload process
-        msg = await m.reply("⏳ Starting download...", reply_markup=cancel_btn(tid))
-        ACTIVE_TASKS[tid]["msg_id"] = msg.id
-        
-        asyncio.create_task(download_file(app, url, msg, paths, tid))
+        msg = await m.reply("⏳ Starting download...", reply_markup=cancel_btn(task.tid))
+        task.msg_id = msg.id
+        await start_drive(app, task, msg)
         
     @app.on_callback_query(filters.regex(r"^cancel_drive:(.+)$"))
     async def cancel_drive_cb(_, q):
         tid = q.data.split(":")[1]
-        if tid in ACTIVE_TASKS:
-            # We set the flag to True and also edit the message to provide immediate feedback
-            ACTIVE_TASKS[tid]["cancel"] = True
+        task = tasks.get(tid, "drive")
+        if task and task.user_id == q.from_user.id:
+            # Cancelling stops the download (or kills gdown), so the runner reports back right away
+            task.cancel()
             await q.answer("⛔ Task cancelled.", show_alert=True)
-            # The message is updated to show cancellation is in progress.
-            # This is important because the download might still be blocking.
-            msg_id = ACTIVE_TASKS[tid]["msg_id"]
-            if msg_id:
-                msg = q.message.reply_to_message or q.message
-                await safe_edit_text(msg, "⛔ **Cancellation requested.**\n_The download may still be in progress, but the file will not be uploaded._", reply_markup=None)
+        elif task:
+            await q.answer("❌ Only the user who started this task can cancel it.", show_alert=True)
         else:
             await q.answer("❌ Task not found.")
 
-async def download_progress_updater(msg, start_time, tid):
+@journal.resumer("drive")
+async def start_drive(app, task, msg):
+    """
+    Starts a /drive task, a file or a shared folder, reporting into `msg`.
+    Also resumes drive jobs left unfinished by a restart.
+    """
+    paths = data_paths(task.user_id)
+    no_cache = task.data.get("no_cache", False)
+    journal.track(task)
+    if drive_engine.parse_folder_url(task.url)[0]:
+        # A shared folder: every file in it, with one status message
+        task.bind(asyncio.create_task(download_folder(app, task.url, msg, paths, task, no_cache)))
+    else:
+        task.bind(asyncio.create_task(download_file(app, task.url, msg, paths, task, no_cache)))
+
+async def download_progress_updater(msg, start_time, task):
     """
     Updates the message with the download status every few seconds.
-    This runs concurrently with the actual download.
+    This runs concurrently with a gdown download, which reports no bytes.
     """
     try:
         while True:
             # Check for cancellation
-            if ACTIVE_TASKS.get(tid, {}).get("cancel"):
+            if task.is_cancelled():
                 break
             
             elapsed_time = time.time() - start_time
-            await safe_edit_text(msg, f"⏳ **Downloading...**\n`[{int(elapsed_time)}s elapsed]`", reply_markup=cancel_btn(tid))
+            await safe_edit_text(msg, f"⏳ **Downloading with gdown...**\n`[{int(elapsed_time)}s elapsed]`", reply_markup=cancel_btn(task.tid))
             await asyncio.sleep(5) # Wait 5 seconds before updating status again
     except asyncio.CancelledError:
-        log.info(f"Progress updater for task {tid} was cancelled.")
+        log.info(f"Progress updater for task {task.tid} was cancelled.")
     except Exception as e:
         log.error(f"Error in progress updater: {e}")
 
-async def download_file(app, url, msg, paths, tid):
+class DriveProgress:
+    """
+    Progress callback for native Drive downloads: percentage, speed and ETA,
+    edited into the status message at most once per PROGRESS_INTERVAL.
+    Speed only counts bytes fetched by this run, not resumed ones.
+    """
+    def __init__(self, msg, name, tid):
+        self.msg = msg
+        self.name = name
+        self.tid = tid
+        self.start = time.time()
+        self.resumed = None
+        self.last = 0
+
+    def __call__(self, done, total):
+        now = time.time()
+        if self.resumed is None:
+            self.resumed = done
+        if now - self.last < PROGRESS_INTERVAL:
+            return
+        self.last = now
+        elapsed = now - self.start
+        speed = (done - self.resumed) / elapsed if elapsed > 0 else 0
+        if total:
+            pct = min(done / total * 100, 100)
+            eta = f"{int((total - done) / speed)}s" if speed > 0 else "N/A"
+            text = (
+                f"⏳ **Downloading** `{self.name}`\n"
+                f"{get_progress_bar(pct)} **{pct:.1f}%**\n"
+                f"**Size:** {humanbytes(done)} / {humanbytes(total)}\n"
+                f"**Speed:** {humanbytes(speed)}/s • **ETA:** {eta}"
+            )
+        else:
+            text = f"⏳ **Downloading** `{self.name}`\n**Size:** {humanbytes(done)} • **Speed:** {humanbytes(speed)}/s"
+        edit_dispatcher.submit(self.msg, text, reply_markup=cancel_btn(self.tid))
+
+async def run_gdown(file_id, output):
+    """
+    Runs gdown as a child process, so a cancelled download can be killed
+    mid-transfer instead of running on in a thread until it finishes.
+    Partial files are removed if the download doesn't complete.
+
+    :param output: A file path, or a directory path ending in a separator
+                   for gdown to save the file there under its Drive name.
+    :return: The path of the downloaded file.
+    """
+    proc = await asyncio.create_subprocess_exec(
+        sys.executable, "-m", "gdown", file_id, "-O", output, "--quiet",
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE,
+    )
+    try:
+        _, stderr = await proc.communicate()
+    except asyncio.CancelledError:
+        proc.kill()
+        await proc.wait()
+        for leftover in glob.glob(glob.escape(output) + "*"):
+            os.remove(leftover)
+        raise
+    if proc.returncode != 0:
+        # gdown prints "Error:", the wrapped message and a footer about reporting issues
+        lines = [l.strip() for l in stderr.decode(errors="replace").splitlines()]
+        message = " ".join(l for l in lines if l and l != "Error:" and not l.startswith("To report issues"))
+        raise Exception(message or f"gdown exited with code {proc.returncode}")
+    if output.endswith(os.sep):
+        files = [f for f in glob.glob(glob.escape(output) + "*") if os.path.isfile(f)]
+        if not files:
+            raise Exception("Gdown did not save a file.")
+        return max(files, key=os.path.getmtime)
+    return output
+
+async def gdown_download(file_id, work_dir, msg, task):
     """
-    Downloads a file from a URL using gdown and then uploads it to Telegram.
-    This version includes robust retries for the upload phase and better
-    error handling to prevent silent failures.
+    Downloads a file with gdown into `work_dir`, showing elapsed time.
+    Used when the native engine can't resolve the link or DRIVE_ENGINE=gdown.
+
+    :return: The path of the downloaded file.
     """
+    # gdown runs as a child process once one of the global download
+    # slots is free; cancelling the task kills it.
+    async def download_coro():
+        async with scheduler.download_slot():
+            return await run_gdown(file_id, work_dir + os.sep)
+
+    download_task = asyncio.create_task(download_coro())
+    progress_task = asyncio.create_task(download_progress_updater(msg, time.time(), task))
+    try:
+        return await download_task
+    except asyncio.CancelledError:
+        # Let the gdown process be killed and its partial file removed
+        download_task.cancel()
+        try:
+            await download_task
+        except (asyncio.CancelledError, Exception):
+            pass
+        raise DownloadCancelled()
+    finally:
+        if not progress_task.done():
+            progress_task.cancel()
+            try:
+                await progress_task # Await cancellation
+            except asyncio.CancelledError:
+                pass
+
+async def download_file(app, url, msg, paths, task, no_cache=False):
+    """
+    Downloads a Google Drive file and then uploads it to Telegram.
+    The native engine resolves the link first and fetches the file over
+    several ranged connections with byte progress; gdown is the fallback.
+    Files delivered before are resent from the file_id cache unless
+    `no_cache` is set.
+    """
+    tid = task.tid
     file_path = ""
-    fpaths = []
-    download_dir = paths["downloads"]
+    work_dir = ""
+    keep_partial = False
+    flight = None
+    failure = None
+    reservation = None
     
     try:
-        # Check for gdown installation
-        try:
-            import gdown
-        except ImportError:
-            await safe_edit_text(msg, "❌ The `gdown` library is not installed. Please install it with `pip install gdown`.")
+        file_id, resource_key = drive_engine.parse_drive_url(url)
+        if not file_id:
+            raise ValueError("Invalid Google Drive URL. Could not find a file ID.")
+
+        key = file_cache.cache_key("drive", file_id)
+        if not no_cache and await file_cache.send_cached(app, msg.chat.id, key):
+            await safe_edit_text(msg, "✅ Sent from cache.", reply_markup=None)
+            journal.state(task, "done")
             return
 
-        # --- CRITICAL FIX: Use a more robust regex to find the file ID ---
-        # It now looks for both ?id= and /d/.../view formats.
-        match = re.search(r'(?:id=|/d/)([a-zA-Z0-9_-]+)', url)
-        if not match:
-            raise ValueError("Invalid Google Drive URL. Could not find a file ID.")
-        
-        file_id = match.group(1)
-        
-        # We need a filename to pass to gdown.download
-        temp_filename = f"{tid}_{file_id}"
-        temp_filepath = os.path.join(download_dir, temp_filename)
+        # Someone else is already downloading this file: share their transfer
+        running = singleflight.find(key)
+        if running:
+            if await singleflight.follow(app, running, msg.chat.id, msg):
+                journal.state(task, "done")
+            return
+        flight = singleflight.lead(key, msg)
 
-        # --- Download Logic with concurrent status updates ---
-        start_time = time.time()
-        
-        # The gdown.download function is synchronous, so we run it in a separate thread.
-        download_coro = asyncio.to_thread(gdown.download, id=file_id, output=temp_filepath, quiet=True, fuzzy=True)
+        # Resolve the link up front, so the scheduler and the staging
+        # reservation know the real size before any byte is fetched
+        meta = None
+        if drive_engine.ENGINE != "gdown":
+            await safe_edit_text(msg, "🔎 Resolving the Drive link...", reply_markup=cancel_btn(tid))
+            try:
+                meta = await drive_engine.resolve(file_id, resource_key)
+            except drive_engine.DriveError:
+                raise
+            except Exception as e:
+                log.warning(f"Could not resolve Drive file {file_id} ({e}); falling back to gdown")
+        size = meta["size"] if meta else 0
         
-        # Create tasks for both the download and the progress updater
-        download_task = asyncio.create_task(download_coro)
-        progress_task = asyncio.create_task(download_progress_updater(msg, start_time, tid))
-        
-        try:
-            # Wait for the download task to complete
-            downloaded_path = await download_task
-            # gdown.download returns the downloaded file path
-            if isinstance(downloaded_path, str) and os.path.exists(downloaded_path):
-                file_path = downloaded_path
-            else:
-                raise Exception("Gdown did not return a valid file path.")
+        async def show_position(position):
+            await safe_edit_text(msg, queue_text(position), reply_markup=cancel_btn(tid))
 
-        except asyncio.CancelledError:
-            # If the download task is cancelled, cancel the progress task as well
-            progress_task.cancel()
-            raise DownloadCancelled()
-        # This new specific block catches gdown download errors in a general way
-        except Exception as gdown_e:
-            log.error(f"Gdown download error: {gdown_e}")
-            await safe_edit_text(msg, f"❌ **Google Drive Download Failed**\n\nAn error occurred during the download: `{gdown_e}`. Please check the URL and try again later.", reply_markup=None)
-            return # Exit the function on this specific, unrecoverable error
-        finally:
-            # Ensure the progress task is cancelled when the download task finishes
-            if not progress_task.done():
-                progress_task.cancel()
+        # Wait for a worker slot; without a size (gdown) the job queues
+        # after this user's jobs of known size.
+        async with scheduler.job(task.user_id, size=size, priority=priority_for(size), on_position=show_position,
+                                 should_cancel=task.is_cancelled):
+            reservation = await staging.reserve(
+                task.user_id, size,
+                on_wait=lambda reason: safe_edit_text(msg, staging.wait_text(reason), reply_markup=cancel_btn(tid)),
+                should_cancel=task.is_cancelled,
+            )
+            journal.state(task, "downloading")
+
+            # One directory per Drive file: the file keeps its own name, and a
+            # failed native download resumes from its segment state next time
+            work_dir = os.path.join(paths["downloads"], f"drive-{file_id}")
+            os.makedirs(work_dir, exist_ok=True)
+
+            if meta:
                 try:
-                    await progress_task # Await cancellation
-                except asyncio.CancelledError:
-                    pass
+                    async with scheduler.download_slot():
+                        file_path, meta = await drive_engine.download(
+                            file_id, resource_key, work_dir, meta=meta,
+                            progress=DriveProgress(msg, meta["name"], tid),
+                            should_cancel=task.is_cancelled,
+                            on_ranges=lambda done: journal.ranges(task, done),
+                        )
+                except (DownloadCancelled, asyncio.CancelledError):
+                    raise
+                except Exception as e:
+                    keep_partial = True
+                    failure = e
+                    log.error(f"Drive download error: {e}")
+                    await safe_edit_text(msg, f"❌ **Google Drive Download Failed**\n\nAn error occurred during the download: `{e}`. Send the link again to resume.", reply_markup=None)
+                    return
+            else:
+                try:
+                    file_path = await gdown_download(file_id, work_dir, msg, task)
+                except DownloadCancelled:
+                    raise
+                except Exception as gdown_e:
+                    failure = gdown_e
+                    log.error(f"Gdown download error: {gdown_e}")
+                    await safe_edit_text(msg, f"❌ **Google Drive Download Failed**\n\nAn error occurred during the download: `{gdown_e}`. Please check the URL and try again later.", reply_markup=None)
+                    return # Exit the function on this specific, unrecoverable error
 
-        # --- NEW: Check for cancellation *after* the download finishes but *before* upload starts ---
-        if ACTIVE_TASKS.get(tid, {}).get("cancel"):
-            raise DownloadCancelled()
+            # --- NEW: Check for cancellation *after* the download finishes but *before* upload starts ---
+            if task.is_cancelled():
+                raise DownloadCancelled()
             
-        # Check if the file is empty.
-        if not os.path.exists(file_path) or os.path.getsize(file_path) == 0:
-            raise Exception("Downloaded file is empty or does not exist.")
+            # Check if the file is empty.
+            if not os.path.exists(file_path) or os.path.getsize(file_path) == 0:
+                raise Exception("Downloaded file is empty or does not exist.")
 
-        # --- Upload Logic ---
-        original_filename = os.path.basename(file_path)
+            # --- Upload Logic ---
+            original_filename = os.path.basename(file_path)
         
-        await safe_edit_text(msg, f"✅ Download complete. Preparing for upload: `{original_filename}`", reply_markup=cancel_btn(tid))
+            await safe_edit_text(msg, f"✅ Download complete. Preparing for upload: `{original_filename}`", reply_markup=cancel_btn(tid))
+            journal.state(task, "uploading")
         
-        filesize = os.path.getsize(file_path)
-        if filesize > MAX_SIZE:
-            await safe_edit_text(msg, f"✅ Download complete. Splitting file into parts…", reply_markup=cancel_btn(tid))
-            fpaths = await asyncio.to_thread(split_file, file_path, MAX_SIZE)
-            os.remove(file_path)
-        else:
-            fpaths = [file_path]
-            
-        total_parts = len(fpaths)
-        
-        for idx, fpath in enumerate(fpaths, 1):
-            if ACTIVE_TASKS.get(tid, {}).get("cancel"):
-                raise DownloadCancelled()
-                
-            last_upload_update = 0
-            async def upload_progress(current, total):
-                nonlocal last_upload_update
-                now = time.time()
-                
-                if ACTIVE_TASKS.get(tid, {}).get("cancel"):
-                    log.info(f"Cancellation requested for task {tid}. Cancelling upload.")
-                    raise asyncio.CancelledError
+            # Files above MAX_SIZE are uploaded as byte-range views of the
+            # original, so no part files are ever written to disk.
+            filesize = os.path.getsize(file_path)
+            if filesize > MAX_SIZE:
+                parts = file_ranges(file_path, MAX_SIZE)
+            else:
+                parts = [(0, filesize, original_filename)]
+            total_parts = len(parts)
 
-                if now - last_upload_update < 2:
-                    return
-                last_upload_update = now
-                
-                percentage = (current / total) * 100 if total else 0
-                part_name = os.path.basename(fpath)
-                
-                progress_text = f"**Uploading part {idx}/{total_parts}**:\n"
-                progress_text += f"`{part_name}`\n"
-                progress_text += f"{get_progress_bar(percentage)} **{percentage:.1f}%**\n"
-                progress_text += f"**Size:** {humanbytes(current)} / {humanbytes(total)}"
-                
-                await safe_edit_text(msg, progress_text, reply_markup=cancel_btn(tid))
-            
-            retries = 3
-            for attempt in range(retries):
-                try:
-                    await safe_edit_text(msg, f"**Attempt {attempt + 1}/{retries}:** Uploading part {idx}/{total_parts}...", reply_markup=cancel_btn(tid))
-                    
-                    if not os.path.exists(fpath):
-                        raise FileNotFoundError(f"File to upload not found: {fpath}")
-                    
-                    await app.send_document(
-                        msg.chat.id,
-                        fpath,
-                        caption=f"✅ Uploaded part {idx}/{total_parts}: `{os.path.basename(fpath)}`",
-                        progress=upload_progress
-                    )
-                    log.info(f"Successfully uploaded part {idx}.")
-                    break
-                except asyncio.CancelledError:
-                    raise
-                except Exception as upload_e:
-                    log.error(f"Error during file upload on attempt {attempt + 1}: {upload_e}")
-                    if attempt < retries - 1:
-                        await asyncio.sleep(5)
-                    else:
-                        raise
+            async def upload_progress(done, total, speed, eta, in_flight):
+                await safe_edit_text(msg, progress_text(done, total, speed, eta, in_flight, total_parts), reply_markup=cancel_btn(tid))
 
-        await safe_edit_text(msg, "✅ All parts uploaded successfully!")
+            # Parts upload side by side and are posted to the chat in order;
+            # parts delivered before a restart are not sent again
+            delivered = journal.parts(task, filesize)
+            async with scheduler.upload_slot():
+                await upload_parts(
+                    app, msg.chat.id,
+                    names=[name for _, _, name in parts],
+                    sizes=[length for _, length, _ in parts],
+                    open_part=lambda idx: FileRange(file_path, *parts[idx - 1]),
+                    caption=lambda idx, name: f"✅ Uploaded part {idx}/{total_parts}: `{name}`",
+                    progress=upload_progress,
+                    should_cancel=task.is_cancelled,
+                    skip={int(idx) for idx in delivered},
+                    on_sent=lambda idx, message: journal.delivered(task, idx, [file_cache.file_entry(message)]),
+                )
+            sent = journal.entries(task, total_parts)
 
-    except DownloadCancelled:
+            # The original is only needed until the last range is delivered
+            os.remove(file_path)
+            await file_cache.put(key, sent, filesize)
+            flight.resolve(sent)
+            journal.state(task, "done")
+            await safe_edit_text(msg, "✅ All parts uploaded successfully!")
+
+    except (DownloadCancelled, asyncio.CancelledError):
+        failure = Exception("The download was cancelled.")
         await safe_edit_text(msg, "❌ Download/Upload cancelled.")
+    except staging.StagingFull as e:
+        failure = e
+        await safe_edit_text(msg, f"❌ Not enough disk space: {e}", reply_markup=None)
+    except drive_engine.DriveError as e:
+        failure = e
+        await safe_edit_text(msg, f"❌ **Google Drive Download Failed**\n\n{e}", reply_markup=None)
     except Exception as e:
+        failure = e
         log.error(f"Error in drive command: {e}")
         await safe_edit_text(msg, f"❌ An unexpected error occurred: {e}")
     finally:
-        ACTIVE_TASKS.pop(tid, None)
+        if flight:
+            singleflight.release(flight, failure)
+        tasks.remove(task)
+        staging.release(reservation)
         # Clean up any remaining files from the download process
-        if file_path and os.path.exists(file_path):
-            os.remove(file_path)
-        # Clean up any split parts from the list of file paths
-        for part_file in fpaths:
-            if os.path.exists(part_file):
-                os.remove(part_file)
+        if work_dir and not keep_partial:
+            shutil.rmtree(work_dir, ignore_errors=True)
@@ -0,0 +1,321 @@
+#
+# This module is a native Google Drive downloader. gdown fetched files as a
+# single stream with no byte progress; here a Drive link is resolved to its
+# direct download URL and then fetched with aio_downloader, i.e. ranged,
+# multi-connection and resumable from the on-disk segment state.
+#
+# Resolving follows what a browser does:
+#
+#   - uc?export=download&id=... either is the file, or (for files too big
+#     to virus-scan) an HTML page whose download form, confirm link or
+#     download_warning cookie leads to the file,
+#   - links with a resourcekey send it as a query parameter and in the
+#     X-Goog-Drive-Resource-Keys header,
+#   - quota, sign-in and not-found pages become a DriveError.
+#
+# Resolved URLs and metadata (name, size, validators) are cached for
+# DRIVE_META_TTL seconds. DRIVE_ENGINE=gdown switches /drive back to gdown.
+#
+# Shared folders are listed from their embeddedfolderview page, recursing
+# into subfolders; listings are cached like file metadata.
+#
+
+import os
+import re
+import html
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from urllib.parse import urlencode, urljoin, urlparse, parse_qs, unquote
+from bs4 import BeautifulSoup
+
+from . import aio_downloader
+from .utils import DownloadCancelled
+
+log = logging.getLogger("drive_engine")
+
+# ---------------- Tunables (overridable from the environment) ----------------
+ENGINE = os.environ.get("DRIVE_ENGINE", "native")  # native, or gdown to always use gdown
+CONNECTIONS = int(os.environ.get("DRIVE_CONNECTIONS", "8"))
+META_TTL = int(os.environ.get("DRIVE_META_TTL", "900"))  # seconds
+FOLDER_MAX_FILES = int(os.environ.get("DRIVE_FOLDER_MAX", "500"))
+META_ENTRIES = 256
+LIST_CONCURRENCY = 4  # folder pages fetched at once while listing a tree
+BASE_URL = "https://drive.google.com"
+
+_ID_PATTERNS = (
+    re.compile(r"/(?:file/)?d/([a-zA-Z0-9_-]{10,})"),
+    re.compile(r"[?&]id=([a-zA-Z0-9_-]{10,})"),
+)
+
+_FOLDER_PATTERNS = (
+    re.compile(r"/folders/([a-zA-Z0-9_-]{10,})"),
+    re.compile(r"folderview\?(?:[^#]*&)?id=([a-zA-Z0-9_-]{10,})"),
+)
+
+_meta = OrderedDict()  # (file_id, resource_key) -> (expires_at, meta)
+_listings = OrderedDict()  # (folder_id, resource_key) -> (expires_at, listing)
+
+class DriveError(Exception):
+    """Drive refused the download (quota, permissions, missing file)"""
+    pass
+
+def parse_drive_url(url):
+    """
+    Finds the file id and resource key in a Drive link (…/file/d/ID/view,
+    open?id=ID, uc?id=ID, …) or a bare id.
+
+    :return: (file_id or None, resource_key or None)
+    """
+    resource_key = parse_qs(urlparse(url).query).get("resourcekey", [None])[0]
+    for pattern in _ID_PATTERNS:
+        match = pattern.search(url)
+        if match:
+            return match.group(1), resource_key
+    if re.fullmatch(r"[a-zA-Z0-9_-]{10,}", url.strip()):
+        return url.strip(), None
+    return None, None
+
+def parse_folder_url(url):
+    """
+    Finds the folder id and resource key in a Drive folder link
+    (…/drive/folders/ID, …/folderview?id=ID).
+
+    :return: (folder_id or None, resource_key or None)
+    """
+    resource_key = parse_qs(urlparse(url).query).get("resourcekey", [None])[0]
+    for pattern in _FOLDER_PATTERNS:
+        match = pattern.search(url)
+        if match:
+            return match.group(1), resource_key
+    return None, None
+
+def sanitize_filename(name):
+    """Removes characters Telegram cannot handle from a filename"""
+    name = re.sub(r'[\\/*?:"<>|]', "", name)
+    return name.strip() or "file"
+
+def _filename(content_disposition):
+    if not content_disposition:
+        return None
+    match = re.search(r"filename\*=(?:UTF-8|utf-8)''([^;]+)", content_disposition)
+    if match:
+        return unquote(match.group(1).strip().strip('"'))
+    match = re.search(r'filename="?([^";]+)"?', content_disposition)
+    return match.group(1) if match else None
+
+def _confirm_url(page, page_url, cookies):
+    """The URL behind a virus-scan warning page, or None"""
+    form = re.search(r'<form[^>]*id="download-form"[^>]*>', page)
+    if form:
+        action = re.search(r'action="([^"]+)"', form.group(0))
+        params = {}
+        for tag in re.findall(r"<input\b[^>]*>", page):
+            attrs = dict(re.findall(r'(\w+)="([^"]*)"', tag))
+            if attrs.get("type") == "hidden" and attrs.get("name"):
+                params[attrs["name"]] = html.unescape(attrs.get("value", ""))
+        if action:
+            return f"{urljoin(page_url, html.unescape(action.group(1)))}?{urlencode(params)}"
+    link = re.search(r'href="(/uc\?export=download[^"]*confirm=[^"]+)"', page)
+    if link:
+        return urljoin(page_url, html.unescape(link.group(1)))
+    for name, morsel in cookies.items():
+        if name.startswith("download_warning"):
+            sep = "&" if "?" in page_url else "?"
+            return f"{page_url}{sep}confirm={morsel.value}"
+    return None
+
+def _page_error(page, final_url):
+    if urlparse(final_url).hostname == "accounts.google.com" or "ServiceLogin" in page:
+        return DriveError("The file is private or needs a signed-in account.")
+    if "Quota exceeded" in page or "Too many users have viewed or downloaded" in page:
+        return DriveError("Drive's download quota for this file is exceeded; try again later.")
+    return DriveError("Drive returned a page instead of the file.")
+
+def _cache_put(cache, key, value):
+    cache[key] = (time.monotonic() + META_TTL, value)
+    cache.move_to_end(key)
+    while len(cache) > META_ENTRIES:
+        cache.popitem(last=False)
+
+async def _open(session, url, headers):
+    """
+    GETs the first byte of `url`. Returns ("file", meta) for file content,
+    or ("page", (html, final url, cookies)) for an HTML page.
+    """
+    async with session.get(url, headers={**headers, "Range": "bytes=0-0"}, allow_redirects=True) as r:
+        final_url = str(r.url)
+        if r.status == 404:
+            raise DriveError("File not found. Check the link and its sharing settings.")
+        if r.content_type == "text/html" and "content-disposition" not in r.headers:
+            return "page", (await r.text(errors="replace"), final_url, session.cookie_jar.filter_cookies(final_url))
+        r.raise_for_status()
+        size = int(r.headers.get("content-length", 0) or 0)
+        content_range = r.headers.get("content-range", "")
+        ranges = r.status == 206 and content_range.rsplit("/", 1)[-1].isdigit()
+        if ranges:
+            size = int(content_range.rsplit("/", 1)[1])
+        return "file", {
+            "url": final_url,
+            "size": size,
+            "ranges": ranges,
+            "etag": r.headers.get("etag"),
+            "last_modified": r.headers.get("last-modified"),
+            "name": _filename(r.headers.get("content-disposition")),
+        }
+
+async def resolve(file_id, resource_key=None, base_url=BASE_URL):
+    """
+    Resolves a Drive file to its direct download URL, through the cache.
+
+    :return: A dict with "url", "name", "size", "ranges", "etag" and
+             "last_modified" (the `info` format of aio_downloader).
+    :raises DriveError: If Drive refuses the download.
+    """
+    key = (file_id, resource_key)
+    entry = _meta.get(key)
+    if entry and entry[0] > time.monotonic():
+        _meta.move_to_end(key)
+        return dict(entry[1])
+
+    session = aio_downloader.get_session()
+    params = {"export": "download", "id": file_id}
+    headers = {}
+    if resource_key:
+        params["resourcekey"] = resource_key
+        headers["X-Goog-Drive-Resource-Keys"] = f"{file_id}/{resource_key}"
+    url = f"{base_url}/uc?{urlencode(params)}"
+
+    kind, result = await _open(session, url, headers)
+    if kind == "page":
+        page, page_url, cookies = result
+        confirm = _confirm_url(page, page_url, cookies)
+        if not confirm:
+            raise _page_error(page, page_url)
+        log.info(f"Drive file {file_id} needs confirmation, following the warning page")
+        kind, result = await _open(session, confirm, headers)
+        if kind == "page":
+            raise _page_error(*result[:2])
+
+    meta = result
+    meta["name"] = sanitize_filename(meta["name"] or file_id)
+    _cache_put(_meta, key, dict(meta))
+    return meta
+
+async def _list_page(session, folder_id, resource_key, base_url):
+    """
+    One folder's embeddedfolderview page.
+
+    :return: (title, [(id, resource key, name) of subfolders],
+             [(id, resource key, name) of files], Google Docs skipped)
+    """
+    params = {"id": folder_id}
+    headers = {}
+    if resource_key:
+        params["resourcekey"] = resource_key
+        headers["X-Goog-Drive-Resource-Keys"] = f"{folder_id}/{resource_key}"
+    async with session.get(f"{base_url}/embeddedfolderview?{urlencode(params)}", headers=headers) as r:
+        if r.status == 404:
+            raise DriveError("Folder not found. Check the link and its sharing settings.")
+        if urlparse(str(r.url)).hostname == "accounts.google.com":
+            raise DriveError("The folder is private or needs a signed-in account.")
+        r.raise_for_status()
+        page = await r.text(errors="replace")
+
+    soup = BeautifulSoup(page, "html.parser")
+    title = soup.title.get_text(strip=True) if soup.title else folder_id
+    folders, files, skipped = [], [], 0
+    for entry in soup.select("div.flip-entry"):
+        link = entry.find("a", href=True)
+        name = entry.select_one(".flip-entry-title")
+        if not link or not name:
+            continue
+        href, name = link["href"], name.get_text(strip=True)
+        child_id, child_key = parse_folder_url(href)
+        if child_id:
+            folders.append((child_id, child_key, name))
+            continue
+        if urlparse(href).hostname == "docs.google.com":
+            # Docs, Sheets and Slides have no file to download
+            skipped += 1
+            continue
+        file_id, file_key = parse_drive_url(href)
+        if file_id:
+            files.append((file_id, file_key, name))
+    return title, folders, files, skipped
+
+async def list_folder(folder_id, resource_key=None, base_url=BASE_URL):
+    """
+    Lists a shared folder and its subfolders, through the cache.
+    At most FOLDER_MAX_FILES files are returned.
+
+    :return: A dict with "title", "files" ([{"id", "resource_key", "path"}]
+             sorted by folder-relative path) and "skipped" (Google Docs
+             entries, which can't be downloaded).
+    :raises DriveError: If the folder can't be listed.
+    """
+    key = (folder_id, resource_key)
+    entry = _listings.get(key)
+    if entry and entry[0] > time.monotonic():
+        _listings.move_to_end(key)
+        return entry[1]
+
+    session = aio_downloader.get_session()
+    limit = asyncio.Semaphore(LIST_CONCURRENCY)
+    seen = {folder_id}
+    files = []
+    skipped = 0
+
+    async def walk(fid, rkey, prefix):
+        nonlocal skipped
+        if len(files) >= FOLDER_MAX_FILES:
+            return fid
+        async with limit:
+            title, folders, found, docs = await _list_page(session, fid, rkey, base_url)
+        skipped += docs
+        files.extend({"id": i, "resource_key": k, "path": prefix + name} for i, k, name in found)
+        children = [(i, k, name) for i, k, name in folders if i not in seen]
+        seen.update(i for i, _, _ in children)
+        await asyncio.gather(*(walk(i, k, f"{prefix}{name}/") for i, k, name in children))
+        return title
+
+    title = await walk(folder_id, resource_key, "")
+    files.sort(key=lambda f: f["path"])
+    if len(files) > FOLDER_MAX_FILES:
+        log.info(f"Drive folder {folder_id} has more than {FOLDER_MAX_FILES} files, taking the first ones")
+    listing = {"title": title, "files": files[:FOLDER_MAX_FILES], "skipped": skipped}
+    _cache_put(_listings, key, listing)
+    return listing
+
+def invalidate(file_id, resource_key=None):
+    """Forgets a resolved URL, e.g. after it stopped working"""
+    _meta.pop((file_id, resource_key), None)
+
+async def download(file_id, resource_key, dest_dir, meta=None, connections=CONNECTIONS,
+                   progress=None, should_cancel=None, base_url=BASE_URL, on_ranges=None):
+    """
+    Downloads a Drive file into `dest_dir` under its own name, resuming
+    from what an earlier attempt left there.
+
+    :param meta: A result of `resolve` to start from.
+    :param progress: Optional callable(downloaded, total), called on the event loop.
+    :param should_cancel: Optional callable returning True to abort.
+    :param on_ranges: Optional callable(ranges), see aio_downloader.download.
+    :return: (file path, meta)
+    """
+    meta = meta or await resolve(file_id, resource_key, base_url)
+    path = os.path.join(dest_dir, meta["name"])
+    try:
+        await aio_downloader.download(meta["url"], path, segments=connections, progress=progress,
+                                      should_cancel=should_cancel, info=meta, on_ranges=on_ranges)
+    except DownloadCancelled:
+        raise
+    except Exception as e:
+        # Confirm URLs expire; resolve again and resume from the segment state
+        log.warning(f"Drive download of {file_id} failed ({e}); resolving the link again")
+        invalidate(file_id, resource_key)
+        meta = await resolve(file_id, resource_key, base_url)
+        await aio_downloader.download(meta["url"], path, segments=connections, progress=progress,
+                                      should_cancel=should_cancel, info=meta, on_ranges=on_ranges)
+    return path, meta
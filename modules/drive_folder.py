@@ -0,0 +1,281 @@
+#
+# This module handles /drive with a shared folder link. The folder tree is
+# listed by drive_engine (cached for DRIVE_META_TTL), then its files are
+# fetched by DRIVE_FOLDER_WORKERS workers with the native Drive engine. Each
+# file goes through the scheduler, staging and the file cache like a single
+# /drive job, is uploaded as soon as it is on disk, and gets its path inside
+# the folder as caption. All files share one status message with the
+# aggregate progress.
+#
+# Delivered files are in the file cache, so sending the same folder link
+# again after a cancel or a failure only transfers what's missing. A job
+# resumed after a restart also skips the files its journal lists as sent.
+#
+
+import os
+import time
+import shutil
+import asyncio
+import logging
+from collections import deque
+from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+
+from .utils import humanbytes, DownloadCancelled, safe_edit_text
+from .file_splitter import FileRange, file_ranges
+from .part_uploader import upload_parts
+from .scheduler import scheduler, priority_for
+from . import file_cache, staging, tasks, drive_engine, journal
+
+log = logging.getLogger("drive_folder")
+
+# ---------------- Tunables (overridable from the environment) ----------------
+WORKERS = int(os.environ.get("DRIVE_FOLDER_WORKERS", "3"))
+MAX_SIZE = 1900 * 1024 * 1024  # Telegram-safe split size, as for single files
+STATUS_INTERVAL = 3   # seconds between status message refreshes
+SHOWN_FINISHED = 5    # recently finished files listed in the status
+
+def cancel_btn(tid):
+    # Folder jobs are "drive" tasks, cancelled by the /drive button handler
+    return InlineKeyboardMarkup([[InlineKeyboardButton("⛔ Cancel", callback_data=f"cancel_drive:{tid}")]])
+
+def _caption(path, idx=1, count=1):
+    """Folder-relative caption of a file, or of one of its parts"""
+    return f"📁 `{path}`" + (f"\nPart {idx}/{count}" if count > 1 else "")
+
+def _short(path, length=48):
+    return path if len(path) <= length else "…" + path[-(length - 1):]
+
+class FolderStatus:
+    """
+    Aggregate progress of a folder download, rendered into one status
+    message refreshed every STATUS_INTERVAL seconds. Byte counts cover the
+    files whose size is known so far.
+    """
+    def __init__(self, msg, tid, title, total):
+        self.msg = msg
+        self.tid = tid
+        self.title = title
+        self.total = total
+        self.sent = 0
+        self.cached = 0
+        self.failed = 0
+        self.sizes = {}     # file id -> size in bytes
+        self.fetched = {}   # file id -> bytes on disk
+        self.running = {}   # file id -> (path, progress text)
+        self.finished = deque(maxlen=SHOWN_FINISHED)
+        self.start = time.time()
+        self.closed = False
+
+    def update(self, fid, path, text):
+        self.running[fid] = (path, text)
+
+    def progress(self, fid, path, size):
+        """A drive_engine progress callback for one file"""
+        self.sizes[fid] = size
+
+        def callback(done, total):
+            self.fetched[fid] = done
+            pct = f"{done / total * 100:.1f}%" if total else humanbytes(done)
+            self.update(fid, path, f"⬇️ {pct}")
+        return callback
+
+    def finish(self, fid, path, ok, text, cached=False):
+        self.running.pop(fid, None)
+        if ok:
+            self.sent += 1
+            self.cached += cached
+            self.fetched[fid] = self.sizes.get(fid, 0)
+        else:
+            self.failed += 1
+            self.sizes.pop(fid, None)
+            self.fetched.pop(fid, None)
+        self.finished.append(f"{'✅' if ok else '❌'} `{_short(path)}` {text}".rstrip())
+
+    def render(self):
+        fetched = sum(self.fetched.values())
+        known = sum(self.sizes.values())
+        elapsed = time.time() - self.start
+        lines = [
+            f"📁 **Folder:** {self.title}",
+            f"✅ {self.sent}/{self.total} sent • ⬇️ {len(self.running)} running • ❌ {self.failed} failed",
+            f"**Downloaded:** {humanbytes(fetched)} of {humanbytes(known)} known • "
+            f"**Speed:** {humanbytes(fetched / elapsed if elapsed > 0 else 0)}/s",
+        ]
+        if self.cached:
+            lines.append(f"♻️ {self.cached} sent from cache")
+        lines.append("")
+        lines += [f"• `{_short(path)}` — {text}" for path, text in list(self.running.values())]
+        lines += list(self.finished)
+        return "\n".join(lines)
+
+    async def run(self):
+        while not self.closed:
+            await safe_edit_text(self.msg, self.render(), reply_markup=cancel_btn(self.tid))
+            await asyncio.sleep(STATUS_INTERVAL)
+
+    def stop(self):
+        self.closed = True
+
+async def _upload(app, chat_id, file_path, rel_path, progress, should_cancel):
+    """Uploads one file (byte-range parts above MAX_SIZE) and returns its file_cache entries"""
+    filesize = os.path.getsize(file_path)
+    if filesize > MAX_SIZE:
+        parts = file_ranges(file_path, MAX_SIZE)
+    else:
+        parts = [(0, filesize, os.path.basename(file_path))]
+
+    async def parts_progress(done, total, speed, eta, in_flight):
+        await progress(done, total)
+
+    async with scheduler.upload_slot():
+        messages = await upload_parts(
+            app, chat_id,
+            names=[name for _, _, name in parts],
+            sizes=[length for _, length, _ in parts],
+            open_part=lambda idx: FileRange(file_path, *parts[idx - 1]),
+            caption=lambda idx, name: _caption(rel_path, idx, len(parts)),
+            progress=parts_progress,
+            should_cancel=should_cancel,
+        )
+    return [file_cache.file_entry(message) for message in messages]
+
+async def download_folder(app, url, msg, paths, task, no_cache=False):
+    """
+    Downloads every file of a shared Drive folder (recursively) and
+    uploads each one as soon as it is on disk.
+    """
+    tid = task.tid
+    user_id = task.user_id
+    chat_id = msg.chat.id
+    folder_id, resource_key = drive_engine.parse_folder_url(url)
+    status = None
+    refresher = None
+
+    try:
+        await safe_edit_text(msg, "🔎 Listing the Drive folder...", reply_markup=cancel_btn(tid))
+        listing = await drive_engine.list_folder(folder_id, resource_key)
+        files = listing["files"]
+        if not files:
+            await safe_edit_text(msg, "❌ No downloadable files in this folder.", reply_markup=None)
+            return
+        status = FolderStatus(msg, tid, listing["title"], len(files))
+        journal.state(task, "downloading")
+        sent_before = journal.parts(task)
+
+        async def process(entry):
+            fid, rkey, path = entry["id"], entry["resource_key"], entry["path"]
+            if fid in sent_before:
+                return "sent before the restart", False
+            key = file_cache.cache_key("drive", fid)
+            if not no_cache and await file_cache.send_cached(
+                    app, chat_id, key, caption=lambda idx, count: _caption(path, idx, count)):
+                journal.delivered(task, fid)
+                return "from cache", True
+
+            status.update(fid, path, "🔎 resolving")
+            meta = await drive_engine.resolve(fid, rkey)
+            size = meta["size"]
+
+            async def show_position(position):
+                status.update(fid, path, f"⏳ queued ({position})")
+
+            async def show_wait(reason):
+                status.update(fid, path, staging.wait_text(reason))
+
+            async def upload_progress(current, total):
+                status.update(fid, path, f"⬆️ {current / total * 100 if total else 0:.1f}% of {humanbytes(total)}")
+
+            # Same directory as a single /drive of this file, so either resumes the other
+            work_dir = os.path.join(paths["downloads"], f"drive-{fid}")
+            keep_partial = False
+            reservation = None
+            try:
+                async with scheduler.job(user_id, size=size, priority=priority_for(size, bulk=True),
+                                         on_position=show_position,
+                                         should_cancel=task.is_cancelled):
+                    reservation = await staging.reserve(user_id, size, on_wait=show_wait,
+                                                        should_cancel=task.is_cancelled)
+                    os.makedirs(work_dir, exist_ok=True)
+                    status.update(fid, path, "⬇️ starting")
+                    try:
+                        async with scheduler.download_slot():
+                            file_path, meta = await drive_engine.download(
+                                fid, rkey, work_dir, meta=meta,
+                                progress=status.progress(fid, path, size),
+                                should_cancel=task.is_cancelled,
+                            )
+                    except (DownloadCancelled, asyncio.CancelledError):
+                        raise
+                    except Exception:
+                        keep_partial = True
+                        raise
+                    filesize = os.path.getsize(file_path)
+                    sent = await _upload(app, chat_id, file_path, path, upload_progress, task.is_cancelled)
+                    await file_cache.put(key, sent, filesize)
+                    journal.delivered(task, fid, sent)
+                    return humanbytes(filesize), False
+            finally:
+                staging.release(reservation)
+                if not keep_partial:
+                    shutil.rmtree(work_dir, ignore_errors=True)
+
+        queue = asyncio.Queue()
+        for entry in files:
+            queue.put_nowait(entry)
+
+        async def worker():
+            while True:
+                try:
+                    entry = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                try:
+                    text, cached = await process(entry)
+                except (DownloadCancelled, asyncio.CancelledError):
+                    raise
+                except Exception as e:
+                    if task.is_cancelled():
+                        raise DownloadCancelled()
+                    log.error(f"Drive folder file {entry['id']} ({entry['path']}) failed: {e}")
+                    status.finish(entry["id"], entry["path"], False, str(e)[:100])
+                else:
+                    status.finish(entry["id"], entry["path"], True, text, cached)
+
+        refresher = asyncio.create_task(status.run())
+        workers = [asyncio.create_task(worker()) for _ in range(min(WORKERS, len(files)))]
+        try:
+            await asyncio.gather(*workers)
+        except BaseException:
+            for w in workers:
+                w.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            raise
+        status.stop()
+        journal.state(task, "done")
+
+        took = int(time.time() - status.start)
+        notes = []
+        if listing["skipped"]:
+            notes.append(f"{listing['skipped']} Google Docs skipped (they have no file to download)")
+        if status.failed:
+            notes.append(f"{status.failed} failed; send the same link again to retry them")
+        summary = f"✅ Folder finished in {took}s." if not status.failed else f"⚠️ Finished in {took}s."
+        await safe_edit_text(msg, "\n".join([status.render(), "", summary] + notes), reply_markup=None)
+
+    except (DownloadCancelled, asyncio.CancelledError):
+        text = "❌ Download/Upload cancelled."
+        if status:
+            status.stop()
+            text = f"{status.render()}\n\n❌ Cancelled. Send the same link again to resume."
+        await safe_edit_text(msg, text, reply_markup=None)
+    except drive_engine.DriveError as e:
+        await safe_edit_text(msg, f"❌ **Google Drive Download Failed**\n\n{e}", reply_markup=None)
+    except Exception as e:
+        log.error(f"Error in drive folder download: {e}", exc_info=True)
+        await safe_edit_text(msg, f"❌ An unexpected error occurred: {e}", reply_markup=None)
+    finally:
+        if status:
+            status.stop()
+        if refresher:
+            refresher.cancel()
+        tasks.remove(task)
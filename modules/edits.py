@@ -0,0 +1,188 @@
+#
+# This module is the single dispatcher for status-message edits. Callers
+# only post the latest text for a message and return at once; a background
+# worker sends edits under Telegram's limits:
+#
+#   - a token bucket per chat (about 1 edit/s in private chats, 20/min in
+#     groups) plus a global bucket for the whole bot,
+#   - only the newest pending text per message is kept, so stale progress
+#     frames are dropped, and text identical to what is shown is skipped,
+#   - a FloodWait pauses that chat's bucket instead of the caller's task.
+#
+# However many transfers are running, the bot makes a bounded number of
+# edit calls, and a slow or rate-limited edit never holds up a transfer.
+#
+
+import os
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from pyrogram.errors import FloodWait, MessageNotModified
+
+log = logging.getLogger("edits")
+
+# ---------------- Tunables (overridable from the environment) ----------------
+PRIVATE_RATE = float(os.environ.get("EDIT_PRIVATE_RATE", "1"))          # edits/s per private chat
+GROUP_RATE = float(os.environ.get("EDIT_GROUP_PER_MINUTE", "20")) / 60  # edits/s per group
+GLOBAL_RATE = float(os.environ.get("EDIT_GLOBAL_RATE", "25"))           # edits/s for the bot
+MAX_INFLIGHT = 8          # edit requests on the wire at once
+SHOWN_ENTRIES = 4096      # remembered "currently shown" texts, for dropping duplicates
+PRUNE_INTERVAL = 60       # seconds between sweeps of idle per-chat buckets
+
+class _Bucket:
+    """
+    Token bucket: `rate` tokens per second, holding at most `burst`.
+    """
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+        self.blocked_until = 0  # set by FloodWait
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def ready_at(self, now):
+        """Monotonic time at which a token is available"""
+        self._refill(now)
+        wait = 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(now + wait, self.blocked_until)
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+class EditDispatcher:
+    """
+    Collects edits per message and sends them in the background.
+    All methods must be called from the event loop.
+    """
+    def __init__(self):
+        self.pending = OrderedDict()  # (chat_id, msg_id) -> (msg, text, reply_markup)
+        self.shown = OrderedDict()    # (chat_id, msg_id) -> (text, reply_markup)
+        self.inflight = set()
+        self.buckets = {}
+        self.global_bucket = _Bucket(GLOBAL_RATE, GLOBAL_RATE)
+        self.mirrors = {}  # (chat_id, msg_id) -> messages showing the same text, until the flight ends
+        self._wakeup = None
+        self._worker = None
+        self._pruned = time.monotonic()
+
+    # ---------------- Posting ----------------
+    def submit(self, msg, text, reply_markup=None):
+        """
+        Makes `text` the next content of `msg`, replacing any edit of it
+        that hasn't been sent yet. Mirrors of `msg` get the text without
+        buttons. Never blocks.
+        """
+        self._post(msg, text, reply_markup)
+        for mirror in self.mirrors.get(self._key(msg), ()):
+            self._post(mirror, text, None)
+
+    def _post(self, msg, text, reply_markup):
+        key = self._key(msg)
+        if key not in self.inflight and self.shown.get(key) == (text, reply_markup):
+            # Already on screen: a queued frame for it would only be stale
+            self.pending.pop(key, None)
+            return
+        self.pending[key] = (msg, text, reply_markup)
+        self.pending.move_to_end(key)
+        self._ensure_worker()
+        self._wakeup.set()
+
+    @staticmethod
+    def _key(msg):
+        return (msg.chat.id, msg.id)
+
+    def _bucket(self, chat_id):
+        bucket = self.buckets.get(chat_id)
+        if bucket is None:
+            # Negative ids are groups and channels, which have the tighter limit
+            rate = GROUP_RATE if chat_id < 0 else PRIVATE_RATE
+            bucket = self.buckets[chat_id] = _Bucket(rate, burst=1)
+        return bucket
+
+    def _prune(self, now):
+        """
+        Drops the buckets of chats with nothing queued or on the wire whose
+        bucket is full again: a new one would be identical.
+        """
+        busy = {key[0] for key in self.pending} | {key[0] for key in self.inflight}
+        for chat_id, bucket in list(self.buckets.items()):
+            if chat_id not in busy and bucket.ready_at(now) <= now and bucket.tokens >= bucket.burst:
+                del self.buckets[chat_id]
+        self._pruned = now
+
+    # ---------------- Mirrors ----------------
+    def add_mirror(self, msg, mirror):
+        """Shows every later edit of `msg` in `mirror` too"""
+        self.mirrors.setdefault(self._key(msg), []).append(mirror)
+
+    def drop_mirrors(self, msg):
+        """Stops mirroring `msg`"""
+        self.mirrors.pop(self._key(msg), None)
+
+    # ---------------- Worker ----------------
+    def _ensure_worker(self):
+        if self._worker is None or self._worker.done():
+            self._wakeup = asyncio.Event()
+            self._worker = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            now = time.monotonic()
+            next_at = None
+            for key in list(self.pending):
+                if len(self.inflight) >= MAX_INFLIGHT:
+                    break
+                if key in self.inflight:
+                    continue  # one edit per message at a time, in order
+                bucket = self._bucket(key[0])
+                at = max(bucket.ready_at(now), self.global_bucket.ready_at(now))
+                if at > now:
+                    next_at = at if next_at is None else min(next_at, at)
+                    continue
+                bucket.take(now)
+                self.global_bucket.take(now)
+                msg, text, reply_markup = self.pending.pop(key)
+                self.inflight.add(key)
+                asyncio.create_task(self._send(key, msg, text, reply_markup))
+
+            if now - self._pruned >= PRUNE_INTERVAL:
+                self._prune(now)
+
+            timeout = None if next_at is None else max(next_at - time.monotonic(), 0.01)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _send(self, key, msg, text, reply_markup):
+        try:
+            await msg.edit_text(text, reply_markup=reply_markup)
+            self._remember(key, text, reply_markup)
+        except FloodWait as e:
+            log.warning(f"FloodWait on chat {key[0]}: pausing its edits for {e.value}s")
+            self._bucket(key[0]).blocked_until = time.monotonic() + e.value
+            # Retry later unless a newer text has been posted meanwhile
+            if key not in self.pending:
+                self.pending[key] = (msg, text, reply_markup)
+        except MessageNotModified:
+            self._remember(key, text, reply_markup)
+        except Exception as e:
+            log.error(f"Failed to edit message: {e}")
+        finally:
+            self.inflight.discard(key)
+            self._wakeup.set()
+
+    def _remember(self, key, text, reply_markup):
+        self.shown[key] = (text, reply_markup)
+        self.shown.move_to_end(key)
+        while len(self.shown) > SHOWN_ENTRIES:
+            self.shown.popitem(last=False)
+
+dispatcher = EditDispatcher()
@@ -0,0 +1,216 @@
+#
+# This module is a multi-session upload engine. Pyrogram's save_file opens
+# one media session per file and pushes every chunk through it, so even a
+# single 1.9 GB upload is capped at what one MTProto connection carries.
+# Here a pool of UPLOAD_SESSIONS media sessions to the upload DC stays open,
+# and the SaveBigFilePart chunks of a file are spread over all of them.
+#
+# FastUploadClient plugs the engine into Client.save_file, so send_document
+# and send_video in /leech, /ytdl and /drive (and the part uploader) use it
+# without changes. Small files and missing-part retries keep Pyrogram's path.
+#
+
+import os
+import math
+import time
+import asyncio
+import inspect
+import logging
+import functools
+from pyrogram import Client, raw, StopTransmission
+from pyrogram.session import Session
+
+from .file_splitter import FileRange
+from .part_uploader import PARALLEL_PARTS
+from .scheduler import UPLOAD_SLOTS
+
+log = logging.getLogger("fast_upload")
+
+# ---------------- Tunables (overridable from the environment) ----------------
+SESSIONS = int(os.environ.get("UPLOAD_SESSIONS", "4"))
+WORKERS_PER_SESSION = int(os.environ.get("UPLOAD_WORKERS_PER_SESSION", "2"))
+# Big files going over the session pool at once: by default every part of
+# every upload slot (see scheduler and part_uploader)
+CONCURRENT_FILES = int(os.environ.get("UPLOAD_CONCURRENT_FILES", str(PARALLEL_PARTS * UPLOAD_SLOTS)))
+PART_SIZE = 512 * 1024             # Telegram's maximum upload chunk
+BIG_FILE_SIZE = 10 * 1024 * 1024   # Below this Telegram wants SaveFilePart + md5
+PART_RETRIES = 3
+
+class SessionPool:
+    """
+    Media sessions to the client's DC, started on first use and kept open
+    between uploads so each file doesn't pay for new handshakes.
+    """
+    def __init__(self, client):
+        self.client = client
+        self.sessions = []
+        self._lock = asyncio.Lock()
+
+    async def get(self, count):
+        """Returns `count` started sessions, opening more if needed"""
+        async with self._lock:
+            while len(self.sessions) < count:
+                session = Session(
+                    self.client, await self.client.storage.dc_id(),
+                    await self.client.storage.auth_key(),
+                    await self.client.storage.test_mode(), is_media=True,
+                )
+                await session.start()
+                self.sessions.append(session)
+                log.info(f"Upload session {len(self.sessions)} started")
+            return self.sessions[:count]
+
+    async def close(self):
+        async with self._lock:
+            for session in self.sessions:
+                try:
+                    await session.stop()
+                except Exception as e:
+                    log.error(f"Failed to stop upload session: {e}")
+            self.sessions = []
+
+def _source_range(path):
+    """(file path, offset, length, name) for a path or FileRange, else None"""
+    if isinstance(path, FileRange):
+        return path.path, path.offset, path.length, path.name
+    if isinstance(path, (str, os.PathLike)) and os.path.isfile(path):
+        path = os.fspath(path)
+        return path, 0, os.path.getsize(path), os.path.basename(path)
+    return None
+
+async def save_big_file(client, pool, path, offset, length, name, progress=None, progress_args=(),
+                        sessions=SESSIONS, workers_per_session=WORKERS_PER_SESSION):
+    """
+    Uploads `length` bytes of `path` starting at `offset` as a big file,
+    sending chunks in parallel over `sessions` pooled media sessions.
+
+    :param progress: Optional callable progress(current, total, *progress_args),
+                     plain or coroutine, like Pyrogram's.
+    :return: The raw InputFileBig to send the file with.
+    """
+    total_parts = math.ceil(length / PART_SIZE)
+    file_id = client.rnd_id()
+    parts = asyncio.Queue()
+    for part in range(total_parts):
+        parts.put_nowait(part)
+    uploaded = 0
+    fd = os.open(path, os.O_RDONLY)
+
+    async def report():
+        if not progress:
+            return
+        func = functools.partial(progress, min(uploaded, length), length, *progress_args)
+        if inspect.iscoroutinefunction(progress):
+            await func()
+        else:
+            await client.loop.run_in_executor(client.executor, func)
+
+    async def worker(session):
+        nonlocal uploaded
+        while True:
+            try:
+                part = parts.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            start = part * PART_SIZE
+            chunk = await asyncio.to_thread(os.pread, fd, min(PART_SIZE, length - start), offset + start)
+            rpc = raw.functions.upload.SaveBigFilePart(
+                file_id=file_id, file_part=part, file_total_parts=total_parts, bytes=chunk,
+            )
+            for attempt in range(1, PART_RETRIES + 1):
+                try:
+                    await session.invoke(rpc)
+                    break
+                except Exception as e:
+                    if attempt >= PART_RETRIES:
+                        raise
+                    log.warning(f"Chunk {part} of {name} failed (attempt {attempt}/{PART_RETRIES}): {e}")
+                    await asyncio.sleep(attempt)
+            uploaded += len(chunk)
+            await report()
+
+    try:
+        pool_sessions = await pool.get(sessions)
+        workers = [
+            asyncio.create_task(worker(session))
+            for session in pool_sessions
+            for _ in range(workers_per_session)
+        ]
+        try:
+            await asyncio.gather(*workers)
+        except BaseException:
+            # Stop the other workers, e.g. on StopTransmission from progress
+            for w in workers:
+                w.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            raise
+    finally:
+        os.close(fd)
+
+    return raw.types.InputFileBig(id=file_id, parts=total_parts, name=name)
+
+class FastUploadClient(Client):
+    """
+    Client whose save_file sends big files over the multi-session pool.
+    """
+    def __init__(self, *args, upload_sessions=SESSIONS, concurrent_files=CONCURRENT_FILES, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.upload_sessions = upload_sessions
+        self.upload_pool = SessionPool(self)
+        # Not Pyrogram's save_file_semaphore, which defaults to one upload bot-wide
+        self.big_file_slots = asyncio.Semaphore(concurrent_files)
+
+    async def save_file(self, path, file_id=None, file_part=0, progress=None, progress_args=()):
+        source = _source_range(path) if file_id is None and path is not None else None
+        if source is None or source[2] <= BIG_FILE_SIZE or self.upload_sessions <= 1:
+            return await super().save_file(path, file_id, file_part, progress, progress_args)
+
+        file_path, offset, length, name = source
+        async with self.big_file_slots:
+            try:
+                return await save_big_file(
+                    self, self.upload_pool, file_path, offset, length, name,
+                    progress=progress, progress_args=progress_args, sessions=self.upload_sessions,
+                )
+            except StopTransmission:
+                raise
+            except Exception as e:
+                # Same contract as Pyrogram's save_file: log and return None
+                log.exception(e)
+                return None
+
+    async def stop(self, *args, **kwargs):
+        await self.upload_pool.close()
+        return await super().stop(*args, **kwargs)
+
+async def benchmark(client, size_mb=64, session_counts=(1, 2, 4, 8), path=None):
+    """
+    Benchmark hook: uploads the same file (without sending it anywhere)
+    once per session count and returns {sessions: MB/s}. Pyrogram's own
+    single-session save_file is reported under 0.
+    """
+    own_file = path is None
+    if own_file:
+        path = f"bench_upload_{size_mb}M.bin"
+        with open(path, "wb") as f:
+            for _ in range(size_mb):
+                f.write(os.urandom(1024 * 1024))
+    length = os.path.getsize(path)
+    pool = SessionPool(client)
+    results = {}
+    try:
+        start = time.perf_counter()
+        await Client.save_file(client, path)
+        results[0] = length / (1024 * 1024) / (time.perf_counter() - start)
+
+        for count in session_counts:
+            await pool.get(count)  # handshakes are not part of the measurement
+            start = time.perf_counter()
+            await save_big_file(client, pool, path, 0, length, os.path.basename(path), sessions=count)
+            results[count] = length / (1024 * 1024) / (time.perf_counter() - start)
+            log.info(f"{count} sessions: {results[count]:.1f} MB/s")
+    finally:
+        await pool.close()
+        if own_file:
+            os.remove(path)
+    return results
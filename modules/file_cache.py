@@ -0,0 +1,251 @@
+#
+# This module remembers the Telegram file_ids of everything we upload, keyed
+# by the normalized source (URL plus format id / Drive file id). A repeat
+# request is answered by resending the cached file_ids, which skips both
+# the download and the upload.
+#
+# Entries live in MongoDB (`file_cache` collection) with an in-memory LRU
+# in front. MongoDB is optional: without it the LRU alone is used.
+#
+
+import os
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+from pymongo import ASCENDING
+from pyrogram.errors import FloodWait
+
+from .utils import file_cache_col
+
+log = logging.getLogger("file_cache")
+
+# ---------------- Tunables (overridable from the environment) ----------------
+TTL_DAYS = int(os.environ.get("FILE_CACHE_TTL_DAYS", "30"))
+MEMORY_ENTRIES = int(os.environ.get("FILE_CACHE_MEMORY_ENTRIES", "512"))
+MAX_ENTRIES = int(os.environ.get("FILE_CACHE_MAX_ENTRIES", "20000"))
+TOUCH_INTERVAL = timedelta(minutes=10)  # memory hits refresh last_used in MongoDB at most this often
+
+# Flag users add to a command to skip the cache for that one request
+BYPASS_FLAG = "--nocache"
+
+# Query parameters that never change what gets downloaded
+_TRACKING_PARAMS = {"fbclid", "gclid", "igshid", "si", "feature", "ref"}
+
+_memory = OrderedDict()  # key -> entry, most recently used last
+_touches = set()  # background last_used updates, kept referenced until done
+_indexes_ready = False
+
+def normalize_url(url):
+    """
+    Canonical form of a URL for cache keys: lowercase scheme and host,
+    default ports and fragments dropped, tracking parameters removed and
+    the query sorted.
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    if parts.port and not ((scheme == "http" and parts.port == 80) or (scheme == "https" and parts.port == 443)):
+        host = f"{host}:{parts.port}"
+    query = sorted(
+        (k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+        if k.lower() not in _TRACKING_PARAMS and not k.lower().startswith("utm_")
+    )
+    return urlunsplit((scheme, host, parts.path or "/", urlencode(query), ""))
+
+def cache_key(kind, source, variant=None):
+    """
+    Builds the cache key for a `kind` of job ("leech", "ytdl", "drive").
+    URLs are normalized; ids (e.g. a Drive file id) are used as they are.
+    """
+    if source.startswith(("http://", "https://")):
+        source = normalize_url(source)
+    return f"{kind}:{source}" + (f"#{variant}" if variant else "")
+
+def split_bypass_flag(text):
+    """
+    Removes BYPASS_FLAG from a command argument string.
+
+    :return: (remaining text, True if the flag was present)
+    """
+    words = text.split()
+    if BYPASS_FLAG not in words:
+        return text.strip(), False
+    return " ".join(w for w in words if w != BYPASS_FLAG), True
+
+def file_entry(message, caption=None):
+    """
+    Extracts what's needed to resend an uploaded message by file_id.
+    """
+    media = message.video or message.document or message.audio
+    if media is None:
+        return None
+    return {"file_id": media.file_id, "caption": caption if caption is not None else (message.caption or "")}
+
+def _remember(key, entry):
+    _memory[key] = entry
+    _memory.move_to_end(key)
+    while len(_memory) > MEMORY_ENTRIES:
+        _memory.popitem(last=False)
+
+def _expired(entry):
+    return entry["expires_at"] <= datetime.now(timezone.utc)
+
+def _ensure_indexes():
+    """Creates the TTL and LRU indexes once per process"""
+    global _indexes_ready
+    if _indexes_ready:
+        return
+    file_cache_col.create_index("expires_at", expireAfterSeconds=0)
+    file_cache_col.create_index([("last_used", ASCENDING)])
+    _indexes_ready = True
+
+def _db_get(key):
+    now = datetime.now(timezone.utc)
+    doc = file_cache_col.find_one_and_update({"_id": key}, {"$set": {"last_used": now}})
+    if doc:
+        doc["last_used"] = now
+        if doc["expires_at"].tzinfo is None:
+            doc["expires_at"] = doc["expires_at"].replace(tzinfo=timezone.utc)
+    return doc
+
+def _touch(key, when):
+    file_cache_col.update_one({"_id": key}, {"$set": {"last_used": when}})
+
+async def _touch_later(key, when):
+    try:
+        await asyncio.to_thread(_touch, key, when)
+    except Exception as e:
+        log.warning(f"File cache last_used update failed for {key}: {e}")
+
+def _db_put(entry):
+    _ensure_indexes()
+    file_cache_col.replace_one({"_id": entry["_id"]}, entry, upsert=True)
+    # Size-based eviction: drop the least recently used entries over the cap
+    excess = file_cache_col.estimated_document_count() - MAX_ENTRIES
+    if excess > 0:
+        stale = file_cache_col.find({}, {"_id": 1}).sort("last_used", ASCENDING).limit(excess)
+        file_cache_col.delete_many({"_id": {"$in": [d["_id"] for d in stale]}})
+
+async def get(key):
+    """
+    Returns the cached entry for `key`, or None on a miss or expiry.
+    """
+    entry = _memory.get(key)
+    if entry is not None:
+        if _expired(entry):
+            _memory.pop(key, None)
+            return None
+        _memory.move_to_end(key)
+        # Size-based eviction goes by last_used: keep entries served from memory off its list
+        now = datetime.now(timezone.utc)
+        if file_cache_col is not None and now - entry["last_used"] >= TOUCH_INTERVAL:
+            entry["last_used"] = now
+            touch = asyncio.create_task(_touch_later(key, now))
+            _touches.add(touch)
+            touch.add_done_callback(_touches.discard)
+        return entry
+
+    if file_cache_col is None:
+        return None
+    try:
+        entry = await asyncio.to_thread(_db_get, key)
+    except Exception as e:
+        log.warning(f"File cache lookup failed for {key}: {e}")
+        return None
+    if entry is None or _expired(entry):
+        return None
+    _remember(key, entry)
+    return entry
+
+async def put(key, files, size=0):
+    """
+    Stores the file_id entries (see `file_entry`) delivered for `key`.
+    """
+    files = [f for f in files if f]
+    if not files:
+        return
+    now = datetime.now(timezone.utc)
+    entry = {
+        "_id": key,
+        "files": files,
+        "size": size,
+        "created_at": now,
+        "last_used": now,
+        "expires_at": now + timedelta(days=TTL_DAYS),
+    }
+    _remember(key, entry)
+    if file_cache_col is None:
+        return
+    try:
+        await asyncio.to_thread(_db_put, entry)
+    except Exception as e:
+        log.warning(f"File cache store failed for {key}: {e}")
+
+async def invalidate(key):
+    """Forgets `key`, e.g. when a cached file_id stopped working"""
+    _memory.pop(key, None)
+    if file_cache_col is not None:
+        try:
+            await asyncio.to_thread(file_cache_col.delete_one, {"_id": key})
+        except Exception as e:
+            log.warning(f"File cache invalidation failed for {key}: {e}")
+
+async def resend(app, chat_id, files, caption=None):
+    """
+    Sends file entries to `chat_id` by file_id, in order, waiting out FloodWait.
+
+    :param caption: Optional callable(index, count) giving the caption of
+                    each file (1-based) instead of the stored one.
+    :return: (number of files sent, the error that stopped the rest or None).
+    """
+    count = len(files)
+    for idx, f in enumerate(files, 1):
+        text = caption(idx, count) if caption else f.get("caption", "")
+        while True:
+            try:
+                await app.send_cached_media(chat_id, f["file_id"], caption=text)
+                break
+            except FloodWait as e:
+                log.info(f"Flood wait. Waiting for {e.value} seconds...")
+                await asyncio.sleep(e.value)
+            except Exception as e:
+                return idx - 1, e
+    return count, None
+
+async def send_cached(app, chat_id, key, caption=None):
+    """
+    Resends the cached files for `key` to `chat_id` by file_id.
+
+    :param caption: Optional callable(index, count) giving the caption of
+                    each file (1-based) instead of the stored one.
+    :return: True if the request was served from the cache. That includes a
+             resend that failed after some parts reached the chat: they are
+             not sent again, the chat is told to retry instead.
+    """
+    entry = await get(key)
+    if entry is None:
+        return False
+    start = time.time()
+    count = len(entry["files"])
+    sent, error = await resend(app, chat_id, entry["files"], caption)
+    if error is None:
+        log.info(f"Served {key} from file cache in {(time.time() - start) * 1000:.0f} ms")
+        return True
+
+    # file_ids can become invalid; the next request does a normal transfer
+    log.warning(f"Cached resend of {key} failed after {sent}/{count} files: {error}")
+    await invalidate(key)
+    if not sent:
+        return False
+    # A full transfer now would post the first parts twice
+    try:
+        await app.send_message(
+            chat_id, f"⚠️ Only {sent} of {count} parts could be resent from the cache ({error}). "
+                     f"Send the same command again to fetch the file afresh.")
+    except Exception as e:
+        log.warning(f"Could not report the partial resend of {key} to {chat_id}: {e}")
+    return True
@@ -2,8 +2,79 @@
 # This module contains functions for splitting and merging large files,
 # primarily used for handling Telegram's file size limits.
 #
+# Bytes are moved inside the kernel with copy_file_range/sendfile where
+# possible, with a fixed-size buffered copy as the fallback, so memory use
+# stays constant no matter how large the parts are.
+#
 
+import io
 import os
+import errno
+import logging
+
+log = logging.getLogger("file_splitter")
+
+COPY_BUFFER_SIZE = 1024 * 1024 # 1 MiB, used only by the buffered fallback
+COPY_STEP = 256 * 1024 * 1024 # Bytes per kernel copy call
+
+# Errors meaning "this copy method isn't available here", not real I/O failures
+_UNSUPPORTED = {errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF}
+
+def _kernel_copy(copy_fn, src_fd, dst_fd, offset, count):
+    """
+    Copies with copy_file_range or sendfile. Returns the bytes copied, which
+    is 0 if the method is unsupported before anything was written.
+    """
+    copied = 0
+    while copied < count:
+        step = min(COPY_STEP, count - copied)
+        try:
+            if copy_fn == "copy_file_range":
+                n = os.copy_file_range(src_fd, dst_fd, step, offset + copied)
+            else:
+                n = os.sendfile(dst_fd, src_fd, offset + copied, step)
+        except OSError as e:
+            if copied == 0 and e.errno in _UNSUPPORTED:
+                return 0
+            raise
+        if n == 0:
+            break # End of the source file
+        copied += n
+    return copied
+
+def _buffered_copy(src_fd, dst_fd, offset, count):
+    """
+    Fallback copy in COPY_BUFFER_SIZE reads, so at most one buffer is held.
+    """
+    copied = 0
+    while copied < count:
+        data = os.pread(src_fd, min(COPY_BUFFER_SIZE, count - copied), offset + copied)
+        if not data:
+            break
+        view = memoryview(data)
+        written = 0
+        while written < len(data):
+            written += os.write(dst_fd, view[written:])
+        copied += len(data)
+    return copied
+
+def copy_range(src_fd, dst_fd, offset, count):
+    """
+    Copies `count` bytes starting at `offset` of `src_fd` to the current
+    position of `dst_fd`, using the cheapest method the kernel supports.
+
+    :return: The number of bytes copied (less than `count` only at end of file).
+    """
+    if count <= 0:
+        return 0
+    for copy_fn in ("copy_file_range", "sendfile"):
+        if hasattr(os, copy_fn):
+            copied = _kernel_copy(copy_fn, src_fd, dst_fd, offset, count)
+            if copied:
+                if copied < count:
+                    copied += _buffered_copy(src_fd, dst_fd, offset + copied, count - copied)
+                return copied
+    return _buffered_copy(src_fd, dst_fd, offset, count)
 
 def split_file(file_path, chunk_size=2097152000): # 2 GB in bytes
     """
@@ -14,6 +85,18 @@ def split_file(file_path, chunk_size=2097152000): # 2 GB in bytes
     :param chunk_size: The maximum size of each part in bytes.
     :return: A list of strings, where each string is the full path to a part file.
     """
+    return list(iter_split(file_path, chunk_size))
+
+def iter_split(file_path, chunk_size=2097152000):
+    """
+    Generator version of `split_file`: each part is only written when the
+    caller asks for it, so parts can be uploaded (and deleted) while the
+    next one is being cut.
+
+    :param file_path: The full path to the large file to be split.
+    :param chunk_size: The maximum size of each part in bytes.
+    :return: Yields the full path of each part file in order.
+    """
     if not os.path.exists(file_path):
         raise FileNotFoundError(f"File not found: {file_path}")
 
@@ -22,23 +105,92 @@ def split_file(file_path, chunk_size=2097152000): # 2 GB in bytes
     part_dir = os.path.dirname(base_name)
     part_base_name = os.path.basename(base_name)
     part_num = 1
-    part_paths = []
+    total = os.path.getsize(file_path)
 
     with open(file_path, 'rb') as f:
-        while True:
-            data = f.read(chunk_size)
-            if not data:
-                break
-            
+        for offset in range(0, total, chunk_size):
             # Create a more user-friendly part name
             part_path = os.path.join(part_dir, f"{part_base_name}_part{part_num}{ext}")
             with open(part_path, 'wb') as out_f:
-                out_f.write(data)
+                copy_range(f.fileno(), out_f.fileno(), offset, min(chunk_size, total - offset))
             
-            part_paths.append(part_path)
+            yield part_path
             part_num += 1
 
-    return part_paths
+class FileRange(io.RawIOBase):
+    """
+    A read-only file object over `length` bytes of `path` starting at
+    `offset`. It has its own `name`, so Pyrogram's `send_document` can upload
+    one part of a large file directly, without writing a part file.
+    """
+    def __init__(self, path, offset, length, name=None):
+        super().__init__()
+        self.path = path
+        self.offset = offset
+        self.length = length
+        self.name = name or os.path.basename(path)
+        self._fd = os.open(path, os.O_RDONLY)
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            pos += self._pos
+        elif whence == io.SEEK_END:
+            pos += self.length
+        if pos < 0:
+            raise ValueError(f"Negative seek position {pos}")
+        self._pos = pos
+        return self._pos
+
+    def readinto(self, buffer):
+        remaining = self.length - self._pos
+        if remaining <= 0:
+            return 0
+        view = memoryview(buffer)[:remaining]
+        data = os.pread(self._fd, len(view), self.offset + self._pos)
+        view[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+    def read(self, size=-1):
+        remaining = max(0, self.length - self._pos)
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        data = os.pread(self._fd, size, self.offset + self._pos) if size else b""
+        self._pos += len(data)
+        return data
+
+    def close(self):
+        if not self.closed:
+            os.close(self._fd)
+        super().close()
+
+def file_ranges(file_path, chunk_size=2097152000):
+    """
+    Describes how `file_path` would be split, without copying any bytes.
+
+    :param file_path: The full path to the large file.
+    :param chunk_size: The maximum size of each part in bytes.
+    :return: A list of (offset, length, part_name) tuples, named like split_file's parts.
+    """
+    if not os.path.exists(file_path):
+        raise FileNotFoundError(f"File not found: {file_path}")
+
+    base_name, ext = os.path.splitext(os.path.basename(file_path))
+    total = os.path.getsize(file_path)
+    return [
+        (offset, min(chunk_size, total - offset), f"{base_name}_part{idx}{ext}")
+        for idx, offset in enumerate(range(0, total, chunk_size), 1)
+    ]
 
 def merge_files(file_parts):
     """
@@ -60,7 +212,7 @@ def merge_files(file_parts):
             if not os.path.exists(part):
                 raise FileNotFoundError(f"Part file not found: {part}")
             with open(part, 'rb') as in_f:
-                out_f.write(in_f.read())
+                copy_range(in_f.fileno(), out_f.fileno(), 0, os.path.getsize(part))
 
     return merged_path
 
@@ -69,7 +221,9 @@ if __name__ == "__main__":
     test_file_path = "test_large_file.mp4"
     # Create a dummy large file for demonstration
     with open(test_file_path, 'wb') as f:
-        f.write(b'\0' * (2100 * 1024 * 1024))
+        block = b'\0' * (1024 * 1024)
+        for _ in range(2100):
+            f.write(block)
     
     print("Splitting large file...")
     parts = split_file(test_file_path, chunk_size=1024*1024*1024)
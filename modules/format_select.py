@@ -0,0 +1,139 @@
+#
+# This module predicts the size of /ytdl downloads before they start. The
+# merged-quality buttons used to ignore size, so a "1080p" pick could come
+# out above Telegram's limit and be split into document parts that don't
+# stream. Here:
+#
+#   - each merged button gets the summed size of the video and audio
+#     streams yt-dlp would pick for it,
+#   - `best_under` finds the highest resolution/bitrate video + audio pair
+#     (or single file) whose predicted size fits under a limit, so it can
+#     be sent as one streamable video without a split pass,
+#   - `smallest` finds the smallest download, for when nothing fits.
+#
+# Sizes come from filesize, filesize_approx, or bitrate x duration.
+#
+
+import logging
+
+log = logging.getLogger("format_select")
+
+# Merged quality buttons: id -> video height (None for the best available)
+MERGED_HEIGHTS = {
+    "merged_360p": 360,
+    "merged_480p": 480,
+    "merged_720p": 720,
+    "merged_1080p": 1080,
+    "merged_max": None,
+}
+
+def format_size(f, duration=None):
+    """Predicted size of one format in bytes, or 0 when nothing hints at it"""
+    size = f.get("filesize") or f.get("filesize_approx")
+    if size:
+        return int(size)
+    if f.get("tbr") and duration:
+        return int(f["tbr"] * 1000 / 8 * duration)
+    return 0
+
+def _video_only(f):
+    return f.get("vcodec") not in (None, "none") and f.get("acodec") == "none"
+
+def _audio_only(f):
+    return f.get("acodec") not in (None, "none") and f.get("vcodec") == "none"
+
+def _progressive(f):
+    return f.get("vcodec") not in (None, "none") and f.get("acodec") not in (None, "none")
+
+def _best(formats):
+    # yt-dlp sorts formats worst to best, so "best" is the last match
+    return formats[-1] if formats else None
+
+def merged_sizes(info):
+    """
+    Predicted size of every merged quality button, mirroring the format
+    strings download_media uses for them ({button id: bytes, 0 if unknown}).
+    """
+    formats = info.get("formats") or []
+    duration = info.get("duration")
+    m4a = _best([f for f in formats if _audio_only(f) and f.get("ext") == "m4a"])
+    sizes = {}
+    for button, height in MERGED_HEIGHTS.items():
+        if height is None:
+            # bestvideo+bestaudio/best
+            video = _best([f for f in formats if _video_only(f)])
+            audio = _best([f for f in formats if _audio_only(f)])
+            pair = [video, audio] if video and audio else [_best(formats)]
+        else:
+            # bestvideo[height=N][ext=mp4]+bestaudio[ext=m4a]
+            video = _best([f for f in formats if _video_only(f) and f.get("height") == height and f.get("ext") == "mp4"])
+            pair = [video, m4a]
+        if None in pair or not all(format_size(f, duration) for f in pair):
+            sizes[button] = 0
+        else:
+            sizes[button] = sum(format_size(f, duration) for f in pair)
+    return sizes
+
+def best_under(info, limit):
+    """
+    The best download that fits in `limit` bytes, as a dict with "format"
+    (a yt-dlp format string), "res" (height) and "size", or None.
+    Highest resolution wins, then frame rate and total bitrate; m4a audio
+    is preferred on ties so the result can be merged into MP4.
+    """
+    formats = info.get("formats") or []
+    duration = info.get("duration")
+    audios = [f for f in formats if _audio_only(f) and format_size(f, duration)]
+    candidates = []
+
+    for video in formats:
+        if not video.get("height") or not format_size(video, duration):
+            continue
+        vsize = format_size(video, duration)
+        if _progressive(video) and vsize <= limit:
+            candidates.append(((video["height"], video.get("fps") or 0, video.get("tbr") or 0, 0),
+                               video["format_id"], vsize, video["height"]))
+        elif _video_only(video):
+            fitting = [a for a in audios if vsize + format_size(a, duration) <= limit]
+            if not fitting:
+                continue
+            audio = max(fitting, key=lambda a: (a.get("ext") == "m4a", a.get("abr") or a.get("tbr") or 0))
+            size = vsize + format_size(audio, duration)
+            score = (video["height"], video.get("fps") or 0,
+                     (video.get("tbr") or 0) + (audio.get("abr") or audio.get("tbr") or 0),
+                     audio.get("ext") == "m4a")
+            candidates.append((score, f"{video['format_id']}+{audio['format_id']}", size, video["height"]))
+
+    if not candidates:
+        return None
+    _, spec, size, res = max(candidates, key=lambda c: c[0])
+    return {"format": spec, "res": res, "size": size}
+
+def smallest(info):
+    """
+    The smallest download with a predicted size, as a dict like
+    `best_under`'s, or None. Video is preferred: audio alone is only
+    picked when no video format has a size hint.
+    """
+    formats = info.get("formats") or []
+    duration = info.get("duration")
+    audios = [f for f in formats if _audio_only(f) and format_size(f, duration)]
+    audio = min(audios, key=lambda a: format_size(a, duration)) if audios else None
+    candidates = []
+
+    for video in formats:
+        vsize = format_size(video, duration)
+        if not vsize:
+            continue
+        if _progressive(video):
+            candidates.append((vsize, video["format_id"], video.get("height") or 0))
+        elif _video_only(video) and audio:
+            candidates.append((vsize + format_size(audio, duration),
+                               f"{video['format_id']}+{audio['format_id']}", video.get("height") or 0))
+
+    if not candidates and audio:
+        candidates.append((format_size(audio, duration), audio["format_id"], 0))
+    if not candidates:
+        return None
+    size, spec, res = min(candidates)
+    return {"format": spec, "res": res, "size": size}
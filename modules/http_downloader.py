@@ -0,0 +1,424 @@
+#
+# This module implements a segmented HTTP download engine for /leech.
+# A file is split into byte ranges which are fetched over parallel
+# connections straight into a preallocated file on disk.
+#
+# Completed ranges are recorded in a sidecar state file next to the
+# partial download, so a retry or a bot restart continues where the
+# previous attempt stopped instead of starting again from byte zero.
+#
+
+import os
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
+import requests
+from requests.adapters import HTTPAdapter
+
+from .utils import DownloadCancelled
+
+log = logging.getLogger("http_downloader")
+
+# ---------------- Tunables (overridable from the environment) ----------------
+SEGMENTS = int(os.environ.get("LEECH_SEGMENTS", "4"))
+CHUNK_SIZE = int(os.environ.get("LEECH_CHUNK_SIZE", str(1024 * 1024)))  # 1 MiB
+MIN_SEGMENT_SIZE = 4 * 1024 * 1024  # Don't bother splitting below 4 MiB per range
+TIMEOUT = (15, 60)  # (connect, read) seconds
+STATE_SUFFIX = ".state"
+STATE_FLUSH_INTERVAL = 2  # seconds between state file writes
+RETRIES = int(os.environ.get("LEECH_RETRIES", "3"))
+
+class ResourceChanged(Exception):
+    """Raised when the remote file no longer matches the saved resume state"""
+    pass
+
+def new_session(pool_size=SEGMENTS):
+    """
+    Creates a requests session whose connection pool is large enough
+    for one connection per segment.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def probe(url, session):
+    """
+    Finds the final URL, the total size and whether the server honours
+    `Range` requests. A HEAD is tried first, then a one-byte ranged GET,
+    since plenty of servers omit `Accept-Ranges` on HEAD but still serve 206.
+
+    :return: A dict with `url`, `size` (0 if unknown), `ranges` (bool),
+             `etag` and `last_modified` (None if not sent).
+    """
+    info = {"url": url, "size": 0, "ranges": False, "etag": None, "last_modified": None}
+
+    try:
+        r = session.head(url, allow_redirects=True, timeout=TIMEOUT)
+        if r.ok:
+            info["url"] = r.url
+            info["size"] = int(r.headers.get("content-length", 0) or 0)
+    except requests.exceptions.RequestException as e:
+        log.info(f"HEAD failed for {url}: {e}")
+
+    with session.get(info["url"], headers={"Range": "bytes=0-0"}, stream=True,
+                     allow_redirects=True, timeout=TIMEOUT) as r:
+        r.raise_for_status()
+        info["url"] = r.url
+        info["etag"] = r.headers.get("etag")
+        info["last_modified"] = r.headers.get("last-modified")
+        content_range = r.headers.get("content-range", "")
+        if r.status_code == 206 and "/" in content_range:
+            total = content_range.rsplit("/", 1)[1]
+            if total.isdigit():
+                info["size"] = int(total)
+                info["ranges"] = True
+
+    return info
+
+def merge_ranges(ranges):
+    """
+    Sorts inclusive (start, end) ranges and joins overlapping or adjacent ones.
+    """
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return [tuple(r) for r in merged]
+
+def missing_ranges(size, done):
+    """
+    Returns the inclusive ranges of [0, size) not covered by `done`.
+    """
+    holes = []
+    pos = 0
+    for start, end in merge_ranges(done):
+        if start > pos:
+            holes.append((pos, start - 1))
+        pos = max(pos, end + 1)
+    if pos < size:
+        holes.append((pos, size - 1))
+    return holes
+
+def plan_segments(size, segments=SEGMENTS, done=()):
+    """
+    Splits the bytes of [0, size) that are not already in `done` into about
+    `segments` inclusive (start, end) ranges, each at least MIN_SEGMENT_SIZE
+    long (except where a hole is smaller than that).
+    """
+    if size <= 0:
+        return []
+    holes = missing_ranges(size, done)
+    remaining = sum(end - start + 1 for start, end in holes)
+    if not remaining:
+        return []
+    step = max(MIN_SEGMENT_SIZE, -(-remaining // max(1, segments)))  # ceil division
+    plan = []
+    for start, end in holes:
+        for seg_start in range(start, end + 1, step):
+            plan.append((seg_start, min(seg_start + step - 1, end)))
+    return plan
+
+def preallocate(filepath, size):
+    """
+    Creates `filepath` with its final size so every segment can write into
+    its own region. Uses posix_fallocate where available to reserve blocks.
+    """
+    with open(filepath, "wb") as f:
+        if size and hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(f.fileno(), 0, size)
+                return
+            except OSError:
+                pass
+        f.truncate(size)
+
+_running = {}  # download target -> downloads writing it now (either engine)
+_running_lock = threading.Lock()
+
+@contextmanager
+def running(filepath):
+    """Marks `filepath` as being downloaded for the duration of the with block"""
+    filepath = os.path.abspath(filepath)
+    with _running_lock:
+        _running[filepath] = _running.get(filepath, 0) + 1
+    try:
+        yield
+    finally:
+        with _running_lock:
+            _running[filepath] -= 1
+            if not _running[filepath]:
+                del _running[filepath]
+
+def is_running(filepath):
+    """True while a download is writing `filepath`"""
+    return os.path.abspath(filepath) in _running
+
+def state_path(filepath):
+    """Returns the sidecar resume-state path for a download target"""
+    return filepath + STATE_SUFFIX
+
+def discard(filepath):
+    """
+    Removes a partial download together with its resume state.
+    """
+    for p in (filepath, state_path(filepath)):
+        if os.path.exists(p):
+            os.remove(p)
+
+class SegmentState:
+    """
+    Thread-safe record of which byte ranges of a download are on disk.
+    It is persisted as JSON next to the partial file so that later attempts
+    can validate it (size, ETag, Last-Modified) and fetch only what's missing.
+    """
+    def __init__(self, filepath, url, size, etag=None, last_modified=None, done=()):
+        self.path = state_path(filepath)
+        self.url = url
+        self.size = size
+        self.etag = etag
+        self.last_modified = last_modified
+        self.done = merge_ranges(done)
+        self.active = {}  # segment start -> next byte to write
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()  # one writer of the state file at a time
+        self.last_flush = 0
+
+    @classmethod
+    def load(cls, filepath, info):
+        """
+        Loads the saved state for `filepath` if it still describes the remote
+        file in `info`, otherwise returns None.
+        """
+        path = state_path(filepath)
+        if not os.path.exists(path) or not os.path.exists(filepath):
+            return None
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                saved = json.load(f)
+        except (OSError, ValueError) as e:
+            log.warning(f"Ignoring unreadable state file {path}: {e}")
+            return None
+
+        stale = (
+            saved.get("size") != info["size"]
+            or os.path.getsize(filepath) != info["size"]
+            or (saved.get("etag") and info["etag"] and saved["etag"] != info["etag"])
+            or (saved.get("last_modified") and info["last_modified"]
+                and saved["last_modified"] != info["last_modified"])
+        )
+        if stale:
+            log.info(f"Remote file changed since last attempt, restarting {filepath}")
+            return None
+
+        return cls(filepath, info["url"], info["size"], saved.get("etag"),
+                   saved.get("last_modified"), [tuple(r) for r in saved.get("done", [])])
+
+    @property
+    def validator(self):
+        """The value to send in `If-Range`, preferring a strong ETag"""
+        if self.etag and not self.etag.startswith("W/"):
+            return self.etag
+        return self.last_modified
+
+    def ranges(self):
+        """Merged (start, end) ranges on disk, including partially finished segments"""
+        with self.lock:
+            ranges = self.done + [(s, p - 1) for s, p in self.active.items() if p > s]
+        return merge_ranges(ranges)
+
+    def completed(self):
+        """Total bytes on disk, including partially finished segments"""
+        return sum(end - start + 1 for start, end in self.ranges())
+
+    def flush_due(self):
+        """True once STATE_FLUSH_INTERVAL has passed since the last save"""
+        return time.time() - self.last_flush >= STATE_FLUSH_INTERVAL
+
+    def advance(self, seg_start, pos, save=True):
+        """
+        Records that bytes up to `pos` (exclusive) of a segment are written,
+        saving the state file when a flush is due. With save=False the
+        caller saves it (e.g. off the event loop; see `flush_due`).
+        """
+        with self.lock:
+            self.active[seg_start] = pos
+        if save and self.flush_due():
+            self.save()
+
+    def finish(self, seg_start, seg_end, save=True):
+        """Marks a whole segment as complete"""
+        with self.lock:
+            self.active.pop(seg_start, None)
+            self.done = merge_ranges(self.done + [(seg_start, seg_end)])
+        if save:
+            self.save()
+
+    def save(self):
+        """Atomically writes the state file"""
+        # `lock` is only held for the snapshot: `advance` runs on the event
+        # loop in the asyncio engine and must not wait for the disk
+        with self.save_lock:
+            data = {
+                "url": self.url,
+                "size": self.size,
+                "etag": self.etag,
+                "last_modified": self.last_modified,
+                "done": self.ranges(),
+            }
+            self.last_flush = time.time()
+            tmp = self.path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(data, f)
+            os.replace(tmp, self.path)
+
+    def remove(self):
+        """Deletes the state file once the download is complete"""
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+class _Progress:
+    """
+    Thread-safe byte counter shared by all segment workers.
+    """
+    def __init__(self, total, callback, done=0):
+        self.total = total
+        self.done = done
+        self.callback = callback
+        self.lock = threading.Lock()
+
+    def add(self, n):
+        with self.lock:
+            self.done += n
+            done = self.done
+        if self.callback:
+            self.callback(done, self.total)
+
+def _fetch_range(session, url, filepath, start, end, chunk_size, progress, should_cancel, state):
+    """
+    Downloads bytes [start, end] into the same offsets of `filepath`,
+    recording progress in `state`. `If-Range` makes the server answer with
+    the full body instead of 206 if the file changed, which we treat as stale.
+    """
+    headers = {"Range": f"bytes={start}-{end}"}
+    if state.validator:
+        headers["If-Range"] = state.validator
+    with session.get(url, headers=headers, stream=True, timeout=TIMEOUT) as r:
+        r.raise_for_status()
+        if r.status_code != 206:
+            raise ResourceChanged(f"Server did not return bytes {start}-{end} (HTTP {r.status_code})")
+        pos = start
+        with open(filepath, "r+b") as f:
+            f.seek(start)
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                if should_cancel and should_cancel():
+                    raise DownloadCancelled()
+                chunk = chunk[:end + 1 - pos]
+                f.write(chunk)
+                pos += len(chunk)
+                state.advance(start, pos)
+                progress.add(len(chunk))
+    if pos <= end:
+        raise Exception(f"Connection closed early at byte {pos} of segment {start}-{end}")
+    state.finish(start, end)
+
+def _fetch_stream(session, url, filepath, chunk_size, progress, should_cancel):
+    """
+    Single-connection fallback for servers that don't support ranges.
+    """
+    with session.get(url, stream=True, timeout=TIMEOUT) as r:
+        r.raise_for_status()
+        if not progress.total:
+            progress.total = int(r.headers.get("content-length", 0) or 0)
+        with open(filepath, "wb") as f:
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                if should_cancel and should_cancel():
+                    raise DownloadCancelled()
+                f.write(chunk)
+                progress.add(len(chunk))
+
+def download(url, filepath, segments=SEGMENTS, chunk_size=CHUNK_SIZE,
+             progress=None, should_cancel=None, retries=RETRIES):
+    """
+    Downloads `url` to `filepath`, retrying failed attempts. Every retry
+    resumes from the saved segment state, so only missing bytes are fetched
+    again. This is a blocking function and should be run in a thread.
+
+    :param retries: Number of attempts before the last error is raised.
+    :return: The total number of bytes on disk.
+    """
+    with running(filepath):
+        for attempt in range(1, retries + 1):
+            try:
+                return _download_once(url, filepath, segments, chunk_size, progress, should_cancel)
+            except DownloadCancelled:
+                raise
+            except Exception as e:
+                if attempt >= retries:
+                    raise
+                log.warning(f"Download attempt {attempt}/{retries} for {url} failed: {e}. Resuming...")
+                time.sleep(min(2 ** attempt, 30))
+
+def _download_once(url, filepath, segments, chunk_size, progress, should_cancel):
+    """
+    A single download attempt, using `segments` parallel ranged connections
+    when the server supports it. If a valid resume state exists for
+    `filepath`, only the missing ranges are fetched.
+
+    :param progress: Optional callable(downloaded, total), called from worker threads.
+    :param should_cancel: Optional callable returning True to abort the download.
+    :return: The total number of bytes on disk.
+    """
+    with new_session(max(1, segments)) as session:
+        info = probe(url, session)
+
+        if not info["ranges"] or info["size"] <= 0:
+            log.info(f"Single-stream download for {url}")
+            discard(filepath)
+            tracker = _Progress(info["size"], progress)
+            _fetch_stream(session, info["url"], filepath, chunk_size, tracker, should_cancel)
+            return tracker.done
+
+        state = SegmentState.load(filepath, info)
+        if state is None:
+            preallocate(filepath, info["size"])
+            state = SegmentState(filepath, info["url"], info["size"], info["etag"], info["last_modified"])
+            state.save()
+        else:
+            log.info(f"Resuming {filepath}: {state.completed()} of {info['size']} bytes already on disk")
+
+        ranges = plan_segments(info["size"], segments, state.done)
+        tracker = _Progress(info["size"], progress, done=state.completed())
+        log.info(f"Segmented download for {url}: {len(ranges)} ranges, {info['size']} bytes")
+
+        # A failing segment sets `stop` so its siblings bail out at their next chunk
+        stop = threading.Event()
+        def cancelled():
+            return stop.is_set() or bool(should_cancel and should_cancel())
+
+        with ThreadPoolExecutor(max_workers=max(1, len(ranges)), thread_name_prefix="segment") as pool:
+            futures = [
+                pool.submit(_fetch_range, session, info["url"], filepath, start, end,
+                            chunk_size, tracker, cancelled, state)
+                for start, end in ranges
+            ]
+            done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+            failed = [fut for fut in done if fut.exception()]
+            if failed:
+                stop.set()
+                wait(futures)
+                error = failed[0].exception()
+                if isinstance(error, ResourceChanged):
+                    discard(filepath)
+                else:
+                    state.save()
+                raise error
+
+        state.remove()
+        return tracker.done
@@ -0,0 +1,121 @@
+#
+# This module caches yt-dlp extraction results. /ytdl extracts a URL once
+# to list its formats; the download that follows (and any other user asking
+# for the same URL) reuses that info-dict through process_ie_result instead
+# of running the slow page/API extraction again.
+#
+# Entries are keyed by the normalized URL and the identity of the cookie
+# file used, live until shortly before the earliest format URL expires
+# (capped at YTDL_INFO_TTL), and are evicted LRU beyond
+# YTDL_INFO_CACHE_ENTRIES. The cache is used from worker threads.
+#
+
+import os
+import re
+import copy
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from urllib.parse import urlparse, parse_qs
+
+from .file_cache import normalize_url
+
+log = logging.getLogger("info_cache")
+
+# ---------------- Tunables (overridable from the environment) ----------------
+TTL = int(os.environ.get("YTDL_INFO_TTL", "1800"))  # seconds
+MAX_ENTRIES = int(os.environ.get("YTDL_INFO_CACHE_ENTRIES", "64"))
+EXPIRY_MARGIN = 120  # seconds before a format URL expires to stop using it
+
+# Expiry timestamps in signed media URLs (YouTube, CloudFront, Akamai...)
+_EXPIRY_PARAMS = ("expire", "expires", "Expires", "exp")
+_EXPIRY_PATH = re.compile(r"/expire/(\d{9,})")
+
+_entries = OrderedDict()  # key -> (expires_at, info)
+_lock = threading.Lock()
+
+def cookie_identity(cookies):
+    """
+    Short fingerprint of a cookie file's contents, or None without cookies.
+    Users with identical (or no) cookies share entries.
+    """
+    if not cookies or not os.path.exists(cookies):
+        return None
+    with open(cookies, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()[:16]
+
+def _key(url, cookies):
+    return (normalize_url(url), cookie_identity(cookies))
+
+def url_expiry(url):
+    """Unix time at which a signed media URL stops working, or None"""
+    if not url:
+        return None
+    parsed = urlparse(url)
+    query = parse_qs(parsed.query)
+    for name in _EXPIRY_PARAMS:
+        value = query.get(name, [""])[0]
+        if value.isdigit():
+            return int(value)
+    match = _EXPIRY_PATH.search(parsed.path)
+    return int(match.group(1)) if match else None
+
+def info_expiry(info):
+    """When `info` must be thrown away: the earliest format URL expiry, capped by TTL"""
+    expires_at = time.time() + TTL
+    for f in info.get("formats") or ():
+        expiry = url_expiry(f.get("url")) or url_expiry(f.get("manifest_url"))
+        if expiry:
+            expires_at = min(expires_at, expiry - EXPIRY_MARGIN)
+    return expires_at
+
+def get(url, cookies=None):
+    """A private copy of the cached info-dict for `url`, or None"""
+    key = _key(url, cookies)
+    with _lock:
+        entry = _entries.get(key)
+        if entry is None:
+            return None
+        expires_at, info = entry
+        if expires_at <= time.time():
+            _entries.pop(key)
+            return None
+        _entries.move_to_end(key)
+    # process_ie_result mutates the dict it is given
+    return copy.deepcopy(info)
+
+def put(url, cookies, info):
+    """
+    Caches a sanitized info-dict (YoutubeDL.sanitize_info with private keys
+    removed), unless its format URLs are about to expire anyway.
+    """
+    expires_at = info_expiry(info)
+    if expires_at <= time.time():
+        return
+    with _lock:
+        _entries[_key(url, cookies)] = (expires_at, info)
+        _entries.move_to_end(_key(url, cookies))
+        while len(_entries) > MAX_ENTRIES:
+            _entries.popitem(last=False)
+
+def invalidate(url, cookies=None):
+    """Drops the entry for `url`, e.g. after its format URLs stopped working"""
+    with _lock:
+        _entries.pop(_key(url, cookies), None)
+
+def extract(ydl, url, cookies=None):
+    """
+    extract_info(url, download=False) through the cache.
+
+    :return: A sanitized info-dict, safe to keep and to hand to
+             process_ie_result later.
+    """
+    info = get(url, cookies)
+    if info is not None:
+        log.info(f"Info cache hit for {url}")
+        return info
+    info = ydl.sanitize_info(ydl.extract_info(url, download=False), remove_private_keys=True)
+    put(url, cookies, info)
+    return copy.deepcopy(info)
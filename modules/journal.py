@@ -0,0 +1,278 @@
+#
+# This module keeps a journal of running jobs in MongoDB (`jobs`
+# collection), so a restart of the bot doesn't lose them. Every /leech,
+# /ytdl, /ytpl and /drive job that starts working is recorded with its
+# source, options (e.g. the chosen format), state transitions, the byte
+# ranges of the source already downloaded and the parts or files already
+# delivered to the chat.
+#
+#   - writes are write-behind: updates are merged in memory and written in
+#     one bulk_write every JOURNAL_FLUSH_INTERVAL seconds; a state change
+#     wakes the writer early, progress never does,
+#   - on startup `recover` re-queues every job left unfinished, through the
+#     resume function its module registered with `resumer`, under the same
+#     task id and status message; delivered parts are skipped,
+#   - a job is given up after JOURNAL_MAX_RESUMES restarts, or if it was
+#     last updated more than JOURNAL_MAX_AGE_HOURS ago,
+#   - finished jobs expire from the collection after JOURNAL_KEEP_DAYS.
+#
+# Without MONGO_URI the journal only lives in memory, which still lets
+# jobs skip parts they delivered before a retry within the same run.
+#
+
+import os
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from pymongo import UpdateOne
+
+from .utils import async_db
+from .http_downloader import merge_ranges
+
+log = logging.getLogger("journal")
+
+# ---------------- Tunables (overridable from the environment) ----------------
+FLUSH_INTERVAL = float(os.environ.get("JOURNAL_FLUSH_INTERVAL", "5"))  # seconds
+MAX_RESUMES = int(os.environ.get("JOURNAL_MAX_RESUMES", "3"))
+MAX_AGE_HOURS = float(os.environ.get("JOURNAL_MAX_AGE_HOURS", "24"))
+KEEP_DAYS = int(os.environ.get("JOURNAL_KEEP_DAYS", "7"))
+
+# task.data values that are journaled (e.g. no_cache, engine, format);
+# the rest, like ytdl's per-button size table, is rebuilt on resume
+_DATA_TYPES = (str, int, float, bool, type(None))
+
+_records = {}   # tid -> in-memory record of a tracked, unfinished task
+_pending = {}   # tid -> {"set": {...}, "push": [...]} not written yet
+_resumers = {}  # kind -> coroutine function resume(app, task, msg)
+_wake = None
+_writer = None
+_closing = False
+
+def _now():
+    return datetime.now(timezone.utc)
+
+def resumer(kind):
+    """
+    Decorator registering the coroutine function that restarts a journaled
+    job of `kind` after a restart. It is called as resume(app, task, msg)
+    with the restored tasks.Task and its status message.
+    """
+    def register(func):
+        _resumers[kind] = func
+        return func
+    return register
+
+def _write(tid, transition=None, **fields):
+    """Queues `fields` (and a state transition) for the next flush"""
+    if async_db() is None:
+        return
+    pending = _pending.setdefault(tid, {"set": {}, "push": []})
+    pending["set"].update(fields)
+    if transition:
+        pending["push"].append({"state": transition, "at": _now()})
+        if _wake is not None:
+            _wake.set()
+
+def _start_writer():
+    global _wake, _writer
+    if async_db() is None or (_writer is not None and not _writer.done()):
+        return
+    _wake = asyncio.Event()
+    _writer = asyncio.create_task(_run_writer())
+
+async def _run_writer():
+    while True:
+        try:
+            await asyncio.wait_for(_wake.wait(), FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _wake.clear()
+        await flush()
+
+async def flush():
+    """Writes all queued updates in one batch. Failed batches are retried on the next flush."""
+    db = async_db()
+    if db is None or not _pending:
+        return
+    batch = dict(_pending)
+    _pending.clear()
+    now = _now()
+    ops = []
+    for tid, pending in batch.items():
+        update = {"$set": {**pending["set"], "updated_at": now}}
+        if pending["push"]:
+            update["$push"] = {"transitions": {"$each": pending["push"]}}
+        ops.append(UpdateOne({"_id": tid}, update, upsert=True))
+    try:
+        await db.jobs.bulk_write(ops, ordered=False)
+    except Exception as e:
+        log.warning(f"Job journal write of {len(ops)} jobs failed, retrying later: {e}")
+        # Put the batch back under anything queued meanwhile
+        for tid, pending in batch.items():
+            newer = _pending.get(tid, {"set": {}, "push": []})
+            _pending[tid] = {"set": {**pending["set"], **newer["set"]}, "push": pending["push"] + newer["push"]}
+
+def track(task):
+    """
+    Starts journaling `task`, once it is about to do work. Calling it again
+    (e.g. for a resumed task) only records its current status message.
+    """
+    record = _records.get(task.tid)
+    if record is not None:
+        _write(task.tid, msg_id=task.msg_id)
+        return
+    _records[task.tid] = {"state": "queued", "size": None, "parts": {}, "ranges": []}
+    _write(
+        task.tid, "queued",
+        kind=task.kind, user_id=task.user_id, chat_id=task.chat_id, msg_id=task.msg_id, url=task.url,
+        data={k: v for k, v in task.data.items() if isinstance(v, _DATA_TYPES)},
+        state="queued", closed=False, resumes=0, size=None, parts=[], ranges=[], created_at=_now(),
+    )
+    _start_writer()
+
+def state(task, new_state):
+    """Records a state transition, e.g. "downloading", "uploading" or "done"."""
+    record = _records.get(task.tid)
+    if record is None or record["state"] == new_state:
+        return
+    record["state"] = new_state
+    _write(task.tid, new_state, state=new_state)
+
+def ranges(task, done):
+    """
+    Records byte ranges of the source that are on disk: an
+    aio_downloader `on_ranges` callback. Ranges only grow.
+    """
+    record = _records.get(task.tid)
+    if record is None:
+        return
+    record["ranges"] = merge_ranges(record["ranges"] + list(done))
+    _write(task.tid, ranges=[list(r) for r in record["ranges"]])
+
+def parts(task, size=None):
+    """
+    The parts already delivered for `task`, as {key: file entries}.
+
+    :param size: Size of the file the parts are cut from. If it differs from
+                 the one they were delivered from (the source changed), they
+                 are forgotten and `size` is recorded instead.
+    """
+    record = _records.get(task.tid)
+    if record is None:
+        return {}
+    if size is not None and record["size"] != size:
+        if record["parts"]:
+            log.info(f"Source of task {task.tid} changed size, delivering all parts again")
+        record["size"] = size
+        record["parts"] = {}
+        _write(task.tid, size=size, parts=[])
+    return dict(record["parts"])
+
+def entries(task, count):
+    """The file entries of delivered parts 1..count, in part order"""
+    done = parts(task)
+    return [entry for idx in range(1, count + 1) for entry in done.get(str(idx)) or ()]
+
+def delivered(task, key, files=None):
+    """Records that part `key` (a part number, Drive file id...) reached the chat as `files`"""
+    record = _records.get(task.tid)
+    if record is None:
+        return
+    record["parts"][str(key)] = files
+    # A list of pairs: keys may be URLs, which MongoDB field names can't hold
+    _write(task.tid, parts=[[k, v] for k, v in record["parts"].items()])
+
+def close(task):
+    """
+    Marks a task finished ("done", "cancelled" or "failed") so it is not
+    resumed. Called by tasks.remove; ignored while the bot shuts down.
+    """
+    if _closing:
+        return
+    record = _records.pop(task.tid, None)
+    if record is None:
+        return
+    final = "cancelled" if task.is_cancelled() else "done" if record["state"] == "done" else "failed"
+    now = _now()
+    _write(task.tid, final if final != record["state"] else None, state=final, closed=True,
+           finished_at=now, expires_at=now + timedelta(days=KEEP_DAYS))
+
+async def _status_message(app, doc):
+    """The job's status message, or a new one if it can't be found"""
+    text = f"♻️ The bot restarted, resuming your `{doc['kind']}` job…\n`{doc['url']}`"
+    if doc.get("msg_id"):
+        try:
+            msg = await app.get_messages(doc["chat_id"], doc["msg_id"])
+            if msg and not msg.empty:
+                return await msg.edit_text(text)
+        except Exception as e:
+            log.info(f"Status message of job {doc['_id']} is gone ({e}), sending a new one")
+    return await app.send_message(doc["chat_id"], text)
+
+async def recover(app):
+    """
+    Re-queues the jobs a previous run left unfinished. Call it once the
+    client is connected and the handlers are registered.
+
+    :return: How many jobs were resumed.
+    """
+    from . import tasks
+
+    db = async_db()
+    if db is None:
+        return 0
+    _start_writer()
+    await db.jobs.create_index("closed")
+    await db.jobs.create_index("expires_at", expireAfterSeconds=0)
+
+    now = _now()
+    expired = await db.jobs.update_many(
+        {"closed": False, "updated_at": {"$lt": now - timedelta(hours=MAX_AGE_HOURS)}},
+        {"$set": {"state": "expired", "closed": True, "finished_at": now,
+                  "expires_at": now + timedelta(days=KEEP_DAYS)}},
+    )
+    if expired.modified_count:
+        log.info(f"Gave up {expired.modified_count} journaled jobs older than {MAX_AGE_HOURS}h")
+
+    resumed = 0
+    async for doc in db.jobs.find({"closed": False}).sort("created_at", 1):
+        tid = doc["_id"]
+        resume = _resumers.get(doc["kind"])
+        if resume is None or doc.get("resumes", 0) >= MAX_RESUMES:
+            reason = "no resume support" if resume is None else "too many restarts"
+            log.warning(f"Not resuming {doc['kind']} job {tid} ({reason})")
+            _write(tid, "abandoned", state="abandoned", closed=True, finished_at=now,
+                   expires_at=now + timedelta(days=KEEP_DAYS))
+            continue
+        task = tasks.register(doc["kind"], doc["user_id"], doc["chat_id"], doc["url"], tid=tid, **doc.get("data", {}))
+        _records[tid] = {
+            "state": "queued",
+            "size": doc.get("size"),
+            "parts": {k: v for k, v in doc.get("parts", [])},
+            "ranges": [tuple(r) for r in doc.get("ranges", [])],
+        }
+        _write(tid, "resumed", state="queued", resumes=doc.get("resumes", 0) + 1)
+        try:
+            msg = await _status_message(app, doc)
+            task.msg_id = msg.id
+            track(task)
+            await resume(app, task, msg)
+            resumed += 1
+        except Exception as e:
+            log.error(f"Could not resume {doc['kind']} job {tid}: {e}", exc_info=True)
+            tasks.remove(task)
+    if resumed:
+        log.info(f"Resumed {resumed} journaled jobs")
+    await flush()
+    return resumed
+
+async def shutdown():
+    """
+    Writes what's queued and stops journaling, so jobs interrupted by the
+    shutdown stay unfinished in the journal and are resumed on the next start.
+    """
+    global _closing
+    _closing = True
+    if _writer is not None:
+        _writer.cancel()
+    await flush()
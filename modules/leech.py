@@ -4,18 +4,28 @@
 #
 
 import os
-import uuid
 import logging
 import asyncio
 import time
 import requests
+import aiohttp
 from pyrogram import Client, filters
 from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton, Message
 
 from .utils import data_paths, ensure_dirs, humanbytes, DownloadCancelled, safe_edit_text
+from . import http_downloader, aio_downloader
+from .pipeline import run_pipeline
+from . import file_cache, singleflight
+from .scheduler import scheduler, queue_text, priority_for
+from . import staging, tasks, journal
 
 log = logging.getLogger("leech")
-ACTIVE_TASKS = {}
+
+# "aiohttp" (default) runs transfers on the event loop, "threads" uses requests
+ENGINE = os.environ.get("LEECH_ENGINE", "aiohttp")
+
+# ---------------- Telegram-safe split size ----------------
+MAX_SIZE = 1900 * 1024 * 1024 # 1900 MiB ≈ 1.86 GiB
 
 def cancel_btn(tid):
     """
@@ -39,84 +49,37 @@ def register_leech_handlers(app: Client):
         if len(args) < 2:
             return await m.reply("Usage: `/leech <direct file URL>`")
 
-        url = args[1].strip()
+        url, no_cache = file_cache.split_bypass_flag(args[1])
+        if not url:
+            return await m.reply("Usage: `/leech <direct file URL>`")
         user_id = m.from_user.id
-        paths = data_paths(user_id)
         ensure_dirs()
-        tid = str(uuid.uuid4())[:8]
-        
-        ACTIVE_TASKS[tid] = {"user_id": user_id, "url": url, "msg_id": None, "cancel": False}
-
-        msg = await m.reply("⏳ Starting direct file download...", reply_markup=cancel_btn(tid))
-        ACTIVE_TASKS[tid]["msg_id"] = msg.id
-
-        async def runner():
-            """
-            This asynchronous function handles the full download and upload process
-            to avoid blocking the main event loop.
-            """
-            try:
-                # Get the current event loop for use in the thread.
-                loop = asyncio.get_event_loop()
-                
-                # Use asyncio.to_thread to run the blocking requests call in a separate thread.
-                await asyncio.to_thread(download_file, loop, url, paths["downloads"], tid, msg)
-
-                # After download, find the file and upload
-                filename = os.path.basename(url)
-                download_path = os.path.join(paths["downloads"], filename)
-
-                if not os.path.exists(download_path):
-                    await safe_edit_text(msg, "❌ Download failed. File not found.")
-                    return
 
-                await safe_edit_text(msg, f"✅ Download complete. Uploading `{filename}`...")
-                
-                last_upload_update_time = time.time()
-                
-                async def upload_progress(cur, tot):
-                    """
-                    This callback function updates the message with upload progress,
-                    but is now throttled to prevent API timeouts.
-                    """
-                    nonlocal last_upload_update_time
-                    
-                    now = time.time()
-                    if (now - last_upload_update_time) < 3:
-                        return
-                    
-                    last_upload_update_time = now
-                    
-                    frac = cur / tot * 100 if tot else 0
-                    bar = "█" * int(frac // 5) + "░" * (20 - int(frac // 5))
-                    await safe_edit_text(
-                        msg, 
-                        f"**Uploading...**\n`{filename}`\n{bar} **{frac:.1f}%**\n⬆ {humanbytes(cur)}/{humanbytes(tot)}", 
-                        reply_markup=cancel_btn(tid)
-                    )
-                    
-                    # Check for cancellation
-                    if ACTIVE_TASKS.get(tid, {}).get("cancel"):
-                        raise DownloadCancelled()
-
-                await app.send_document(m.chat.id, download_path, progress=upload_progress)
-                await safe_edit_text(msg, f"✅ Uploaded `{filename}` successfully!")
-                os.remove(download_path) # Clean up the file after upload
-
-            except DownloadCancelled:
-                await safe_edit_text(msg, "❌ Download/Upload cancelled.")
-                filename = os.path.basename(url)
-                download_path = os.path.join(paths["downloads"], filename)
-                if os.path.exists(download_path):
-                    os.remove(download_path)
-            except Exception as e:
-                # Use safe_edit_text to handle errors and avoid crashing
-                await safe_edit_text(msg, f"❌ Error: {e}")
-            finally:
-                if tid in ACTIVE_TASKS:
-                    ACTIVE_TASKS.pop(tid)
-        
-        asyncio.create_task(runner())
+        # Links leeched before are resent by file_id, skipping the transfer
+        key = file_cache.cache_key("leech", url)
+        if not no_cache and await file_cache.send_cached(app, m.chat.id, key):
+            return
+
+        # The same link already downloading for someone else: share it.
+        # Otherwise claim it before the first await, so an identical
+        # request arriving meanwhile follows this one.
+        flight = singleflight.find(key)
+        if flight:
+            msg = await m.reply("🔗 Attaching to a running download…")
+            asyncio.create_task(singleflight.follow(app, flight, m.chat.id, msg))
+            return
+        flight = singleflight.lead(key)
+
+        task = tasks.register("leech", user_id, m.chat.id, url)
+        try:
+            msg = await m.reply("⏳ Starting direct file download...", reply_markup=cancel_btn(task.tid))
+        except BaseException as e:
+            singleflight.release(flight, e)
+            tasks.remove(task)
+            raise
+        task.msg_id = msg.id
+        flight.report_in(msg)
+        await start_leech(app, task, msg, flight)
 
     @app.on_callback_query(filters.regex(r"^cancel:(.+)$"))
     async def cancel_leech_cb(_, q):
@@ -124,52 +87,292 @@ def register_leech_handlers(app: Client):
         Handles the "Cancel" button click.
         """
         tid = q.data.split(":")[1]
-        if tid in ACTIVE_TASKS:
-            ACTIVE_TASKS[tid]["cancel"] = True
+        task = tasks.get(tid, "leech")
+        if task and task.user_id == q.from_user.id:
+            task.cancel()
             await q.answer("⛔ Task cancelled.", show_alert=True)
+        elif task:
+            await q.answer("❌ Only the user who started this task can cancel it.", show_alert=True)
         else:
             await q.answer("❌ Task not found.", show_alert=True)
 
-def download_file(loop, url, path, tid, msg):
+@journal.resumer("leech")
+async def start_leech(app, task, msg, flight=None):
     """
-    Downloads a file from a URL using requests. This function is designed to run
-    in a separate thread to avoid blocking the event loop.
+    Downloads and uploads the file of a /leech task, reporting into `msg`.
+    Also resumes leech jobs left unfinished by a restart.
+
+    :param flight: The singleflight.Flight the caller leads for this link.
+                   Without one (a resumed job) the task leads a new flight,
+                   or follows the one already running for the link.
     """
+    url = task.url
+    user_id = task.user_id
+    chat_id = task.chat_id
+    tid = task.tid
+    paths = data_paths(user_id)
+    key = file_cache.cache_key("leech", url)
+    journal.track(task)
+    if flight is None:
+        running = singleflight.find(key)
+        if running:
+            task.bind(asyncio.create_task(singleflight.follow_task(app, running, task, msg)))
+            return
+        flight = singleflight.lead(key, msg)
+
+    async def runner():
+        """
+        This asynchronous function handles the full download and upload process
+        to avoid blocking the main event loop.
+        """
+        failure = None
+        reservation = None
+
+        async def work(info):
+            # Files above the Telegram limit are fetched part by part, and
+            # each part is uploaded while the next one downloads.
+            if ENGINE != "threads" and info["ranges"] and info["size"] > MAX_SIZE:
+                sent = await pipelined_leech(app, chat_id, url, info, paths["downloads"], task, msg)
+                await file_cache.put(key, sent, info["size"])
+                flight.resolve(sent)
+                journal.state(task, "done")
+                return
+
+            async with scheduler.download_slot():
+                await download_file(url, paths["downloads"], task, msg)
+
+            # After download, find the file and upload
+            filename = os.path.basename(url)
+            download_path = os.path.join(paths["downloads"], filename)
+
+            if not os.path.exists(download_path):
+                await safe_edit_text(msg, "❌ Download failed. File not found.")
+                return
+
+            await safe_edit_text(msg, f"✅ Download complete. Uploading `{filename}`...")
+            journal.state(task, "uploading")
+
+            last_upload_update_time = time.time()
+
+            async def upload_progress(cur, tot):
+                """
+                This callback function updates the message with upload progress,
+                but is now throttled to prevent API timeouts.
+                """
+                nonlocal last_upload_update_time
+
+                now = time.time()
+                if (now - last_upload_update_time) < 3:
+                    return
+
+                last_upload_update_time = now
+
+                frac = cur / tot * 100 if tot else 0
+                bar = "█" * int(frac // 5) + "░" * (20 - int(frac // 5))
+                await safe_edit_text(
+                    msg, 
+                    f"**Uploading...**\n`{filename}`\n{bar} **{frac:.1f}%**\n⬆ {humanbytes(cur)}/{humanbytes(tot)}", 
+                    reply_markup=cancel_btn(tid)
+                )
+
+                # Check for cancellation
+                if task.is_cancelled():
+                    raise DownloadCancelled()
+
+            filesize = os.path.getsize(download_path)
+            async with scheduler.upload_slot():
+                sent = await app.send_document(chat_id, download_path, progress=upload_progress)
+            await safe_edit_text(msg, f"✅ Uploaded `{filename}` successfully!")
+            await file_cache.put(key, [file_cache.file_entry(sent)], filesize)
+            flight.resolve([file_cache.file_entry(sent)])
+            journal.state(task, "done")
+            os.remove(download_path) # Clean up the file after upload
+
+        async def show_position(position):
+            await safe_edit_text(msg, queue_text(position), reply_markup=cancel_btn(tid))
+
+        try:
+            # The probe gives the scheduler a size hint for queue ordering
+            info = await aio_downloader.probe(url)
+            async with scheduler.job(user_id, size=info["size"], priority=priority_for(info["size"]),
+                                     on_position=show_position,
+                                     should_cancel=task.is_cancelled):
+                # A pipelined transfer keeps at most two parts on disk
+                expected = info["size"]
+                if ENGINE != "threads" and info["ranges"] and expected > MAX_SIZE:
+                    expected = 2 * MAX_SIZE
+                reservation = await staging.reserve(
+                    user_id, expected,
+                    on_wait=lambda reason: safe_edit_text(msg, staging.wait_text(reason), reply_markup=cancel_btn(tid)),
+                    should_cancel=task.is_cancelled,
+                )
+                journal.state(task, "downloading")
+                await work(info)
+
+        except (DownloadCancelled, asyncio.CancelledError):
+            failure = Exception("The download was cancelled.")
+            await safe_edit_text(msg, "❌ Download/Upload cancelled.")
+            filename = os.path.basename(url)
+            download_path = os.path.join(paths["downloads"], filename)
+            # Drop the partial file and its resume state
+            http_downloader.discard(download_path)
+        except staging.StagingFull as e:
+            failure = e
+            await safe_edit_text(msg, f"❌ Not enough disk space: {e}")
+        except Exception as e:
+            failure = e
+            # Use safe_edit_text to handle errors and avoid crashing
+            await safe_edit_text(msg, f"❌ Error: {e}")
+        finally:
+            singleflight.release(flight, failure)
+            staging.release(reservation)
+            tasks.remove(task)
+
+    task.bind(asyncio.create_task(runner()))
+
+async def download_file(url, path, task, msg):
+    """
+    Downloads a file from a URL with the segmented HTTP engine. By default
+    this runs natively on the event loop over the shared aiohttp session;
+    LEECH_ENGINE=threads selects the requests-based engine in a thread.
+    """
+    filename = os.path.basename(url)
+    filepath = os.path.join(path, filename)
+    
+    last_download_update_time = time.time()
+
+    if not url.startswith(("http://", "https://")):
+        raise ValueError("URL is not valid")
+
+    loop = asyncio.get_running_loop()
+
+    def progress(downloaded, total_size):
+        """
+        Called after every chunk, from the event loop or a segment thread.
+        """
+        nonlocal last_download_update_time
+        now = time.time()
+        if (now - last_download_update_time) <= 3:
+            return
+        last_download_update_time = now
+        pct = (downloaded / total_size) * 100 if total_size > 0 else 0
+        bar = "█" * int(pct // 5) + "░" * (20 - int(pct // 5))
+        # Use call_soon_threadsafe so this works from either engine
+        loop.call_soon_threadsafe(
+            asyncio.create_task,
+            safe_edit_text(
+                msg, 
+                f"**Downloading...**\n`{filename}`\n{bar} **{pct:.1f}%**\n⬇ {humanbytes(downloaded)}/{humanbytes(total_size)}", 
+                reply_markup=cancel_btn(task.tid)
+            )
+        )
+
     try:
-        filename = os.path.basename(url)
-        filepath = os.path.join(path, filename)
-        
-        last_download_update_time = time.time()
-
-        if not url.startswith(("http://", "https://")):
-            raise ValueError("URL is not valid")
-
-        with requests.get(url, stream=True) as r:
-            r.raise_for_status()
-            total_size = int(r.headers.get("content-length", 0))
-            downloaded = 0
-            
-            with open(filepath, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=8192):
-                    if ACTIVE_TASKS.get(tid, {}).get("cancel"):
-                        raise DownloadCancelled()
-                    
-                    f.write(chunk)
-                    downloaded += len(chunk)
-                    
-                    now = time.time()
-                    if (now - last_download_update_time) > 3:
-                        last_download_update_time = now
-                        pct = (downloaded / total_size) * 100 if total_size > 0 else 0
-                        bar = "█" * int(pct // 5) + "░" * (20 - int(pct // 5))
-                        # Use call_soon_threadsafe to schedule the coroutine in the main event loop
-                        loop.call_soon_threadsafe(
-                            asyncio.create_task,
-                            safe_edit_text(
-                                msg, 
-                                f"**Downloading...**\n`{filename}`\n{bar} **{pct:.1f}%**\n⬇ {humanbytes(downloaded)}/{humanbytes(total_size)}", 
-                                reply_markup=cancel_btn(tid)
-                            )
-                        )
-    except requests.exceptions.RequestException as e:
+        if ENGINE == "threads":
+            # Segment threads watch the token after every chunk
+            await tasks.to_thread(
+                task, http_downloader.download, url, filepath,
+                progress=progress, should_cancel=task.is_cancelled,
+            )
+        else:
+            await aio_downloader.download(url, filepath, progress=progress, should_cancel=task.is_cancelled,
+                                          on_ranges=lambda done: journal.ranges(task, done))
+    except (requests.exceptions.RequestException, aiohttp.ClientError) as e:
         raise Exception(f"Failed to download file: {e}")
+
+def part_paths(filepath, count):
+    """
+    Returns the part file names for `filepath`, matching split_file's naming.
+    """
+    base_name, ext = os.path.splitext(filepath)
+    return [f"{base_name}_part{idx}{ext}" for idx in range(1, count + 1)]
+
+async def pipelined_leech(app, chat_id, url, info, path, task, msg):
+    """
+    Downloads a file larger than MAX_SIZE as a sequence of ranged parts and
+    uploads each part while the next one is still downloading, so wall time
+    is closer to max(download, upload) and only about two parts are on disk.
+    Parts the journal lists as delivered (before a restart) are skipped.
+
+    :return: The file_cache entries of the uploaded parts, in order.
+    """
+    filename = os.path.basename(url)
+    size = info["size"]
+    total_parts = -(-size // MAX_SIZE)  # ceil division
+    fpaths = part_paths(os.path.join(path, filename), total_parts)
+    tid = task.tid
+    should_cancel = task.is_cancelled
+
+    # Both directions report into one status message
+    status = {"down": "", "up": ""}
+    delivered = journal.parts(task, size)
+    if delivered:
+        status["up"] = f"♻️ {len(delivered)} parts already delivered"
+    last_update = 0
+
+    async def render(force=False):
+        nonlocal last_update
+        now = time.time()
+        if not force and now - last_update < 3:
+            return
+        last_update = now
+        text = f"**Pipelined transfer** `{filename}` ({humanbytes(size)}, {total_parts} parts)\n"
+        text += "\n".join(line for line in (status["down"], status["up"]) if line)
+        await safe_edit_text(msg, text, reply_markup=cancel_btn(tid))
+
+    def bar(cur, tot):
+        pct = cur / tot * 100 if tot else 0
+        return "█" * int(pct // 5) + "░" * (20 - int(pct // 5)) + f" **{pct:.1f}%**"
+
+    async def produce():
+        for idx, fpath in enumerate(fpaths, 1):
+            if str(idx) in delivered:
+                continue
+            start = (idx - 1) * MAX_SIZE
+            end = min(start + MAX_SIZE, size) - 1
+
+            def progress(cur, tot, idx=idx):
+                status["down"] = f"⬇ Part {idx}/{total_parts}: {bar(cur, tot)} {humanbytes(cur)}/{humanbytes(tot)}"
+                if time.time() - last_update >= 3:
+                    asyncio.create_task(render())
+
+            async with scheduler.download_slot():
+                await aio_downloader.download(
+                    url, fpath, progress=progress, should_cancel=should_cancel,
+                    window=(start, end), info=info if idx == 1 else None,
+                    on_ranges=lambda done: journal.ranges(task, done),
+                )
+            status["down"] = f"✅ Part {idx}/{total_parts} downloaded"
+            yield fpath
+
+    async def upload(_, fpath):
+        # Numbered by file, not by upload order: delivered parts are skipped
+        idx = fpaths.index(fpath) + 1
+
+        async def upload_progress(cur, tot):
+            if should_cancel():
+                raise DownloadCancelled()
+            status["up"] = f"⬆ Part {idx}/{total_parts}: {bar(cur, tot)} {humanbytes(cur)}/{humanbytes(tot)}"
+            await render()
+
+        async with scheduler.upload_slot():
+            message = await app.send_document(
+                chat_id,
+                fpath,
+                caption=f"✅ Uploaded part {idx}/{total_parts}: `{os.path.basename(fpath)}`",
+                progress=upload_progress,
+            )
+        journal.delivered(task, idx, [file_cache.file_entry(message)])
+        status["up"] = f"✅ Part {idx}/{total_parts} uploaded"
+        await render(force=True)
+
+    try:
+        await run_pipeline(produce(), upload)
+    except BaseException:
+        # Whatever ended the transfer, drop any part still on disk with its
+        # resume state: a failed job is not resumed, so nothing reuses them
+        for fpath in fpaths:
+            http_downloader.discard(fpath)
+        raise
+    await safe_edit_text(msg, f"✅ Uploaded `{filename}` in {total_parts} parts successfully!")
+    return journal.entries(task, total_parts)
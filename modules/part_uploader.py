@@ -0,0 +1,191 @@
+#
+# This module uploads the parts of a split file concurrently. Up to
+# UPLOAD_PARALLEL_PARTS parts are saved to Telegram at once (save_file,
+# one media session each), and the finished uploads are then posted to the
+# chat strictly in part order with messages.SendMedia, so the chat still
+# reads part 1, 2, 3... Every part keeps the usual 3 attempts, and progress
+# is reported for all parts together (aggregate speed and ETA).
+#
+
+import os
+import time
+import asyncio
+import logging
+from pyrogram import raw, types, utils as pyrogram_utils, StopTransmission
+from pyrogram.errors import FloodWait, FilePartMissing
+
+from .utils import DownloadCancelled, humanbytes
+
+log = logging.getLogger("part_uploader")
+
+# ---------------- Tunables (overridable from the environment) ----------------
+PARALLEL_PARTS = int(os.environ.get("UPLOAD_PARALLEL_PARTS", "3"))
+RETRIES = 3
+RETRY_DELAY = 5  # seconds
+
+class _Progress:
+    """
+    Sums the progress of all parts and works out speed and ETA.
+    """
+    def __init__(self, total, callback):
+        self.total = total
+        self.callback = callback
+        self.per_part = {}
+        self.active = set()  # parts whose bytes are moving
+        self.peak = 0
+        self.start = time.time()
+
+    async def update(self, idx, current):
+        self.per_part[idx] = current
+        if not self.callback:
+            return
+        done = sum(self.per_part.values())
+        elapsed = time.time() - self.start
+        speed = done / elapsed if elapsed > 0 else 0
+        eta = (self.total - done) / speed if speed > 0 else None
+        await self.callback(done, self.total, speed, eta, len(self.active))
+
+def progress_text(done, total, speed, eta, in_flight, total_parts):
+    """Combined status text for a multi-part upload"""
+    pct = done / total * 100 if total else 0
+    bar = "█" * int(pct // 5) + "░" * (20 - int(pct // 5))
+    eta_text = f"{int(eta)}s" if eta is not None else "N/A"
+    return (
+        f"**Uploading {total_parts} parts** ({in_flight} in flight)\n"
+        f"`[{bar}]` **{pct:.1f}%**\n"
+        f"**Size:** {humanbytes(done)} / {humanbytes(total)}\n"
+        f"**Speed:** {humanbytes(speed)}/s • **ETA:** {eta_text}"
+    )
+
+async def _save(app, idx, open_part, progress, should_cancel):
+    """Uploads the bytes of part `idx` and returns its InputFile"""
+    async def part_progress(current, total):
+        if should_cancel and should_cancel():
+            raise StopTransmission()
+        # Counted from the first chunk, not while waiting for a transmission slot
+        progress.active.add(idx)
+        progress.peak = max(progress.peak, len(progress.active))
+        await progress.update(idx, current)
+
+    source = open_part(idx)
+    try:
+        saved = await app.save_file(source, progress=part_progress)
+    finally:
+        progress.active.discard(idx)
+        source.close()
+    if saved is None:
+        # save_file logs and swallows errors instead of raising them
+        raise Exception(f"Upload of part {idx} failed")
+    return saved
+
+async def _send(app, chat_id, idx, saved, file_name, caption, open_part):
+    """Posts an uploaded part to the chat and returns the parsed Message"""
+    media = raw.types.InputMediaUploadedDocument(
+        mime_type=app.guess_mime_type(file_name) or "application/zip",
+        file=saved,
+        attributes=[raw.types.DocumentAttributeFilename(file_name=file_name)],
+    )
+    while True:
+        try:
+            r = await app.invoke(
+                raw.functions.messages.SendMedia(
+                    peer=await app.resolve_peer(chat_id),
+                    media=media,
+                    random_id=app.rnd_id(),
+                    **await pyrogram_utils.parse_text_entities(app, caption, None, None)
+                )
+            )
+        except FilePartMissing as e:
+            # Same recovery as send_document: re-send just the missing chunk
+            source = open_part(idx)
+            try:
+                await app.save_file(source, file_id=saved.id, file_part=e.value)
+            finally:
+                source.close()
+        else:
+            for update in r.updates:
+                if isinstance(update, (raw.types.UpdateNewMessage, raw.types.UpdateNewChannelMessage)):
+                    return await types.Message._parse(
+                        app, update.message,
+                        {u.id: u for u in r.users},
+                        {c.id: c for c in r.chats},
+                    )
+            raise Exception(f"Telegram did not return a message for part {idx}")
+
+async def upload_parts(app, chat_id, names, sizes, open_part, caption, progress=None,
+                       should_cancel=None, parallel=PARALLEL_PARTS, retries=RETRIES,
+                       skip=(), on_sent=None):
+    """
+    Uploads parts concurrently and sends them to `chat_id` in order.
+
+    :param names: File name of each part, in order.
+    :param sizes: Size in bytes of each part, in order.
+    :param open_part: Callable open_part(idx) returning a fresh binary file
+                      object with a `.name` for part idx (1-based), e.g. a
+                      FileRange; it is closed after each use.
+    :param caption: Callable caption(idx, name) returning the part's caption.
+    :param progress: Optional coroutine function
+                     progress(done, total, speed, eta, parts_in_flight).
+    :param should_cancel: Optional callable; True aborts with DownloadCancelled.
+    :param parallel: How many parts are uploaded at the same time.
+    :param retries: Attempts per part (upload and send together).
+    :param skip: Part numbers already delivered (e.g. before a restart);
+                 they are neither uploaded nor sent.
+    :param on_sent: Optional callable on_sent(idx, message), called as soon
+                    as each part is posted.
+    :return: The sent Messages of the parts not skipped, in part order.
+    """
+    todo = [idx for idx in range(1, len(names) + 1) if idx not in skip]
+    tracker = _Progress(sum(sizes[idx - 1] for idx in todo), progress)
+    slots = asyncio.Semaphore(parallel)
+    # Pyrogram's save_file lets max_concurrent_transmissions uploads run bot-wide
+    cap = getattr(app, "max_concurrent_transmissions", parallel)
+    if cap < parallel:
+        log.warning(f"Client allows {cap} concurrent uploads, fewer than the {parallel} parallel parts asked for")
+
+    async def save(idx):
+        async with slots:
+            return await _save(app, idx, open_part, tracker, should_cancel)
+
+    # All uploads start now and run `parallel` at a time; sending waits for them in order
+    saves = {idx: asyncio.create_task(save(idx)) for idx in todo}
+    messages = []
+    try:
+        for idx in todo:
+            name = names[idx - 1]
+            attempt = 1
+            while True:
+                try:
+                    saved = await saves[idx]
+                    message = await _send(app, chat_id, idx, saved, name, caption(idx, name), open_part)
+                    messages.append(message)
+                    if on_sent:
+                        on_sent(idx, message)
+                    break
+                except StopTransmission:
+                    raise DownloadCancelled()
+                except FloodWait as e:
+                    # Raised by the send; the finished upload is reused
+                    log.info(f"Flood wait. Waiting for {e.value} seconds...")
+                    await asyncio.sleep(e.value)
+                    continue
+                except Exception as e:
+                    if should_cancel and should_cancel():
+                        raise DownloadCancelled()
+                    log.error(f"Upload of part {idx} failed on attempt {attempt}/{retries}: {e}")
+                    if attempt >= retries:
+                        raise
+                    attempt += 1
+                    await asyncio.sleep(RETRY_DELAY)
+                # Upload the part again, then retry sending it
+                tracker.per_part[idx] = 0
+                saves[idx] = asyncio.create_task(save(idx))
+    finally:
+        for task in saves.values():
+            task.cancel()
+        await asyncio.gather(*saves.values(), return_exceptions=True)
+    if parallel > 1 and len(todo) > 1 and tracker.peak < 2:
+        log.warning(f"The {len(todo)} parts were uploaded one at a time, not {parallel} at once")
+    else:
+        log.info(f"Uploaded {len(todo)} parts, up to {tracker.peak} at once")
+    return messages
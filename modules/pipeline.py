@@ -0,0 +1,74 @@
+#
+# This module overlaps producing file parts (e.g. ranged downloads) with
+# uploading them to Telegram. While part N is being uploaded, part N+1 is
+# already being produced, and a small slot limit keeps at most about two
+# parts on disk at any time.
+#
+
+import os
+import asyncio
+import logging
+
+log = logging.getLogger("pipeline")
+
+_DONE = object()
+
+async def run_pipeline(parts, upload, depth=2, cleanup=True):
+    """
+    Uploads parts as soon as they are produced.
+
+    :param parts: An async iterator yielding the paths of finished parts, in order.
+                  The next part is only requested once a slot is free.
+    :param upload: A coroutine function upload(idx, path) called once per part (1-based).
+    :param depth: How many parts may exist at once (being produced, waiting
+                  or being uploaded). 2 means "upload one, fetch the next".
+    :param cleanup: Remove each part once its upload has finished or failed.
+    :return: The number of parts uploaded.
+    """
+    queue = asyncio.Queue()
+    slots = asyncio.Semaphore(depth)
+
+    async def producer():
+        iterator = parts.__aiter__()
+        try:
+            while True:
+                await slots.acquire()
+                try:
+                    path = await iterator.__anext__()
+                except StopAsyncIteration:
+                    break
+                queue.put_nowait(path)
+        finally:
+            # Never blocks, so the consumer always wakes up
+            queue.put_nowait(_DONE)
+
+    producer_task = asyncio.create_task(producer())
+    uploaded = 0
+    try:
+        while True:
+            path = await queue.get()
+            if path is _DONE:
+                break
+            uploaded += 1
+            try:
+                await upload(uploaded, path)
+            finally:
+                if cleanup and os.path.exists(path):
+                    os.remove(path)
+            slots.release()
+        # Surface any error that ended the producer early
+        await producer_task
+    finally:
+        if not producer_task.done():
+            producer_task.cancel()
+            try:
+                await producer_task
+            except (asyncio.CancelledError, Exception):
+                pass
+        # Parts that were produced but never uploaded
+        while not queue.empty():
+            path = queue.get_nowait()
+            if cleanup and path is not _DONE and os.path.exists(path):
+                os.remove(path)
+
+    return uploaded
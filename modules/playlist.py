@@ -0,0 +1,448 @@
+#
+# This module handles the /ytpl command: a whole playlist or channel with
+# one command. The entry list comes from a flat extraction (no per-video
+# page requests), one quality policy applies to every entry, and entries
+# are downloaded and uploaded by YTDL_PLAYLIST_WORKERS workers, each entry
+# still going through the scheduler, staging and the file cache like a
+# /ytdl job. Progress of all entries is shown in a single status message.
+#
+# The entry list and what has been delivered are kept in a sidecar JSON
+# file in the user's download folder, so running the same command again
+# after a cancel or a failure only does the missing entries. After a
+# restart the job is resumed from the journal, which also lists the
+# delivered entries in case the sidecar was lost with the disk.
+#
+
+import os
+import json
+import time
+import shutil
+import asyncio
+import hashlib
+import logging
+from collections import deque
+from pyrogram import Client, filters
+from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton, Message
+from pyrogram.errors import FloodWait, RPCError
+
+from .utils import data_paths, ensure_dirs, humanbytes, DownloadCancelled, safe_edit_text
+from .file_splitter import FileRange, file_ranges
+from .part_uploader import upload_parts
+from .file_cache import normalize_url
+from . import file_cache, staging, tasks, cookie_store, journal
+from .scheduler import scheduler, priority_for
+from .ytdl_pool import pool as ytdl_pool
+from .ytdl_engines import split_engine_flag
+from .ytdlp import MAX_SIZE, fetch_formats, fetch_media, sanitize_filename, clean_ansi_codes
+
+log = logging.getLogger("playlist")
+
+# ---------------- Tunables (overridable from the environment) ----------------
+WORKERS = int(os.environ.get("YTDL_PLAYLIST_WORKERS", "2"))
+MAX_ENTRIES = int(os.environ.get("YTDL_PLAYLIST_MAX", "200"))
+STATUS_INTERVAL = 3   # seconds between status message refreshes
+SHOWN_FINISHED = 5    # recently finished entries listed in the status
+RETRIES = 3
+
+FLAT_OPTS = {
+    "quiet": True,
+    "skip_download": True,
+    "extract_flat": "in_playlist",  # entry ids and titles only
+}
+
+# Quality policy -> yt-dlp format string ("fit" is worked out per entry)
+POLICIES = {
+    "360": "bestvideo[height<=360][ext=mp4]+bestaudio[ext=m4a]/best[height<=360]",
+    "480": "bestvideo[height<=480][ext=mp4]+bestaudio[ext=m4a]/best[height<=480]",
+    "720": "bestvideo[height<=720][ext=mp4]+bestaudio[ext=m4a]/best[height<=720]",
+    "1080": "bestvideo[height<=1080][ext=mp4]+bestaudio[ext=m4a]/best[height<=1080]",
+    "max": "bestvideo+bestaudio/best",
+    "audio": "bestaudio[ext=m4a]/bestaudio",
+    "fit": None,
+}
+DEFAULT_POLICY = "fit"
+USAGE = (
+    "Usage: `/ytpl <playlist or channel URL> [quality]`\n"
+    "Quality: `fit` (best under the upload limit, default), `360`, `480`, `720`, `1080`, `max` or `audio`"
+)
+
+def cancel_btn(tid):
+    return InlineKeyboardMarkup([[InlineKeyboardButton("⛔ Cancel", callback_data=f"cancel_ytpl:{tid}")]])
+
+# ---------------- Entry list ----------------
+def _entries(ydl, info, depth=0):
+    """Video entries of a flat-extracted playlist, expanding channel tabs"""
+    found = []
+    for entry in info.get("entries") or ():
+        if not entry:
+            continue
+        url = entry.get("url") or entry.get("webpage_url")
+        if entry.get("_type") == "playlist":
+            found += _entries(ydl, entry, depth + 1)
+        elif depth < 2 and (entry.get("ie_key") or "").endswith(("Tab", "Playlist")):
+            # e.g. a channel URL lists its Videos/Shorts tabs as playlists
+            found += _entries(ydl, ydl.extract_info(url, download=False), depth + 1)
+        elif url and url.startswith(("http://", "https://")):
+            found.append({
+                "id": entry.get("id") or url,
+                "url": url,
+                "title": entry.get("title") or entry.get("id") or url,
+            })
+    return found
+
+def list_entries(url, cookies=None):
+    """
+    Flat-extracts a playlist or channel. Blocking; run it in a thread.
+
+    :return: (playlist title, [{"id", "url", "title"}, ...])
+    """
+    with ytdl_pool.checkout("flat", FLAT_OPTS, cookies) as ydl:
+        info = ydl.extract_info(url, download=False)
+        if info.get("_type") not in ("playlist", "multi_video"):
+            # A single video: a playlist of one
+            return info.get("title") or url, [{"id": info.get("id") or url, "url": url,
+                                               "title": info.get("title") or url}]
+        entries = _entries(ydl, info)
+
+    unique = {}
+    for entry in entries:
+        unique.setdefault(entry["id"], entry)
+    return info.get("title") or url, list(unique.values())[:MAX_ENTRIES]
+
+# ---------------- Resume state ----------------
+def state_path(user_dir, url, policy):
+    """Sidecar file recording a playlist's entries and progress"""
+    digest = hashlib.sha1(f"{normalize_url(url)}|{policy}".encode()).hexdigest()[:16]
+    return os.path.join(user_dir, f".playlist-{digest}.json")
+
+def load_state(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def save_state(path, state):
+    # Written to a temporary file first, so a crash never leaves half a file
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp, path)
+
+# ---------------- Status message ----------------
+class PlaylistStatus:
+    """
+    Per-entry progress of a playlist, rendered into one status message.
+    Entry texts may be set from download threads; the message is refreshed
+    every STATUS_INTERVAL seconds from the event loop.
+    """
+    def __init__(self, msg, tid, title, total, done):
+        self.msg = msg
+        self.tid = tid
+        self.title = title
+        self.total = total
+        self.done = done
+        self.skipped = done  # delivered by an earlier run
+        self.failed = 0
+        self.running = {}  # entry id -> (title, progress text)
+        self.finished = deque(maxlen=SHOWN_FINISHED)
+        self.closed = False
+
+    def update(self, eid, title, text):
+        self.running[eid] = (title, text)
+
+    def finish(self, eid, title, ok, text):
+        self.running.pop(eid, None)
+        if ok:
+            self.done += 1
+        else:
+            self.failed += 1
+        self.finished.append(f"{'✅' if ok else '❌'} `{title}` {text}".rstrip())
+
+    def render(self):
+        lines = [
+            f"📃 **Playlist:** {self.title}",
+            f"✅ {self.done}/{self.total} sent • ⬇️ {len(self.running)} running • ❌ {self.failed} failed",
+        ]
+        if self.skipped:
+            lines.append(f"♻️ {self.skipped} sent by an earlier run")
+        lines.append("")
+        lines += [f"• `{title}` — {text}" for title, text in list(self.running.values())]
+        lines += list(self.finished)
+        return "\n".join(lines)
+
+    async def run(self):
+        while not self.closed:
+            await safe_edit_text(self.msg, self.render(), reply_markup=cancel_btn(self.tid))
+            await asyncio.sleep(STATUS_INTERVAL)
+
+    def stop(self):
+        self.closed = True
+
+def _short(title, length=40):
+    return title if len(title) <= length else title[:length - 1] + "…"
+
+# ---------------- Upload ----------------
+async def _upload(app, chat_id, path, caption, progress, should_cancel):
+    """Sends a downloaded entry like /ytdl does and returns its file_cache entries"""
+    filesize = os.path.getsize(path)
+    is_video = os.path.splitext(path)[1].lower() in ['.mp4', '.mkv', '.avi', '.mov', '.webm']
+
+    if filesize <= MAX_SIZE:
+        send = app.send_video if is_video else app.send_document
+        attempt = 1
+        while True:
+            try:
+                async with scheduler.upload_slot():
+                    message = await send(chat_id, path, caption=caption, progress=progress)
+                return [file_cache.file_entry(message)]
+            except FloodWait as e:
+                log.info(f"Flood wait. Waiting for {e.value} seconds...")
+                await asyncio.sleep(e.value)
+            except RPCError as e:
+                if attempt >= RETRIES:
+                    raise
+                log.error(f"Upload of {path} failed on attempt {attempt}/{RETRIES}: {e}")
+                attempt += 1
+                await asyncio.sleep(5)
+
+    # Bigger than Telegram allows: byte-range parts, uploaded side by side
+    parts = file_ranges(path, MAX_SIZE)
+    names = []
+    for _, _, name in parts:
+        name = sanitize_filename(name)
+        if len(name) > 150:
+            name = name[:150] + os.path.splitext(name)[1]
+        names.append(name)
+
+    async def parts_progress(done, total, speed, eta, in_flight):
+        await progress(done, total)
+
+    async with scheduler.upload_slot():
+        messages = await upload_parts(
+            app, chat_id,
+            names=names,
+            sizes=[length for _, length, _ in parts],
+            open_part=lambda idx: FileRange(path, parts[idx - 1][0], parts[idx - 1][1], names[idx - 1]),
+            caption=lambda idx, name: f"{caption}\nPart {idx}/{len(parts)}",
+            progress=parts_progress,
+            should_cancel=should_cancel,
+        )
+    return [file_cache.file_entry(message) for message in messages]
+
+@journal.resumer("playlist")
+async def start_playlist(app, task, msg):
+    """
+    Lists the entries of a /ytpl task and starts on the ones not delivered
+    yet, reporting into `msg`. Also resumes playlist jobs left unfinished
+    by a restart.
+    """
+    url = task.url
+    user_id = task.user_id
+    chat_id = task.chat_id
+    tid = task.tid
+    policy = task.data["policy"]
+    engine = task.data.get("engine")
+    no_cache = task.data.get("no_cache", False)
+    paths = data_paths(user_id)
+    sidecar = state_path(paths["downloads"], url, policy)
+    journal.track(task)
+
+    cookies = await cookie_store.path_for(user_id)
+    state = load_state(sidecar)
+    if state is None:
+        try:
+            title, entries = await asyncio.to_thread(list_entries, url, cookies)
+        except Exception as e:
+            tasks.remove(task)
+            return await msg.edit(f"❌ Error fetching playlist: {e}")
+        if not entries:
+            tasks.remove(task)
+            return await msg.edit("❌ No videos found.")
+        state = {"url": url, "policy": policy, "title": title, "entries": entries, "done": {}, "failed": {}}
+    # The journal also knows what was delivered if a restart lost the sidecar
+    for eid in journal.parts(task):
+        state["done"][eid] = True
+    save_state(sidecar, state)
+
+    pending = [e for e in state["entries"] if e["id"] not in state["done"]]
+    status = PlaylistStatus(msg, tid, state["title"], len(state["entries"]), len(state["done"]))
+    index = {e["id"]: i for i, e in enumerate(state["entries"], 1)}
+
+    async def resolve_format(entry_url):
+        """
+        (format string, expected size, note) for one entry under the policy.
+        Under "fit", an entry with nothing under the upload limit gets its
+        smallest format, and the note says so in the entry's status.
+        """
+        if policy != "fit":
+            return POLICIES[policy], 0, None
+        # Also fills the info cache, so the download doesn't extract again
+        fmts, plan = await fetch_formats(entry_url, cookies, task)
+        if not fmts:
+            raise Exception("No format fits: yt-dlp listed no formats")
+        if plan.get("fit"):
+            return plan["fit"]["format"], plan["fit"]["size"], None
+        if plan.get("smallest"):
+            return (plan["smallest"]["format"], plan["smallest"]["size"],
+                    f"no format fits {humanbytes(MAX_SIZE)}, sent the smallest")
+        return "best", 0, "size unknown, sent the best"
+
+    async def process(entry):
+        eid, entry_url = entry["id"], entry["url"]
+        title = _short(entry["title"])
+        caption = f"✅ {index[eid]}/{status.total}: `{entry['title']}`"
+        status.update(eid, title, "🔍 choosing format")
+        spec, size, note = await resolve_format(entry_url)
+
+        key = file_cache.cache_key("ytdl", entry_url, spec)
+        if not no_cache and await file_cache.send_cached(app, chat_id, key):
+            return "from cache"
+
+        def hook(d):
+            if task.is_cancelled():
+                raise DownloadCancelled()
+            if d["status"] == "downloading":
+                pct = clean_ansi_codes(d.get("_percent_str", "")).strip()
+                speed = clean_ansi_codes(d.get("_speed_str", "")).strip()
+                status.update(eid, title, f"⬇️ {pct} • {speed}")
+
+        async def upload_progress(current, total):
+            status.update(eid, title, f"⬆️ {current / total * 100 if total else 0:.1f}% of {humanbytes(total)}")
+
+        async def show_position(position):
+            status.update(eid, title, f"⏳ queued ({position})")
+
+        async def show_wait(reason):
+            status.update(eid, title, staging.wait_text(reason))
+
+        # Each entry gets its own folder: titles repeat within playlists
+        entry_dir = os.path.join(paths["downloads"], f"ytpl-{tid}-{index[eid]}")
+        os.makedirs(entry_dir, exist_ok=True)
+        reservation = None
+        try:
+            async with scheduler.job(user_id, size=size, priority=priority_for(size, bulk=True),
+                                     on_position=show_position,
+                                     should_cancel=task.is_cancelled):
+                reservation = await staging.reserve(
+                    user_id, size * 2 if "+" in spec else size,
+                    on_wait=show_wait, should_cancel=task.is_cancelled,
+                )
+                status.update(eid, title, "⬇️ starting")
+                async with scheduler.download_slot():
+                    full_path, _, _ = await fetch_media(
+                        task, entry_url, entry_dir, cookies, hook, spec, engine,
+                    )
+                filesize = os.path.getsize(full_path)
+                sent = await _upload(app, chat_id, full_path, caption, upload_progress, task.is_cancelled)
+                await file_cache.put(key, sent, filesize)
+                return f"{humanbytes(filesize)}, {note}" if note else humanbytes(filesize)
+        finally:
+            staging.release(reservation)
+            shutil.rmtree(entry_dir, ignore_errors=True)
+
+    async def runner():
+        queue = asyncio.Queue()
+        for entry in pending:
+            queue.put_nowait(entry)
+
+        async def worker():
+            while True:
+                try:
+                    entry = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                eid, title = entry["id"], _short(entry["title"])
+                try:
+                    result = await process(entry)
+                except (DownloadCancelled, asyncio.CancelledError):
+                    raise
+                except Exception as e:
+                    if task.is_cancelled():
+                        raise DownloadCancelled()
+                    log.error(f"Playlist entry {entry['url']} failed: {e}")
+                    state["failed"][eid] = str(e)
+                    status.finish(eid, title, False, str(e)[:100])
+                else:
+                    state["done"][eid] = True
+                    state["failed"].pop(eid, None)
+                    journal.delivered(task, eid)
+                    status.finish(eid, title, True, result)
+                save_state(sidecar, state)
+
+        journal.state(task, "downloading")
+        refresher = asyncio.create_task(status.run())
+        workers = [asyncio.create_task(worker()) for _ in range(min(WORKERS, len(pending)))]
+        started = time.time()
+        try:
+            try:
+                await asyncio.gather(*workers)
+            except BaseException:
+                for w in workers:
+                    w.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
+                raise
+            status.stop()
+            journal.state(task, "done")
+            took = int(time.time() - started)
+            if state["failed"]:
+                await safe_edit_text(
+                    msg, f"{status.render()}\n\n⚠️ Finished in {took}s with {len(state['failed'])} failed. "
+                         f"Send the same command again to retry them.")
+            else:
+                os.remove(sidecar)
+                await safe_edit_text(msg, f"{status.render()}\n\n✅ Playlist finished in {took}s.")
+        except (DownloadCancelled, asyncio.CancelledError):
+            status.stop()
+            await safe_edit_text(
+                msg, f"{status.render()}\n\n❌ Cancelled. Send the same command again to resume.")
+        except Exception as e:
+            log.error(f"An error occurred in the playlist runner: {e}", exc_info=True)
+            status.stop()
+            await safe_edit_text(msg, f"❌ Error: {e}")
+        finally:
+            status.stop()
+            refresher.cancel()
+            tasks.remove(task)
+
+    task.bind(asyncio.create_task(runner()))
+
+def register_playlist_handlers(app: Client):
+    @app.on_message(filters.command("ytpl") & (filters.private | filters.group))
+    async def cmd_ytpl(_, m: Message):
+        """
+        Handles /ytpl: downloads every entry of a playlist or channel.
+        """
+        args = m.text.split(maxsplit=1)
+        if len(args) < 2:
+            return await m.reply(USAGE)
+        text, engine = split_engine_flag(args[1])
+        text, no_cache = file_cache.split_bypass_flag(text)
+        words = text.split()
+        policy = words[1].lower().removesuffix("p") if len(words) > 1 else DEFAULT_POLICY
+        if not words or policy not in POLICIES:
+            return await m.reply(USAGE)
+        url = words[0]
+
+        user_id = m.from_user.id
+        ensure_dirs()
+
+        msg = await m.reply("🔍 Fetching playlist…")
+        task = tasks.register("playlist", user_id, m.chat.id, url, no_cache=no_cache, engine=engine, policy=policy)
+        task.msg_id = msg.id
+        await start_playlist(app, task, msg)
+
+    @app.on_callback_query(filters.regex(r"^cancel_ytpl:(.+)$"))
+    async def cancel_ytpl_cb(_, q):
+        """
+        Handles the "Cancel" button of a playlist.
+        """
+        tid = q.data.split(":")[1]
+        task = tasks.get(tid, "playlist")
+        if task and task.user_id == q.from_user.id:
+            tasks.cancel(tid)
+            await q.answer("⛔ Playlist cancelled.", show_alert=True)
+        elif task:
+            await q.answer("❌ Only the user who started this task can cancel it.", show_alert=True)
+        else:
+            await q.answer("❌ Task not found.", show_alert=True)
@@ -0,0 +1,125 @@
+#
+# This module decides how a /ytdl download ends up as an MP4. Every merged
+# format used to go through FFmpegVideoConvertor, i.e. a full re-encode on
+# the CPU, often slower than the download itself. Now:
+#
+#   - separate video and audio streams are merged with stream copy into
+#     MP4 when the codecs allow it (h264/hevc/av1 + aac/mp3), else into MKV,
+#   - a single file in another container whose codecs fit MP4 is remuxed
+#     (stream copy, seconds even for long videos),
+#   - only codecs MP4 can't hold are transcoded, and only with
+#     YTDL_TRANSCODE=1; otherwise the file is sent as it is.
+#
+# `finish` returns a one-line summary of what was done and how long it took.
+#
+
+import os
+import time
+import logging
+from yt_dlp.postprocessor.ffmpeg import FFmpegPostProcessor
+
+log = logging.getLogger("remux")
+
+# ---------------- Tunables (overridable from the environment) ----------------
+TRANSCODE = os.environ.get("YTDL_TRANSCODE", "0") == "1"
+TRANSCODE_PRESET = os.environ.get("YTDL_TRANSCODE_PRESET", "veryfast")
+MERGE_FORMATS = "mp4/mkv"  # merge_output_format: MP4 if the codecs fit, else MKV
+
+_MP4_VIDEO = ("avc1", "avc3", "h264", "hvc1", "hev1", "hevc", "h265", "av01", "av1")
+_MP4_AUDIO = ("mp4a", "aac", "mp3", "ac-3", "ac3", "ec-3", "eac3")
+_REMUX_ARGS = ["-map", "0:v?", "-map", "0:a?", "-c", "copy", "-movflags", "+faststart"]
+
+class PostprocessorTimer:
+    """
+    A yt-dlp postprocessor hook that records how long each postprocessor
+    (e.g. the Merger) took.
+    """
+    def __init__(self):
+        self.started = {}
+        self.took = {}
+
+    def __call__(self, d):
+        name = d.get("postprocessor")
+        if d["status"] == "started":
+            self.started[name] = time.monotonic()
+        elif d["status"] == "finished" and name in self.started:
+            self.took[name] = time.monotonic() - self.started.pop(name)
+
+def _codec_name(codec):
+    return (codec or "").split(".")[0].lower()
+
+def _codecs(info):
+    """(video codecs, audio codecs) of the selected format(s), as reported by the site"""
+    formats = info.get("requested_formats") or [info]
+    vcodecs = [_codec_name(f.get("vcodec")) for f in formats if f.get("vcodec") not in (None, "none")]
+    acodecs = [_codec_name(f.get("acodec")) for f in formats if f.get("acodec") not in (None, "none")]
+    return vcodecs, acodecs
+
+def _probe_codecs(ffmpeg, path):
+    """(video codecs, audio codecs) of the file on disk, via ffprobe"""
+    streams = ffmpeg.get_metadata_object(path).get("streams", [])
+    return (
+        [s["codec_name"] for s in streams if s.get("codec_type") == "video"],
+        [s["codec_name"] for s in streams if s.get("codec_type") == "audio"],
+    )
+
+def mp4_compatible(vcodecs, acodecs):
+    """True if MP4 can hold these codecs without re-encoding"""
+    return (all(c.startswith(_MP4_VIDEO) for c in vcodecs)
+            and all(c.startswith(_MP4_AUDIO) for c in acodecs))
+
+def _codec_text(vcodecs, acodecs):
+    return "/".join(vcodecs + acodecs) or "unknown codecs"
+
+def finish(ydl, info, path, timer=None, transcode=TRANSCODE):
+    """
+    Turns a finished download into an MP4 where it can be done cheaply.
+    Blocking; call it in the download thread, with the YoutubeDL that
+    downloaded `info`.
+
+    :param timer: The PostprocessorTimer that watched the download, if any.
+    :param transcode: Re-encode codecs that MP4 can't hold.
+    :return: (path of the final file, summary of what was done)
+    """
+    ext = os.path.splitext(path)[1].lstrip(".").lower()
+    merged = info.get("requested_formats") is not None
+    merge_time = (timer.took.get("Merger") if timer else None) or 0
+
+    if ext == "mp4":
+        if merged:
+            return path, f"merged into mp4 with stream copy in {merge_time:.1f}s"
+        return path, "already mp4"
+
+    ffmpeg = FFmpegPostProcessor(ydl)
+    if not ffmpeg.available:
+        return path, f"kept {ext}: ffmpeg is not installed"
+
+    vcodecs, acodecs = _codecs(info)
+    if not vcodecs and not acodecs:
+        vcodecs, acodecs = _probe_codecs(ffmpeg, path)
+    codecs = _codec_text(vcodecs, acodecs)
+    target = os.path.splitext(path)[0] + ".mp4"
+
+    if mp4_compatible(vcodecs, acodecs):
+        action, args = "remuxed", _REMUX_ARGS
+    elif transcode:
+        action = "transcoded"
+        args = ["-map", "0:v:0?", "-map", "0:a:0?", "-c:v", "libx264", "-preset", TRANSCODE_PRESET,
+                "-crf", "23", "-c:a", "aac", "-b:a", "160k", "-movflags", "+faststart"]
+    else:
+        how = "merged" if merged else "downloaded"
+        return path, f"kept {ext} ({codecs} can't go into mp4 without transcoding; {how} with stream copy)"
+
+    start = time.monotonic()
+    try:
+        ffmpeg.run_ffmpeg(path, target, args)
+    except Exception as e:
+        log.error(f"ffmpeg failed to convert {path}: {e}")
+        if os.path.exists(target):
+            os.remove(target)
+        return path, f"kept {ext}: converting to mp4 failed"
+    os.remove(path)
+    how = " with stream copy" if action == "remuxed" else ""
+    summary = f"{action} {ext} ({codecs}) to mp4{how} in {time.monotonic() - start:.1f}s"
+    log.info(f"{os.path.basename(target)}: {summary}")
+    return target, summary
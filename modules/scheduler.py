@@ -0,0 +1,197 @@
+#
+# This module is the central job scheduler shared by /leech, /ytdl and
+# /drive. It bounds how many jobs run at once, hands out separate download
+# and upload slots, and decides which queued job runs next:
+#
+#   1. the best priority class first (HIGH, then NORMAL, then LOW; small
+#      single jobs are HIGH, /ytpl entries and folder files LOW),
+#   2. round-robin between users, so one user's backlog can't starve others,
+#   3. within a user's queue, the smallest expected size first.
+#
+# Jobs waiting in the queue are told their position so it can be shown in
+# their status message.
+#
+
+import os
+import math
+import asyncio
+import logging
+import itertools
+from collections import deque
+from contextlib import asynccontextmanager
+
+from .utils import DownloadCancelled
+
+log = logging.getLogger("scheduler")
+
+# ---------------- Tunables (overridable from the environment) ----------------
+MAX_JOBS = int(os.environ.get("SCHED_MAX_JOBS", "6"))
+DOWNLOAD_SLOTS = int(os.environ.get("SCHED_DOWNLOAD_SLOTS", "4"))
+UPLOAD_SLOTS = int(os.environ.get("SCHED_UPLOAD_SLOTS", "2"))
+# Single jobs up to this size jump ahead of bigger ones (see priority_for)
+SMALL_JOB_SIZE = int(os.environ.get("SCHED_SMALL_JOB_MB", "64")) * 1024 * 1024
+
+# ---------------- Priority classes (lower runs first) ----------------
+HIGH = 0
+NORMAL = 1
+LOW = 2
+
+def priority_for(size, bulk=False):
+    """
+    The priority class of a job: LOW for one item of a bulk job (a /ytpl
+    entry, a file of a Drive folder), HIGH for a single job known to be at
+    most SMALL_JOB_SIZE, NORMAL otherwise.
+    """
+    if bulk:
+        return LOW
+    if 0 < (size or 0) <= SMALL_JOB_SIZE:
+        return HIGH
+    return NORMAL
+
+class _Ticket:
+    """
+    A job waiting for (or holding) a worker slot.
+    """
+    def __init__(self, seq, user_id, size, priority, on_position):
+        self.seq = seq
+        self.user_id = user_id
+        self.size = size
+        self.priority = priority
+        self.on_position = on_position
+        self.position = None
+        self.started = asyncio.Event()
+
+    @property
+    def sort_key(self):
+        # Unknown sizes go after known ones for the same user
+        return (self.priority, self.size or math.inf, self.seq)
+
+class Scheduler:
+    """
+    Bounded worker pool with per-user round-robin and size-ordered queues.
+    """
+    def __init__(self, max_jobs=MAX_JOBS, download_slots=DOWNLOAD_SLOTS, upload_slots=UPLOAD_SLOTS):
+        self.max_jobs = max_jobs
+        self.running = 0
+        self.queues = {}  # user_id -> list of tickets
+        self.rotation = deque()  # user ids in round-robin order
+        self.downloads = asyncio.Semaphore(download_slots)
+        self.uploads = asyncio.Semaphore(upload_slots)
+        self._seq = itertools.count()
+
+    # ---------------- Queue bookkeeping ----------------
+    def _enqueue(self, ticket):
+        self.queues.setdefault(ticket.user_id, []).append(ticket)
+        if ticket.user_id not in self.rotation:
+            self.rotation.append(ticket.user_id)
+
+    def _remove(self, ticket):
+        queue = self.queues.get(ticket.user_id, [])
+        if ticket in queue:
+            queue.remove(ticket)
+        if not queue:
+            self.queues.pop(ticket.user_id, None)
+            if ticket.user_id in self.rotation:
+                self.rotation.remove(ticket.user_id)
+
+    @staticmethod
+    def _pick(queues, rotation):
+        """
+        Chooses the next ticket from `queues` and rotates its user to the back
+        of `rotation`. Both arguments are modified.
+        """
+        best = min(t.priority for q in queues.values() for t in q)
+        for user_id in list(rotation):
+            candidates = [t for t in queues[user_id] if t.priority == best]
+            if candidates:
+                ticket = min(candidates, key=lambda t: t.sort_key)
+                queues[user_id].remove(ticket)
+                rotation.remove(user_id)
+                if queues[user_id]:
+                    rotation.append(user_id)
+                else:
+                    queues.pop(user_id)
+                return ticket
+        return None
+
+    def _dispatch(self):
+        """Starts queued jobs while worker slots are free, then updates positions"""
+        while self.running < self.max_jobs and self.queues:
+            ticket = self._pick(self.queues, self.rotation)
+            self.running += 1
+            ticket.position = 0
+            ticket.started.set()
+        self._notify_positions()
+
+    def _notify_positions(self):
+        """Works out the dispatch order of all queued jobs and reports changes"""
+        queues = {u: list(q) for u, q in self.queues.items()}
+        rotation = deque(self.rotation)
+        position = 0
+        while queues:
+            ticket = self._pick(queues, rotation)
+            position += 1
+            if ticket.position != position:
+                ticket.position = position
+                if ticket.on_position:
+                    asyncio.create_task(ticket.on_position(position))
+
+    def queued(self):
+        """Number of jobs waiting for a worker slot"""
+        return sum(len(q) for q in self.queues.values())
+
+    # ---------------- Public API ----------------
+    @asynccontextmanager
+    async def job(self, user_id, size=0, priority=NORMAL, on_position=None, should_cancel=None):
+        """
+        Waits for a worker slot and holds it for the duration of the block.
+
+        :param size: Expected size in bytes (0 if unknown), used for ordering.
+        :param priority: HIGH, NORMAL or LOW.
+        :param on_position: Optional coroutine function called with the 1-based
+                            queue position whenever it changes while queued.
+        :param should_cancel: Optional callable; if it returns True while the
+                              job is queued, DownloadCancelled is raised.
+        """
+        ticket = _Ticket(next(self._seq), user_id, size, priority, on_position)
+        self._enqueue(ticket)
+        self._dispatch()
+        try:
+            while not ticket.started.is_set():
+                if should_cancel and should_cancel():
+                    raise DownloadCancelled()
+                try:
+                    await asyncio.wait_for(ticket.started.wait(), timeout=1)
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            if ticket.started.is_set():
+                self.running -= 1
+            else:
+                self._remove(ticket)
+            self._dispatch()
+            raise
+
+        try:
+            yield ticket
+        finally:
+            self.running -= 1
+            self._dispatch()
+
+    @asynccontextmanager
+    async def download_slot(self):
+        """Holds one of the global download slots"""
+        async with self.downloads:
+            yield
+
+    @asynccontextmanager
+    async def upload_slot(self):
+        """Holds one of the global upload slots"""
+        async with self.uploads:
+            yield
+
+scheduler = Scheduler()
+
+def queue_text(position):
+    """Status line shown while a job waits for a worker slot"""
+    return f"⏳ **Queued** — position {position} ({scheduler.running} running)"
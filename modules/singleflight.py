@@ -0,0 +1,115 @@
+#
+# This module coalesces identical in-flight transfers. The first request
+# for a source (see file_cache.cache_key) becomes the leader and does the
+# work; later requests for the same source attach to it, see its progress
+# in their own status message, and get the uploaded files resent to their
+# chat by file_id once it finishes. Nothing is fetched twice.
+#
+
+import asyncio
+import logging
+
+from . import file_cache, journal, tasks
+from .utils import safe_edit_text
+from .edits import dispatcher as edit_dispatcher
+
+log = logging.getLogger("singleflight")
+
+_flights = {}
+
+class Flight:
+    """
+    One running transfer and the requests waiting on it.
+    """
+    def __init__(self, key, msg=None):
+        self.key = key
+        self.msg = msg
+        self.followers = []
+        self.result = asyncio.get_running_loop().create_future()
+
+    def attach(self, msg):
+        """Mirrors the leader's status message into `msg`"""
+        self.followers.append(msg)
+        if self.msg is not None:
+            edit_dispatcher.add_mirror(self.msg, msg)
+
+    def report_in(self, msg):
+        """Sets the leader's status message, for flights led before it was sent"""
+        self.msg = msg
+        for follower in self.followers:
+            edit_dispatcher.add_mirror(msg, follower)
+
+    def resolve(self, files):
+        """Hands the uploaded file entries (file_cache.file_entry) to followers"""
+        if not self.result.done():
+            self.result.set_result(list(files))
+
+    def fail(self, error):
+        """Tells followers the transfer did not complete"""
+        if not self.result.done():
+            self.result.set_exception(error)
+            # Retrieved by followers if there are any; avoid "never retrieved" noise
+            self.result.exception()
+
+def find(key):
+    """Returns the running Flight for `key`, or None"""
+    return _flights.get(key)
+
+def lead(key, msg=None):
+    """
+    Registers a new transfer for `key`, reporting progress in `msg`.
+    The caller must call `release` when it finishes, whatever the outcome.
+    Call it right after `find` returned None, with no await in between, or
+    an identical request may start a second transfer. Without `msg` yet,
+    pass it to `Flight.report_in` once sent.
+    """
+    flight = Flight(key, msg)
+    _flights[key] = flight
+    return flight
+
+def release(flight, error=None):
+    """
+    Ends a flight. Followers still waiting get `error` (or a generic one if
+    the leader never resolved).
+    """
+    if _flights.get(flight.key) is flight:
+        _flights.pop(flight.key)
+    if flight.msg is not None:
+        edit_dispatcher.drop_mirrors(flight.msg)
+    flight.fail(error or Exception("The shared download did not finish."))
+
+async def follow(app, flight, chat_id, msg):
+    """
+    Attaches `msg` to a running flight and, once it completes, resends the
+    results to `chat_id` by file_id.
+
+    :return: True if the results were delivered.
+    """
+    flight.attach(msg)
+    await safe_edit_text(msg, "🔗 This link is already being downloaded. Attached to the running transfer…")
+    try:
+        files = await asyncio.shield(flight.result)
+    except Exception as e:
+        await safe_edit_text(msg, f"❌ Shared download failed: {e}")
+        return False
+
+    # Stops at the first failure: parts already delivered are not sent again
+    sent, error = await file_cache.resend(app, chat_id, files)
+    if error is not None:
+        log.error(f"Fan-out of {flight.key} to {chat_id} failed after {sent}/{len(files)} files: {error}")
+        delivered = f" after {sent} of {len(files)} parts" if sent else ""
+        await safe_edit_text(msg, f"❌ Could not deliver the shared download{delivered}: {error}")
+        return False
+    await safe_edit_text(msg, "✅ Delivered from a shared download.")
+    return True
+
+async def follow_task(app, flight, task, msg):
+    """
+    `follow` for a journaled task, e.g. a job resumed after a restart whose
+    source another request is already downloading. Ends the task.
+    """
+    try:
+        if await follow(app, flight, task.chat_id, msg):
+            journal.state(task, "done")
+    finally:
+        tasks.remove(task)
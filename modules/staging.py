@@ -0,0 +1,182 @@
+#
+# This module manages disk space in the staging area (utils.DOWNLOADS_DIR).
+# Every job reserves the bytes it expects to write before it starts, so a
+# few large parallel jobs can no longer fill the volume and all fail
+# halfway through. Jobs that don't fit right now wait for space (or are
+# rejected up front), and each user has a quota across their running jobs.
+#
+# Partial downloads kept on disk for a later resume (a sidecar resume state
+# and no download running) belong to no reservation, so they count as used.
+#
+# Usage from a module:
+#
+#   reservation = None
+#   try:
+#       reservation = await staging.reserve(user_id, expected_bytes)
+#       ...
+#   finally:
+#       staging.release(reservation)
+#
+
+import os
+import asyncio
+import logging
+import psutil
+
+from .utils import DOWNLOADS_DIR, DownloadCancelled, humanbytes
+from .http_downloader import STATE_SUFFIX, is_running
+
+log = logging.getLogger("staging")
+
+MiB = 1024 * 1024
+
+# ---------------- Tunables (overridable from the environment) ----------------
+# Space always left free on the volume
+HEADROOM = int(os.environ.get("STAGING_HEADROOM_MB", "1024")) * MiB
+# Bytes one user may have reserved at once (0 = no quota)
+USER_QUOTA = int(os.environ.get("STAGING_USER_QUOTA_MB", "8192")) * MiB
+# Reservation for jobs whose size is not known up front (e.g. /drive)
+UNKNOWN_SIZE = int(os.environ.get("STAGING_UNKNOWN_SIZE_MB", "2048")) * MiB
+# "1" waits for space to free up, "0" rejects jobs that don't fit right away
+WAIT_FOR_SPACE = os.environ.get("STAGING_WAIT", "1") == "1"
+POLL_INTERVAL = 5  # seconds between re-checks while waiting
+
+class StagingFull(Exception):
+    """Raised when a job can't get the disk space it needs"""
+    pass
+
+class Reservation:
+    """
+    Disk space held for one job until `release` is called.
+    """
+    def __init__(self, user_id, nbytes):
+        self.user_id = user_id
+        self.nbytes = nbytes
+        self.released = False
+
+_reservations = []
+_changed = None  # asyncio.Event, created on first use inside the loop
+_checking = None  # asyncio.Lock: one reservation is checked and taken at a time
+
+def _staged_bytes():
+    """
+    Bytes allocated under the staging directory by running jobs, i.e. not
+    counting partial downloads kept idle for a resume. Walks the directory;
+    run it in a thread.
+    """
+    sizes = {}
+    stack = [DOWNLOADS_DIR]
+    while stack:
+        try:
+            entries = list(os.scandir(stack.pop()))
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    # st_blocks counts what is really allocated, which matters
+                    # for preallocated and sparse files
+                    sizes[entry.path] = entry.stat(follow_symlinks=False).st_blocks * 512
+            except FileNotFoundError:
+                pass
+    kept = 0
+    for path, nbytes in sizes.items():
+        target = path[:-len(STATE_SUFFIX)]
+        if path.endswith(STATE_SUFFIX) and not is_running(target):
+            kept += nbytes + sizes.get(target, 0)
+    return sum(sizes.values()) - kept
+
+async def available():
+    """
+    Bytes that new reservations may still claim. Files running jobs have
+    staged are assumed to belong to the current reservations, so they are
+    added back to the free space before the reservations are subtracted.
+    """
+    os.makedirs(DOWNLOADS_DIR, exist_ok=True)
+    free = psutil.disk_usage(DOWNLOADS_DIR).free
+    staged = await asyncio.to_thread(_staged_bytes)
+    reserved = sum(r.nbytes for r in _reservations)
+    return free + staged - reserved - HEADROOM
+
+def user_reserved(user_id):
+    """Bytes currently reserved by `user_id`"""
+    return sum(r.nbytes for r in _reservations if r.user_id == user_id)
+
+def _check_limits(user_id, nbytes):
+    """Rejects requests that could never fit, however long they wait"""
+    capacity = psutil.disk_usage(DOWNLOADS_DIR).total - HEADROOM
+    if nbytes > capacity:
+        raise StagingFull(f"Needs {humanbytes(nbytes)} but the disk only has room for {humanbytes(capacity)}")
+    if USER_QUOTA and nbytes > USER_QUOTA:
+        raise StagingFull(f"Needs {humanbytes(nbytes)}, above your {humanbytes(USER_QUOTA)} quota")
+
+async def _shortfall(user_id, nbytes):
+    """Why `nbytes` can't be reserved right now, or None if it fits"""
+    used = user_reserved(user_id)
+    if USER_QUOTA and used + nbytes > USER_QUOTA:
+        return f"your other jobs already use {humanbytes(used)} of your {humanbytes(USER_QUOTA)} quota"
+    free = await available()
+    if nbytes > free:
+        return f"{humanbytes(max(free, 0))} free, {humanbytes(nbytes)} needed"
+    return None
+
+async def reserve(user_id, nbytes, on_wait=None, should_cancel=None):
+    """
+    Reserves `nbytes` of staging space for a job of `user_id`.
+
+    :param nbytes: Expected bytes on disk at the job's peak; 0 or None
+                   means unknown and reserves UNKNOWN_SIZE.
+    :param on_wait: Optional coroutine function called with a reason text
+                    once, when the job has to wait for space.
+    :param should_cancel: Optional callable; if it returns True while
+                          waiting, DownloadCancelled is raised.
+    :return: A Reservation, to be passed to `release`.
+    :raises StagingFull: If the job can never fit, or doesn't fit now and
+                         STAGING_WAIT is off.
+    """
+    global _changed, _checking
+    if _changed is None:
+        _changed = asyncio.Event()
+        _checking = asyncio.Lock()
+    nbytes = nbytes or UNKNOWN_SIZE
+    _check_limits(user_id, nbytes)
+
+    waiting = False
+    while True:
+        # The walk awaits: without the lock two jobs could both see the same free space
+        async with _checking:
+            reason = await _shortfall(user_id, nbytes)
+            if reason is None:
+                reservation = Reservation(user_id, nbytes)
+                _reservations.append(reservation)
+                return reservation
+        if not WAIT_FOR_SPACE:
+            raise StagingFull(f"{reason}, try again later")
+        if should_cancel and should_cancel():
+            raise DownloadCancelled()
+        if not waiting:
+            waiting = True
+            log.info(f"User {user_id} waits for {humanbytes(nbytes)} of staging space: {reason}")
+            if on_wait:
+                await on_wait(reason)
+        _changed.clear()
+        try:
+            # Releases wake us up; the timeout catches space freed elsewhere
+            await asyncio.wait_for(_changed.wait(), timeout=POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+def release(reservation):
+    """Gives the space of `reservation` back. Safe to call twice or with None."""
+    if reservation is None or reservation.released:
+        return
+    reservation.released = True
+    _reservations.remove(reservation)
+    if _changed is not None:
+        _changed.set()
+
+def wait_text(reason):
+    """Status line shown while a job waits for disk space"""
+    return f"💾 **Waiting for disk space** — {reason}"
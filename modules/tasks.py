@@ -0,0 +1,166 @@
+#
+# This module is the task registry shared by /leech, /ytdl and /drive.
+# Every job is registered once and can be looked up by task id, user or
+# chat. Removing a task closes its entry in the job journal. Each task
+# carries a cancellation token:
+#
+#   - `is_cancelled` can be polled from progress callbacks and threads,
+#   - `token` is a threading.Event that worker threads can wait on,
+#   - callbacks added with `on_cancel` run right away (e.g. killing a
+#     subprocess), and the bound asyncio runner is cancelled, which closes
+#     its sockets and frees its scheduler slot within the next await.
+#
+
+import asyncio
+import logging
+import threading
+import uuid
+
+from . import journal
+
+log = logging.getLogger("tasks")
+
+class Task:
+    """
+    One running (or about to run) job.
+    """
+    def __init__(self, kind, user_id, chat_id, url, tid=None, **data):
+        self.tid = tid or str(uuid.uuid4())[:8]
+        self.kind = kind
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.url = url
+        self.msg_id = None
+        self.data = data  # Module-specific extras (e.g. no_cache, size hints)
+        self.token = threading.Event()
+        self._callbacks = []
+        self._runner = None
+        self._loop = None
+
+    def is_cancelled(self):
+        """True once the task has been cancelled. Safe to call from any thread."""
+        return self.token.is_set()
+
+    def bind(self, runner):
+        """
+        Attaches the asyncio task doing the work, so cancelling stops it at
+        its current await instead of waiting for the next progress callback.
+        """
+        self._runner = runner
+        self._loop = runner.get_loop()
+        if self.is_cancelled():
+            self._loop.call_soon_threadsafe(runner.cancel)
+        return runner
+
+    def on_cancel(self, callback):
+        """
+        Registers `callback()` to run when the task is cancelled (immediately
+        if it already is). Returns a function that unregisters it.
+        """
+        if self.is_cancelled():
+            callback()
+            return lambda: None
+        self._callbacks.append(callback)
+        return lambda: self._callbacks.remove(callback) if callback in self._callbacks else None
+
+    def cancel(self):
+        """Cancels the task. Safe to call twice and from any thread."""
+        if self.is_cancelled():
+            return
+        self.token.set()
+        log.info(f"Cancelling {self.kind} task {self.tid} of user {self.user_id}")
+        for callback in list(self._callbacks):
+            try:
+                callback()
+            except Exception as e:
+                log.error(f"Cancel callback of task {self.tid} failed: {e}")
+        if self._runner is not None and not self._runner.done():
+            self._loop.call_soon_threadsafe(self._runner.cancel)
+
+# ---------------- Registry ----------------
+_tasks = {}    # tid -> Task
+_by_user = {}  # user_id -> set of tids
+_by_chat = {}  # chat_id -> set of tids
+
+def register(kind, user_id, chat_id, url, tid=None, **data):
+    """
+    Creates and registers a new task.
+
+    :param tid: Task id to reuse, e.g. for a job resumed from the journal.
+    """
+    task = Task(kind, user_id, chat_id, url, tid, **data)
+    _tasks[task.tid] = task
+    _by_user.setdefault(user_id, set()).add(task.tid)
+    _by_chat.setdefault(chat_id, set()).add(task.tid)
+    return task
+
+def remove(task):
+    """Drops a finished task from the registry. Safe to call twice."""
+    if task is None or _tasks.pop(task.tid, None) is None:
+        return
+    journal.close(task)
+    for index, key in ((_by_user, task.user_id), (_by_chat, task.chat_id)):
+        tids = index.get(key)
+        if tids is not None:
+            tids.discard(task.tid)
+            if not tids:
+                index.pop(key)
+
+def get(tid, kind=None):
+    """The task with id `tid` (optionally only of `kind`), or None"""
+    task = _tasks.get(tid)
+    if task is not None and kind is not None and task.kind != kind:
+        return None
+    return task
+
+def of_user(user_id):
+    """All tasks of `user_id`"""
+    return [_tasks[tid] for tid in _by_user.get(user_id, ())]
+
+def of_chat(chat_id):
+    """All tasks started from `chat_id`"""
+    return [_tasks[tid] for tid in _by_chat.get(chat_id, ())]
+
+def count(user_id=None):
+    """Number of tasks, overall or of one user"""
+    return len(_tasks) if user_id is None else len(_by_user.get(user_id, ()))
+
+def _cancel(task):
+    task.cancel()
+    # Nothing started working on it yet (e.g. /ytdl waiting for a format
+    # choice), so no runner's finally will remove it
+    if task._runner is None:
+        remove(task)
+
+def cancel(tid):
+    """Cancels one task. Returns False if it doesn't exist."""
+    task = _tasks.get(tid)
+    if task is None:
+        return False
+    _cancel(task)
+    return True
+
+def cancel_user(user_id):
+    """Cancels every task of `user_id` and returns how many there were"""
+    user_tasks = of_user(user_id)
+    for task in user_tasks:
+        _cancel(task)
+    return len(user_tasks)
+
+async def to_thread(task, func, *args, **kwargs):
+    """
+    Like asyncio.to_thread, but if the caller is cancelled meanwhile it waits
+    for `func` to notice `task.token` and return before re-raising, so the
+    thread never keeps writing into files that cleanup is removing.
+    """
+    future = asyncio.ensure_future(asyncio.to_thread(func, *args, **kwargs))
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        if not task.is_cancelled():
+            task.cancel()
+        try:
+            await future
+        except BaseException:
+            pass
+        raise
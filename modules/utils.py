@@ -3,20 +3,37 @@
 import os
 import math
 import logging
-import asyncio
-from pyrogram.errors import FloodWait, MessageNotModified
 from pyrogram.types import Message
-from pymongo import MongoClient
+from pymongo import MongoClient, AsyncMongoClient
+
+from .edits import dispatcher as edit_dispatcher
 
 log = logging.getLogger("utils")
 
-# ------------------ MongoDB cookies collection ------------------
+# ------------------ MongoDB collections ------------------
 MONGO_URI = os.environ.get("MONGO_URI", "")
+MONGO_POOL_SIZE = int(os.environ.get("MONGO_POOL_SIZE", "10"))
 if MONGO_URI:
     client = MongoClient(MONGO_URI)
-    cookies_col = client["mongo_leech"]["cookies"]
+    file_cache_col = client["mongo_leech"]["file_cache"]
 else:
-    cookies_col = None  # In case MongoDB URI is not set
+    client = None
+    file_cache_col = None  # In case MongoDB URI is not set
+
+_async_client = None
+
+def async_db():
+    """
+    The bot's database through pymongo's asyncio client, for code running
+    on the event loop (one shared client, at most MONGO_POOL_SIZE
+    connections), or None if MONGO_URI is not set.
+    """
+    global _async_client
+    if not MONGO_URI:
+        return None
+    if _async_client is None:
+        _async_client = AsyncMongoClient(MONGO_URI, maxPoolSize=MONGO_POOL_SIZE)
+    return _async_client["mongo_leech"]
 
 # ------------------ Exception ------------------
 class DownloadCancelled(Exception):
@@ -57,26 +74,9 @@ def humanbytes(size):
 
 async def safe_edit_text(msg: Message, text: str, reply_markup=None):
     """
-    Edits a message with robust error handling for API flooding and message modification.
-    """
-    while True:
-        try:
-            await msg.edit_text(text, reply_markup=reply_markup)
-            break
-        except FloodWait as e:
-            log.warning(f"FloodWait: {e.value}s. Sleeping...")
-            await asyncio.sleep(e.value)
-        except MessageNotModified:
-            break
-        except Exception as e:
-            log.error(f"Failed to edit message: {e}")
-            break
-
-# ------------------ Cancel tasks ------------------
-def cancel_task(active_tasks):
-    """
-    Cancels all ongoing download/upload tasks.
-    Sets 'cancel' flag for each active task.
+    Queues an edit of `msg` on the shared edit dispatcher (see edits.py) and
+    returns at once. The dispatcher handles rate limits and FloodWait in the
+    background and only sends the newest text, so progress updates never
+    hold up the transfer that posts them.
     """
-    for tid in list(active_tasks.keys()):
-        active_tasks[tid]["cancel"] = True
+    edit_dispatcher.submit(msg, text, reply_markup)
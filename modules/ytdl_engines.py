@@ -0,0 +1,166 @@
+#
+# This module holds the download-engine settings for /ytdl. Out of the box
+# yt-dlp fetches HLS/DASH fragments one at a time and plain HTTP formats over
+# a single connection, which is very slow for long streams. Each job now
+# runs with one of these engines:
+#
+#   native  - yt-dlp's own downloaders with YTDL_FRAGMENTS fragments in
+#             flight and YTDL_HTTP_CHUNK_MB range requests for DASH formats
+#   aria2c  - the same for HLS/DASH, but plain HTTP(S)/FTP formats go to
+#             aria2c with YTDL_ARIA2C_CONNECTIONS connections (when installed)
+#
+# YTDL_ENGINE picks the default ("auto" uses aria2c when it is on PATH),
+# YTDL_SITE_ENGINES overrides it per site, e.g. "youtube.com=native", and
+# `/ytdl <url> --aria2c` or `--native` overrides both for one job.
+#
+# yt-dlp's aria2c downloader only reports when it is done, so it is replaced
+# by a subclass that reports progress through the usual progress hooks.
+#
+
+import os
+import time
+import shutil
+import logging
+import tempfile
+import subprocess
+from urllib.parse import urlparse
+from yt_dlp.downloader import external
+from yt_dlp.utils import Popen
+
+log = logging.getLogger("ytdl_engines")
+
+# ---------------- Tunables (overridable from the environment) ----------------
+ENGINE = os.environ.get("YTDL_ENGINE", "auto")  # auto, native or aria2c
+SITE_ENGINES = os.environ.get("YTDL_SITE_ENGINES", "")  # "domain=engine,domain=engine"
+FRAGMENTS = int(os.environ.get("YTDL_FRAGMENTS", "8"))
+HTTP_CHUNK_SIZE = int(os.environ.get("YTDL_HTTP_CHUNK_MB", "10")) * 1024 * 1024
+ARIA2C_CONNECTIONS = int(os.environ.get("YTDL_ARIA2C_CONNECTIONS", "16"))
+PROGRESS_INTERVAL = 1  # seconds between progress reports from aria2c downloads
+
+ENGINES = ("native", "aria2c")
+
+class Aria2cProgressFD(external.Aria2cFD):
+    """
+    yt-dlp's aria2c downloader, plus progress: while aria2c runs, the bytes
+    it has written are reported to the progress hooks like the native
+    downloader does, so cancelling from a hook also stops aria2c.
+    """
+    EXE_NAME = "aria2c"
+
+    def _call_downloader(self, tmpfilename, info_dict):
+        self._progress_file = tmpfilename
+        return super()._call_downloader(tmpfilename, info_dict)
+
+    def _call_process(self, cmd, info_dict):
+        if "fragments" in info_dict:
+            # One aria2c run per batch of fragments; nothing useful to poll
+            return super()._call_process(cmd, info_dict)
+
+        total = info_dict.get("filesize") or info_dict.get("filesize_approx")
+        started = time.time()
+        last = (started, 0)
+        with tempfile.TemporaryFile(mode="w+") as stderr:
+            # stderr goes to a file so a chatty aria2c can't fill the pipe while we poll
+            proc = Popen(cmd, text=True, stderr=stderr)
+            try:
+                while True:
+                    try:
+                        retval = proc.wait(timeout=PROGRESS_INTERVAL)
+                        break
+                    except subprocess.TimeoutExpired:
+                        last = self._report(info_dict, total, started, last)
+            except BaseException:
+                proc.kill(timeout=None)
+                raise
+            stderr.seek(0)
+            return None, stderr.read(), retval
+
+    def _report(self, info_dict, total, started, last):
+        try:
+            # aria2c writes segments at their offsets into a sparse file, so
+            # count allocated blocks rather than the apparent size
+            done = os.stat(self._progress_file).st_blocks * 512
+        except OSError:
+            done = 0
+        if total:
+            done = min(done, total)
+        now = time.time()
+        speed = (done - last[1]) / (now - last[0]) if now > last[0] else None
+        self._hook_progress({
+            "status": "downloading",
+            "downloaded_bytes": done,
+            "total_bytes" if info_dict.get("filesize") else "total_bytes_estimate": total,
+            "filename": info_dict.get("_filename") or self._progress_file,
+            "tmpfilename": self._progress_file,
+            "elapsed": now - started,
+            "speed": speed,
+            "eta": (total - done) / speed if total and speed else None,
+        }, info_dict)
+        return now, done
+
+# yt-dlp looks external downloaders up by name
+external._BY_NAME[Aria2cProgressFD.get_basename()] = Aria2cProgressFD
+
+def _site_engines():
+    engines = {}
+    for entry in SITE_ENGINES.split(","):
+        domain, _, engine = entry.strip().partition("=")
+        if domain and engine:
+            engines[domain.strip().lower()] = engine.strip().lower()
+    return engines
+
+def aria2c_available():
+    return shutil.which(Aria2cProgressFD.EXE_NAME) is not None
+
+def split_engine_flag(text):
+    """
+    Removes an engine flag (--native, --aria2c) from a command argument string.
+
+    :return: (remaining text, the engine named by the flag or None)
+    """
+    words = text.split()
+    flags = [w for w in words if w[2:] in ENGINES and w.startswith("--")]
+    if not flags:
+        return text.strip(), None
+    return " ".join(w for w in words if w not in flags), flags[-1][2:]
+
+def engine_for(url, requested=None):
+    """
+    The engine a job for `url` runs with: `requested` if given, else the
+    site's entry in YTDL_SITE_ENGINES, else YTDL_ENGINE. aria2c falls back
+    to native when it isn't installed.
+    """
+    engine = requested
+    if engine is None:
+        host = (urlparse(url).hostname or "").lower()
+        for domain, site_engine in _site_engines().items():
+            if host == domain or host.endswith("." + domain):
+                engine = site_engine
+                break
+    engine = (engine or ENGINE).lower()
+    if engine == "auto":
+        engine = "aria2c" if aria2c_available() else "native"
+    if engine not in ENGINES:
+        log.warning(f"Unknown yt-dlp engine '{engine}', using native")
+        engine = "native"
+    if engine == "aria2c" and not aria2c_available():
+        log.warning("aria2c is not installed, using the native engine")
+        engine = "native"
+    return engine
+
+def engine_opts(engine):
+    """yt-dlp options for `engine`"""
+    opts = {
+        "concurrent_fragment_downloads": FRAGMENTS,
+        "http_chunk_size": HTTP_CHUNK_SIZE,
+    }
+    if engine == "aria2c":
+        name = Aria2cProgressFD.get_basename()
+        # Only single-file HTTP(S)/FTP formats; HLS/DASH stay native with concurrent fragments
+        opts["external_downloader"] = {"http": name, "ftp": name}
+        opts["external_downloader_args"] = {name: [
+            f"--max-connection-per-server={ARIA2C_CONNECTIONS}",
+            f"--split={ARIA2C_CONNECTIONS}",
+            "--min-split-size=1M",
+        ]}
+    return opts
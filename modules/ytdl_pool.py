@@ -0,0 +1,232 @@
+#
+# This module keeps warm yt-dlp instances. Building a YoutubeDL loads the
+# extractor list, the cookie jar and (on first request) the HTTP opener, and
+# every site's extractor is set up again on first use; /ytdl used to pay all
+# of that on each format listing and each download.
+#
+# Instances are pooled per option profile and cookie file. A job checks one
+# out, gets its own format, output template and progress/postprocessor
+# hooks on top of the profile, and on return the instance is reset to the profile's state. An
+# instance is retired after YTDL_POOL_MAX_USES jobs, after any job that
+# raised, and when the cookie file behind it changes. The pool is used from
+# worker threads.
+#
+# The reset doesn't name yt-dlp's private per-job fields (download counters,
+# seen playlist URLs...), which change between releases. Every plain-data
+# attribute of the fresh instance is snapshotted and put back, and plain
+# data a job added is dropped; only the caches in _KEEP survive a job.
+#
+
+import os
+import copy
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+import yt_dlp
+
+from .info_cache import cookie_identity
+
+log = logging.getLogger("ytdl_pool")
+
+# ---------------- Tunables (overridable from the environment) ----------------
+POOL_SIZE = int(os.environ.get("YTDL_POOL_SIZE", "4"))        # idle instances kept per profile
+MAX_USES = int(os.environ.get("YTDL_POOL_MAX_USES", "25"))    # jobs before an instance is rebuilt
+MAX_PROFILES = int(os.environ.get("YTDL_POOL_PROFILES", "16"))  # (profile, cookies) keys kept
+WARM_EXTRACTORS = ("Youtube", "Generic")  # set up ahead of the first job by warm()
+
+# YoutubeDL attributes that are plain data yet not per-job state: params and
+# format_selector are restored on their own, the rest are extractor caches
+_KEEP = {"params", "format_selector", "_ies", "_ies_instances"}
+
+def _is_data(value):
+    """True for values made only of builtin scalars and containers"""
+    if value is None or isinstance(value, (bool, int, float, str, bytes)):
+        return True
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return all(_is_data(v) for v in value)
+    if isinstance(value, dict):
+        return all(_is_data(k) and _is_data(v) for k, v in value.items())
+    return False
+
+class _Pooled:
+    """
+    A YoutubeDL plus what is needed to put it back in its profile's state.
+    """
+    def __init__(self, key, opts, cookies):
+        self.key = key
+        self.uses = 0
+        self.hook = None     # progress hook of the current job
+        self.pp_hook = None  # postprocessor hook of the current job
+        self.ydl = yt_dlp.YoutubeDL({**opts, "cookiefile": cookies or None})
+        # Permanent hooks that forward to whichever job has the instance
+        self.ydl.add_progress_hook(self._forward)
+        self.ydl.add_postprocessor_hook(self._forward_pp)
+        self.params = self._snapshot()
+        self.format_selector = self.ydl.format_selector
+        self.state = {
+            name: copy.deepcopy(value) for name, value in vars(self.ydl).items()
+            if name not in _KEEP and _is_data(value)
+        }
+
+    def _forward(self, d):
+        if self.hook is not None:
+            self.hook(d)
+
+    def _forward_pp(self, d):
+        if self.pp_hook is not None:
+            self.pp_hook(d)
+
+    def _snapshot(self):
+        params = dict(self.ydl.params)
+        params["outtmpl"] = dict(params["outtmpl"])
+        return params
+
+    def prepare(self, format=None, outtmpl=None, progress_hook=None, postprocessor_hook=None):
+        """Applies the settings of one job"""
+        if format is not None:
+            self.ydl.params["format"] = format
+            self.ydl.format_selector = self.ydl.build_format_selector(format)
+        if outtmpl is not None:
+            self.ydl.params["outtmpl"]["default"] = outtmpl
+        self.hook = progress_hook
+        self.pp_hook = postprocessor_hook
+        self.uses += 1
+
+    def reset(self):
+        """Undoes everything a job changed"""
+        self.hook = None
+        self.pp_hook = None
+        self.ydl.params.clear()
+        self.ydl.params.update(self._restore())
+        attrs = vars(self.ydl)
+        for name in [n for n, v in attrs.items() if n not in _KEEP and n not in self.state and _is_data(v)]:
+            del attrs[name]
+        for name, value in self.state.items():
+            attrs[name] = copy.deepcopy(value)
+        self.ydl.format_selector = self.format_selector
+        if not self.ydl.params.get("cookiefile"):
+            # Without a cookie file the jar is shared by all users: don't
+            # let one job's site cookies leak into the next
+            self.ydl.cookiejar.clear()
+
+    def _restore(self):
+        params = dict(self.params)
+        params["outtmpl"] = dict(params["outtmpl"])
+        return params
+
+    def close(self):
+        # Pooled instances never write the cookie file back: it belongs to
+        # the user, who may have replaced it meanwhile
+        self.ydl.params["cookiefile"] = None
+        try:
+            self.ydl.close()
+        except Exception as e:
+            log.error(f"Failed to close yt-dlp instance: {e}")
+
+class YtdlPool:
+    """
+    Idle YoutubeDL instances keyed by (profile, cookie file, its contents).
+    """
+    def __init__(self, size=POOL_SIZE, max_uses=MAX_USES, max_profiles=MAX_PROFILES):
+        self.size = size
+        self.max_uses = max_uses
+        self.max_profiles = max_profiles
+        self.idle = OrderedDict()  # key -> list of _Pooled
+        self._lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+
+    @staticmethod
+    def _key(profile, cookies):
+        cookies = cookies if cookies and os.path.exists(cookies) else None
+        return (profile, cookies, cookie_identity(cookies)), cookies
+
+    def _take(self, key, opts, cookies):
+        stale = []
+        with self._lock:
+            # Instances built from an older version of the same cookie file
+            for other in [k for k in self.idle if k[:2] == key[:2] and k != key]:
+                stale.extend(self.idle.pop(other))
+            free = self.idle.get(key)
+            pooled = free.pop() if free else None
+            if pooled is not None:
+                self.idle.move_to_end(key)
+                self.reused += 1
+            else:
+                self.created += 1
+        for old in stale:
+            old.close()
+        # Building one takes a while; don't hold up other threads meanwhile
+        return pooled or _Pooled(key, opts, cookies)
+
+    def _give_back(self, pooled, broken):
+        retire = broken or pooled.uses >= self.max_uses
+        if not retire:
+            try:
+                pooled.reset()
+            except Exception as e:
+                log.error(f"Failed to reset yt-dlp instance: {e}")
+                retire = True
+        evicted = []
+        with self._lock:
+            if not retire:
+                free = self.idle.setdefault(pooled.key, [])
+                self.idle.move_to_end(pooled.key)
+                if len(free) < self.size:
+                    free.append(pooled)
+                    pooled = None
+            while len(self.idle) > self.max_profiles:
+                evicted.extend(self.idle.popitem(last=False)[1])
+        if pooled is not None:
+            evicted.append(pooled)
+        for old in evicted:
+            old.close()
+
+    @contextmanager
+    def checkout(self, profile, opts, cookies=None, format=None, outtmpl=None, progress_hook=None,
+                 postprocessor_hook=None):
+        """
+        Lends a warm YoutubeDL set up with `opts` (the profile, identical for
+        every use of `profile`) and the per-job `format`, `outtmpl`,
+        `progress_hook` and `postprocessor_hook`. Must not be kept after the
+        with block.
+        """
+        key, cookies = self._key(profile, cookies)
+        pooled = self._take(key, opts, cookies)
+        broken = True
+        try:
+            pooled.prepare(format, outtmpl, progress_hook, postprocessor_hook)
+            yield pooled.ydl
+            broken = False
+        finally:
+            self._give_back(pooled, broken)
+
+    def warm(self, profile, opts, cookies=None, count=1, extractors=WARM_EXTRACTORS):
+        """
+        Builds `count` instances of a profile ahead of time, with the HTTP
+        opener and the common extractors already set up.
+        """
+        key, cookies = self._key(profile, cookies)
+        start = time.perf_counter()
+        ready = []
+        for _ in range(count):
+            pooled = _Pooled(key, opts, cookies)
+            pooled.ydl._request_director
+            for ie_key in extractors:
+                pooled.ydl.get_info_extractor(ie_key)
+            ready.append(pooled)
+        with self._lock:
+            self.idle.setdefault(key, []).extend(ready)
+        log.info(f"Warmed {count} yt-dlp instance(s) for '{profile}' in {time.perf_counter() - start:.2f}s")
+
+    def close(self):
+        """Closes every idle instance"""
+        with self._lock:
+            idle, self.idle = self.idle, OrderedDict()
+        for free in idle.values():
+            for pooled in free:
+                pooled.close()
+
+pool = YtdlPool()
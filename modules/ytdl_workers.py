@@ -0,0 +1,265 @@
+#
+# This module runs yt-dlp jobs in worker processes. In a thread, yt-dlp's
+# extraction, format sorting and progress hooks hold the GIL and slow down
+# the event loop that serves every other user, and a stuck extractor can
+# only be abandoned. With YTDL_ISOLATION=process, list_formats and
+# download_media run in one of YTDL_WORKERS child processes instead:
+#
+#   - jobs and results travel as length-prefixed pickles over the child's
+#     stdin/stdout, progress hook events are streamed back the same way
+#     (YTDL_WORKER_HOOK_INTERVAL apart at most) and replayed into the
+#     caller's hook on the event loop,
+#   - cancelling a job kills its worker's process group, so ffmpeg and
+#     aria2c children die with it; a fresh worker is started on demand,
+#   - extraction results travel with the jobs, so the info cache still
+#     spares the download a second extraction,
+#   - workers are recycled after YTDL_WORKER_MAX_JOBS jobs,
+#   - format listings get their own YTDL_LIST_WORKERS workers, so running
+#     downloads never hold up a /ytdl prompt, and a listing that takes
+#     longer than YTDL_LIST_TIMEOUT is killed.
+#
+# The default, YTDL_ISOLATION=thread, keeps everything in the bot process.
+#
+
+import os
+import sys
+import time
+import pickle
+import signal
+import struct
+import asyncio
+import logging
+
+from .utils import DownloadCancelled
+from . import info_cache
+
+log = logging.getLogger("ytdl_workers")
+
+# ---------------- Tunables (overridable from the environment) ----------------
+ISOLATION = os.environ.get("YTDL_ISOLATION", "thread")  # thread or process
+WORKERS = int(os.environ.get("YTDL_WORKERS", "4"))
+LIST_WORKERS = int(os.environ.get("YTDL_LIST_WORKERS", "2"))
+LIST_TIMEOUT = float(os.environ.get("YTDL_LIST_TIMEOUT", "120"))  # seconds
+MAX_JOBS = int(os.environ.get("YTDL_WORKER_MAX_JOBS", "50"))
+HOOK_INTERVAL = float(os.environ.get("YTDL_WORKER_HOOK_INTERVAL", "0.5"))  # seconds
+
+# Progress hook fields sent to the parent (the rest, e.g. info_dict, isn't picklable)
+HOOK_KEYS = (
+    "status", "downloaded_bytes", "total_bytes", "total_bytes_estimate", "filename",
+    "tmpfilename", "elapsed", "speed", "eta", "fragment_index", "fragment_count",
+    "_percent_str", "_speed_str", "_eta_str", "_total_bytes_str", "_downloaded_bytes_str",
+)
+_HEADER = struct.Struct("!I")
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class WorkerError(Exception):
+    """A job failed in a worker process, or the worker died"""
+    pass
+
+# ---------------- Parent side ----------------
+class _Worker:
+    """One child process and its pipes"""
+    def __init__(self, proc):
+        self.proc = proc
+        self.jobs = 0
+
+    @classmethod
+    async def start(cls):
+        env = {**os.environ, "MONGO_URI": "", "PYTHONPATH": os.pathsep.join(
+            p for p in (_ROOT, os.environ.get("PYTHONPATH")) if p)}
+        proc = await asyncio.create_subprocess_exec(
+            sys.executable, "-m", "modules.ytdl_workers",
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+            env=env, start_new_session=True,  # its own process group, see `kill`
+        )
+        return cls(proc)
+
+    @property
+    def alive(self):
+        return self.proc.returncode is None
+
+    async def send(self, message):
+        data = pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+        self.proc.stdin.write(_HEADER.pack(len(data)) + data)
+        await self.proc.stdin.drain()
+
+    async def recv(self):
+        size, = _HEADER.unpack(await self.proc.stdout.readexactly(_HEADER.size))
+        return pickle.loads(await self.proc.stdout.readexactly(size))
+
+    def kill(self):
+        """Kills the worker and everything it started. Safe to call from any thread."""
+        if not self.alive:
+            return
+        try:
+            os.killpg(self.proc.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError, AttributeError):
+            self.proc.kill()
+
+class WorkerPool:
+    """
+    Up to `size` worker processes, started on demand and kept between jobs.
+    """
+    def __init__(self, size=WORKERS, max_jobs=MAX_JOBS):
+        self.size = size
+        self.max_jobs = max_jobs
+        self._idle = []
+        self._busy = set()
+        self._limit = None
+        self.started = 0
+
+    async def run(self, call, args, progress_hook=None, task=None, timeout=None):
+        """
+        Runs `call` (a name in _CALLS) with `args` in a worker.
+
+        :param progress_hook: Optional yt-dlp style hook, called on the event
+                              loop with each progress event; raising from it
+                              (e.g. DownloadCancelled) kills the job.
+        :param task: The tasks.Task of the job; cancelling it kills the worker.
+        :param timeout: Optional seconds after which the worker is killed.
+        :raises WorkerError: With the job's error message, or on timeout.
+        """
+        if self._limit is None:
+            self._limit = asyncio.Semaphore(self.size)
+        async with self._limit:
+            worker = None
+            while self._idle and worker is None:
+                worker = self._idle.pop()
+                if not worker.alive:
+                    worker = None
+            if worker is None:
+                worker = await _Worker.start()
+                self.started += 1
+
+            clean = False
+            self._busy.add(worker)
+            unregister = task.on_cancel(worker.kill) if task else (lambda: None)
+            try:
+                async with asyncio.timeout(timeout):
+                    await worker.send((call, args))
+                    while True:
+                        kind, payload = await worker.recv()
+                        if kind == "progress":
+                            if progress_hook:
+                                progress_hook(payload)
+                            continue
+                        clean = True
+                        if kind == "cancelled":
+                            raise DownloadCancelled()
+                        if kind == "error":
+                            raise WorkerError(payload)
+                        return payload
+            except TimeoutError:
+                raise WorkerError(f"yt-dlp took longer than {timeout:.0f}s")
+            except (asyncio.IncompleteReadError, ConnectionError):
+                if task and task.is_cancelled():
+                    raise DownloadCancelled()
+                raise WorkerError("The yt-dlp worker process exited unexpectedly")
+            finally:
+                unregister()
+                self._busy.discard(worker)
+                worker.jobs += 1
+                if clean and worker.alive and worker.jobs < self.max_jobs:
+                    self._idle.append(worker)
+                else:
+                    worker.kill()
+                    if worker.proc.stdin:
+                        worker.proc.stdin.close()
+                    await worker.proc.wait()
+
+    async def close(self):
+        """Stops the idle workers and kills busy ones, e.g. on shutdown"""
+        for worker in list(self._busy):
+            worker.kill()
+        while self._idle:
+            worker = self._idle.pop()
+            worker.proc.stdin.close()
+            await worker.proc.wait()
+
+pool = WorkerPool()
+list_pool = WorkerPool(size=LIST_WORKERS)
+
+async def close():
+    """Stops every worker process; call it on shutdown"""
+    await pool.close()
+    await list_pool.close()
+
+async def list_formats(url, cookies=None, task=None, timeout=LIST_TIMEOUT):
+    """ytdlp.list_formats in a worker process, killed after `timeout` seconds"""
+    result, info = await list_pool.run("list_formats", (url, cookies, info_cache.get(url, cookies)),
+                                       task=task, timeout=timeout)
+    if info is not None:
+        info_cache.put(url, cookies, info)
+    return result
+
+async def download_media(task, url, path, cookies, progress_hook, fmt_id, engine=None):
+    """ytdlp.download_media in a worker process"""
+    return await pool.run("download_media", (url, path, cookies, fmt_id, engine, info_cache.get(url, cookies)),
+                          progress_hook, task)
+
+# ---------------- Child side ----------------
+def _child_list_formats(send, url, cookies, info):
+    from .ytdlp import list_formats
+    if info is not None:
+        info_cache.put(url, cookies, info)
+    result = list_formats(url, cookies)
+    return result, info_cache.get(url, cookies)
+
+def _child_download_media(send, url, path, cookies, fmt_id, engine, info):
+    from .ytdlp import download_media
+    if info is not None:
+        info_cache.put(url, cookies, info)
+    last = 0
+
+    def hook(d):
+        nonlocal last
+        now = time.monotonic()
+        if d.get("status") == "downloading" and now - last < HOOK_INTERVAL:
+            return
+        last = now
+        send(("progress", {k: d[k] for k in HOOK_KEYS if k in d}))
+
+    return download_media(url, path, cookies, hook, fmt_id, engine)
+
+_CALLS = {
+    "list_formats": _child_list_formats,
+    "download_media": _child_download_media,
+}
+
+def _serve():
+    """Worker main loop: one job at a time until stdin closes"""
+    # Protocol frames own the real stdout; stray prints go to stderr
+    out = os.fdopen(os.dup(1), "wb")
+    os.dup2(2, 1)
+    sys.stdout = sys.stderr
+    inp = sys.stdin.buffer
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    def send(message):
+        data = pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+        out.write(_HEADER.pack(len(data)) + data)
+        out.flush()
+
+    from .ytdlp import warm_ytdl_pool
+    warm_ytdl_pool()
+    while True:
+        header = inp.read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            return
+        call, args = pickle.loads(inp.read(_HEADER.unpack(header)[0]))
+        try:
+            send(("result", _CALLS[call](send, *args)))
+        except DownloadCancelled:
+            send(("cancelled", None))
+        except Exception as e:
+            # yt-dlp wraps exceptions raised by hooks in a DownloadError
+            exc_info = getattr(e, "exc_info", None)
+            if exc_info and isinstance(exc_info[1], DownloadCancelled):
+                send(("cancelled", None))
+            else:
+                log.error(f"{call} failed in worker {os.getpid()}: {e}")
+                send(("error", str(e)))
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="[ytdl-worker %(process)d] %(levelname)s:%(name)s:%(message)s")
+    _serve()
@@ -4,7 +4,6 @@
 #
 
 import os
-import uuid
 import logging
 import asyncio
 import time
@@ -15,16 +14,34 @@ from pyrogram.errors import FloodWait, RPCError
 
 # Assuming these imports are correct based on your project structure.
 from .utils import data_paths, ensure_dirs, humanbytes, DownloadCancelled, safe_edit_text
-from .file_splitter import split_file
-import yt_dlp
+from .edits import dispatcher as edit_dispatcher
+from .file_splitter import FileRange, file_ranges
+from .part_uploader import upload_parts, progress_text
+from . import file_cache, singleflight
+from .scheduler import scheduler, queue_text, priority_for
+from . import staging, tasks, info_cache, remux, format_select, ytdl_workers, cookie_store, journal
+from .ytdl_pool import pool as ytdl_pool
+from .ytdl_engines import engine_for, engine_opts, split_engine_flag
 from yt_dlp.utils import DownloadError
 
 log = logging.getLogger("ytdl")
-ACTIVE_TASKS = {} # This is now for ytdl tasks
 
 # ---------------- Telegram-safe split size ----------------
 MAX_SIZE = 1900 * 1024 * 1024 # 1900 MiB ≈ 1.86 GiB
 
+# ---------------- yt-dlp option profiles (pooled instances) ----------------
+LIST_OPTS = {
+    "quiet": True,
+    "skip_download": True,
+    "noplaylist": True, # Ensure we don't process playlists
+}
+DOWNLOAD_OPTS = {}
+# Merges copy the streams into mp4 when the codecs allow it, else into mkv;
+# remux.finish handles the rest without re-encoding unless asked to.
+MERGE_OPTS = {
+    "merge_output_format": remux.MERGE_FORMATS,
+}
+
 def cancel_btn(tid):
     """
     Creates an inline keyboard markup with a single "Cancel" button.
@@ -54,16 +71,18 @@ def register_ytdl_handlers(app: Client):
         if len(args) < 2:
             return await m.reply("Usage: `/ytdl <video URL>`")
 
-        url = args[1].strip()
+        text, engine = split_engine_flag(args[1])
+        url, no_cache = file_cache.split_bypass_flag(text)
+        if not url:
+            return await m.reply("Usage: `/ytdl <video URL>`")
         user_id = m.from_user.id
-        paths = data_paths(user_id)
         ensure_dirs()
 
         msg = await m.reply("🔍 Fetching formats…")
 
         try:
-            # Use asyncio.to_thread to run the blocking list_formats function
-            fmts = await asyncio.to_thread(list_formats, url, paths["cookies"])
+            # list_formats blocks, so it runs in a thread or a worker process
+            fmts, plan = await fetch_formats(url, await cookie_store.path_for(user_id))
         except Exception as e:
             return await msg.edit(f"❌ Error fetching formats: {e}")
 
@@ -91,8 +110,26 @@ def register_ytdl_handlers(app: Client):
         # --------------------------------------------------------------------------
 
         # Create a unique ID for the task and store it
-        tid = str(uuid.uuid4())[:8]
-        ACTIVE_TASKS[tid] = {"user_id": user_id, "url": url, "msg_id": msg.id, "cancel": False}
+        task = tasks.register("ytdl", user_id, m.chat.id, url, no_cache=no_cache, engine=engine)
+        task.msg_id = msg.id
+        tid = task.tid
+
+        # Expected size per button (video + audio for merged ones), used by
+        # the scheduler to order queued jobs and shown on the buttons
+        sizes = {f["id"]: f.get("size", 0) for f in fmts}
+        sizes.update(plan["merged"])
+        fit = plan["fit"]
+        if fit:
+            task.data["fit_format"] = fit["format"]
+            sizes[fit["format"]] = fit["size"]
+        task.data["sizes"] = sizes
+
+        def merged_label(text, button):
+            size = sizes.get(button, 0)
+            if not size:
+                return text
+            # Above MAX_SIZE it gets split into document parts
+            return f"{text} • {humanbytes(size)}{' ✂️' if size > MAX_SIZE else ''}"
 
         kb = []
         row = []
@@ -112,15 +149,19 @@ def register_ytdl_handlers(app: Client):
         
         # --- Add new custom quality buttons based on availability ---
         if has_360p:
-            kb.append([InlineKeyboardButton("🎬 Low Quality (360p + audio)", callback_data=f"choose_ytdl:{tid}:merged_360p")])
+            kb.append([InlineKeyboardButton(merged_label("🎬 Low Quality (360p + audio)", "merged_360p"), callback_data=f"choose_ytdl:{tid}:merged_360p")])
         if has_480p:
-            kb.append([InlineKeyboardButton("🎬 Low Quality (480p + audio)", callback_data=f"choose_ytdl:{tid}:merged_480p")])
+            kb.append([InlineKeyboardButton(merged_label("🎬 Low Quality (480p + audio)", "merged_480p"), callback_data=f"choose_ytdl:{tid}:merged_480p")])
         if has_720p:
-            kb.append([InlineKeyboardButton("🎬 Normal Quality (720p + audio)", callback_data=f"choose_ytdl:{tid}:merged_720p")])
+            kb.append([InlineKeyboardButton(merged_label("🎬 Normal Quality (720p + audio)", "merged_720p"), callback_data=f"choose_ytdl:{tid}:merged_720p")])
         if has_1080p:
-            kb.append([InlineKeyboardButton("🎬 Best Quality (1080p + audio)", callback_data=f"choose_ytdl:{tid}:merged_1080p")])
+            kb.append([InlineKeyboardButton(merged_label("🎬 Best Quality (1080p + audio)", "merged_1080p"), callback_data=f"choose_ytdl:{tid}:merged_1080p")])
         if max_res_fmt:
-            kb.append([InlineKeyboardButton(f"🎬 Highest Quality ({max_res_fmt.get('res')}p + audio)", callback_data=f"choose_ytdl:{tid}:merged_max")])
+            kb.append([InlineKeyboardButton(merged_label(f"🎬 Highest Quality ({max_res_fmt.get('res')}p + audio)", "merged_max"), callback_data=f"choose_ytdl:{tid}:merged_max")])
+        # Best quality that is still sent as one streamable video, unless
+        # the highest quality already fits
+        if fit and not 0 < sizes.get("merged_max", 0) <= MAX_SIZE:
+            kb.append([InlineKeyboardButton(f"🎯 Best under {humanbytes(MAX_SIZE)} ({fit['res']}p • {humanbytes(fit['size'])})", callback_data=f"choose_ytdl:{tid}:best_fit")])
         # --------------------------------------------------------------------
 
         await msg.edit("🎞 Choose quality:", reply_markup=InlineKeyboardMarkup(kb))
@@ -131,221 +172,349 @@ def register_ytdl_handlers(app: Client):
         Handles the callback query when a user chooses a format.
         """
         tid, fmt = q.data.split(":")[1:]
-        task_info = ACTIVE_TASKS.get(tid)
-        if not task_info:
+        task = tasks.get(tid, "ytdl")
+        if not task:
             return await q.answer("❌ Task not found or expired.", show_alert=True)
+        if fmt == "best_fit":
+            # The video+audio pair picked when the formats were listed
+            fmt = task.data["fit_format"]
+        if task.data.get("started"):
+            return await q.answer("⏳ This download is already running.")
+        task.data["started"] = True
+
+        url = task.url
+
+        # The same URL + format delivered before is resent by file_id
+        key = file_cache.cache_key("ytdl", url, fmt)
+        if not task.data.get("no_cache") and await file_cache.send_cached(app, q.message.chat.id, key):
+            tasks.remove(task)
+            return await q.message.edit("✅ Sent from cache.")
+
+        # Someone else is already downloading this URL + format: share it.
+        # Otherwise claim it before the first await, so an identical
+        # request arriving meanwhile follows this one.
+        running = singleflight.find(key)
+        if running:
+            tasks.remove(task)
+            asyncio.create_task(singleflight.follow(app, running, q.message.chat.id, q.message))
+            return await q.answer("🔗 Attached to a running download.")
+        flight = singleflight.lead(key, q.message)
+
+        # Recorded in the journal, so a restart resumes with the same choice
+        task.data["format"] = fmt
+        task.data["size"] = task.data.get("sizes", {}).get(fmt, 0)
+        try:
+            st = await q.message.edit("⏳ Preparing download…", reply_markup=cancel_btn(tid))
+        except BaseException as e:
+            singleflight.release(flight, e)
+            tasks.remove(task)
+            raise
+        await start_download(app, task, st, flight)
+
+    @app.on_callback_query(filters.regex(r"^cancel_ytdl:(.+)$"))
+    async def cancel_ytdl_cb(_, q):
+        """
+        Handles the "Cancel" button click.
+        """
+        tid = q.data.split(":")[1]
+        task = tasks.get(tid, "ytdl")
+        if task and task.user_id == q.from_user.id:
+            tasks.cancel(tid)
+            await q.answer("⛔ Task cancelled.", show_alert=True)
+        elif task:
+            await q.answer("❌ Only the user who started this task can cancel it.", show_alert=True)
+        else:
+            await q.answer("❌ Task not found.", show_alert=True)
 
-        url = task_info["url"]
-        user_id = task_info["user_id"]
-        paths = data_paths(user_id)
+@journal.resumer("ytdl")
+async def start_download(app, task, st, flight=None):
+    """
+    Downloads the format chosen for a /ytdl task (task.data["format"]) and
+    uploads it, reporting into the status message `st`. Also resumes ytdl
+    jobs left unfinished by a restart.
 
-        st = await q.message.edit("⏳ Preparing download…", reply_markup=cancel_btn(tid))
+    :param flight: The singleflight.Flight the caller leads for this URL and
+                   format. Without one (a resumed job) the task leads a new
+                   flight, or follows the one already running.
+    """
+    url = task.url
+    user_id = task.user_id
+    chat_id = task.chat_id
+    tid = task.tid
+    fmt = task.data["format"]
+    paths = data_paths(user_id)
+    key = file_cache.cache_key("ytdl", url, fmt)
+    journal.track(task)
+    if flight is None:
+        running = singleflight.find(key)
+        if running:
+            task.bind(asyncio.create_task(singleflight.follow_task(app, running, task, st)))
+            return
+        flight = singleflight.lead(key, st)
 
-        class ProgressUpdater:
-            """
-            Manages the queue-based progress bar updates for the message.
-            This avoids flooding the Telegram API with too many edits.
-            """
-            def __init__(self, msg, url):
-                self.msg = msg
-                self.url = url
-                self.queue = asyncio.Queue()
-                self.last_update = 0
-                self.last_uploaded_bytes = 0
-                self.last_downloaded_bytes = 0
-                self.start_time = time.time()
-                self.task = None
-
-            def start(self):
-                self.task = asyncio.create_task(self.updater_task())
-
-            def stop(self):
-                if self.task and not self.task.done():
-                    self.task.cancel()
-
-            async def updater_task(self):
-                try:
-                    while True:
-                        text = await self.queue.get()
-                        await safe_edit_text(self.msg, f"{text}\n\n`{self.url}`", reply_markup=cancel_btn(tid))
-                        self.queue.task_done()
-                except asyncio.CancelledError:
-                    pass
-
-            def progress_hook(self, d):
-                """
-                A hook function for yt-dlp to send progress updates.
-                """
-                # Check for cancellation before processing
-                if ACTIVE_TASKS.get(tid, {}).get("cancel"):
-                    log.info(f"Cancellation detected during download for task {tid}. Raising exception.")
-                    raise DownloadCancelled() # Re-raise our custom exception
-
-                if d["status"] == "downloading":
-                    now = time.time()
-                    # Only update every 3 seconds to avoid FloodWait errors
-                    if now - self.last_update < 3:
-                        return
-
-                    pct_str = d.get("_percent_str", "").strip()
-                    if not pct_str:
-                          return
-
-                    pct = float(clean_ansi_codes(pct_str).replace('%', ''))
-                    downloaded = d.get("downloaded_bytes", 0)
-                    total = d.get("total_bytes") or d.get("total_bytes_estimate") or 0
-
-                    download_speed = clean_ansi_codes(d.get("_speed_str", "N/A")).strip()
-                    eta = clean_ansi_codes(d.get("_eta_str", "N/A")).strip()
-
-                    # Construct the progress message using the custom progress bar
-                    progress_text = f"**Downloading**:\n"
-                    progress_text += f"**File:** `{clean_ansi_codes(d.get('filename', 'Unknown File'))}`\n"
-
-                    bar = get_progress_bar(pct)
-
-                    progress_text += f"{bar} **{pct:.1f}%**\n"
-                    progress_text += f"**Size:** {humanbytes(downloaded)} / {humanbytes(total)}\n"
-                    progress_text += f"**Speed:** {download_speed} • **ETA:** {eta}"
-
-                    self.queue.put_nowait(progress_text)
-                    self.last_update = now
-
-        async def runner():
+    class ProgressUpdater:
+        """
+        Posts progress frames for the status message to the shared edit
+        dispatcher, which rate-limits them and drops stale ones. `post`
+        is safe to call from yt-dlp's download thread and from Pyrogram's
+        progress executor.
+        """
+        def __init__(self, msg, url):
+            self.msg = msg
+            self.url = url
+            self.loop = asyncio.get_running_loop()
+            self.last_update = 0
+            self.last_uploaded_bytes = 0
+            self.last_downloaded_bytes = 0
+            self.start_time = time.time()
+            self.closed = False
+
+        def stop(self):
+            # Frames from a finished task must not overwrite its final status
+            self.closed = True
+
+        def post(self, text):
+            self.loop.call_soon_threadsafe(self._submit, text)
+
+        def _submit(self, text):
+            if not self.closed:
+                edit_dispatcher.submit(self.msg, f"{text}\n\n`{self.url}`", reply_markup=cancel_btn(tid))
+
+        def progress_hook(self, d):
             """
-            The main coroutine to handle the entire download and upload process.
+            A hook function for yt-dlp to send progress updates.
             """
-            fpaths = []
-            updater = ProgressUpdater(st, url)
-            updater.start()
+            # Check for cancellation before processing
+            if task.is_cancelled():
+                log.info(f"Cancellation detected during download for task {tid}. Raising exception.")
+                raise DownloadCancelled() # Re-raise our custom exception
 
-            try:
-                # Part 1: Download Media
-                await st.edit("✅ Download starting...", reply_markup=cancel_btn(tid))
-                full_path, fname = await asyncio.to_thread(
-                    download_media, url, paths["downloads"], paths["cookies"], updater.progress_hook, fmt
-                )
+            if d["status"] == "downloading":
+                now = time.time()
+                # Only update every 3 seconds to avoid FloodWait errors
+                if now - self.last_update < 3:
+                    return
+
+                pct_str = d.get("_percent_str", "").strip()
+                if not pct_str:
+                      return
+
+                pct = float(clean_ansi_codes(pct_str).replace('%', ''))
+                downloaded = d.get("downloaded_bytes", 0)
+                total = d.get("total_bytes") or d.get("total_bytes_estimate") or 0
+
+                download_speed = clean_ansi_codes(d.get("_speed_str", "N/A")).strip()
+                eta = clean_ansi_codes(d.get("_eta_str", "N/A")).strip()
+
+                # Construct the progress message using the custom progress bar
+                progress_text = f"**Downloading**:\n"
+                progress_text += f"**File:** `{clean_ansi_codes(d.get('filename', 'Unknown File'))}`\n"
+
+                bar = get_progress_bar(pct)
 
-                filesize = os.path.getsize(full_path)
-
-                if filesize <= MAX_SIZE:
-                    fpaths = [full_path]
-                else:
-                    await st.edit(f"✅ Download complete. Splitting file into parts…")
-                    fpaths = await asyncio.to_thread(split_file, full_path, MAX_SIZE)
-                    os.remove(full_path) # Remove the large original file after splitting
-
-                # Part 2: Upload Media
-                total_parts = len(fpaths)
-                for idx, fpath in enumerate(fpaths, 1):
-                    # Check for cancellation before each upload
-                    if ACTIVE_TASKS.get(tid, {}).get("cancel"):
-                        await st.edit("❌ Upload cancelled by user.")
-                        # This return will jump to the finally block
-                        return
-
-                    if not os.path.exists(fpath):
-                        await st.edit(f"❌ File not found: {fpath}")
-                        continue
-
-                    # Define retry logic
-                    retries = 3
-                    while retries > 0:
-                        try:
-                            file_ext = os.path.splitext(fpath)[1].lower()
-                            is_video = file_ext in ['.mp4', '.mkv', '.avi', '.mov', '.webm']
-
-                            if total_parts == 1 and is_video:
-                                # Send as a streamable video
-                                await app.send_video(
-                                    q.message.chat.id,
-                                    fpath,
-                                    caption=f"✅ Uploaded: `{fname}`",
-                                    progress=lambda cur, tot: upload_progress(cur, tot, updater, tid, "video", fname, 1, 1)
-                                )
-                            else:
-                                # Send as a document for multi-part files or non-video formats
-                                part_name = sanitize_filename(os.path.basename(fpath))
-                                if len(part_name) > 150:
-                                    ext = os.path.splitext(part_name)[1]
-                                    part_name = part_name[:150] + ext
-
-                                await app.send_document(
-                                    q.message.chat.id,
-                                    fpath,
-                                    caption=f"✅ Uploaded part {idx}/{total_parts}: `{part_name}`",
-                                    progress=lambda cur, tot: upload_progress(cur, tot, updater, tid, "document", part_name, idx, total_parts)
-                                )
-
-                            # If upload is successful, break the retry loop
-                            break
-                        except FloodWait as e:
-                            log.info(f"Flood wait. Waiting for {e.value} seconds...")
-                            await asyncio.sleep(e.value)
-                        except RPCError as e:
-                            log.error(f"RPC Error during upload: {e}")
-                            retries -= 1
-                            if retries > 0:
-                                log.info(f"Retrying upload... {retries} attempts left.")
-                                await asyncio.sleep(5) # Wait before retrying
-                            else:
-                                raise e # Re-raise if all retries fail
-
-                await st.edit("✅ All parts uploaded successfully!")
-
-            except DownloadCancelled:
-                # The progress callback raises this, so we catch it here to stop the task
-                await st.edit("❌ Download/Upload cancelled.")
-            except Exception as e:
-                # Catch any other unexpected errors and report them
-                log.error(f"An error occurred in the runner: {e}", exc_info=True)
-                await st.edit(f"❌ Error: {e}")
-            finally:
-                updater.stop()
-                ACTIVE_TASKS.pop(tid, None)
-                # Cleanup: remove all files after a successful or failed task
-                for fpath in fpaths:
-                    if os.path.exists(fpath):
-                        os.remove(fpath)
-
-        asyncio.create_task(runner())
-
-    def upload_progress(cur, tot, updater, tid, file_type, name, part, total_parts):
+                progress_text += f"{bar} **{pct:.1f}%**\n"
+                progress_text += f"**Size:** {humanbytes(downloaded)} / {humanbytes(total)}\n"
+                progress_text += f"**Speed:** {download_speed} • **ETA:** {eta}"
+
+                self.post(progress_text)
+                self.last_update = now
+
+    async def runner():
         """
-        A unified progress callback for both video and document uploads.
+        The main coroutine to handle the entire download and upload process.
         """
-        # Check for the cancel flag. If set, we stop the upload process.
-        if ACTIVE_TASKS.get(tid, {}).get("cancel"):
-            raise DownloadCancelled()
+        fpaths = []
+        failure = None
+        reservation = None
+        updater = ProgressUpdater(st, url)
+
+        async def work():
+            nonlocal fpaths
+            # Part 1: Download Media
+            await safe_edit_text(st, "✅ Download starting...", reply_markup=cancel_btn(tid))
+            cookies = await cookie_store.path_for(task.user_id)
+            async with scheduler.download_slot():
+                full_path, fname, post = await fetch_media(
+                    task, url, paths["downloads"], cookies, updater.progress_hook, fmt,
+                    task.data["engine"],
+                )
+            if post:
+                await safe_edit_text(st, f"✅ Download complete\n🎞 {post}", reply_markup=cancel_btn(tid))
 
-        now = time.time()
-        # Only update every 2 seconds to avoid FloodWait errors
-        if now - updater.last_update < 2:
-            return
+            filesize = os.path.getsize(full_path)
+            fpaths = [full_path]
+
+            # Files above MAX_SIZE are uploaded as byte-range views of the
+            # original, so no part files are ever written to disk.
+            if filesize <= MAX_SIZE:
+                parts = [(0, filesize, os.path.basename(full_path))]
+            else:
+                parts = file_ranges(full_path, MAX_SIZE)
+
+            # Part 2: Upload Media
+            journal.state(task, "uploading")
+            total_parts = len(parts)
+            file_ext = os.path.splitext(full_path)[1].lower()
+            is_video = file_ext in ['.mp4', '.mkv', '.avi', '.mov', '.webm']
+
+            if total_parts == 1 and is_video:
+                # Send as a streamable video, with the usual retry logic
+                retries = 3
+                while True:
+                    if task.is_cancelled():
+                        raise DownloadCancelled()
+                    try:
+                        async with scheduler.upload_slot():
+                            message = await app.send_video(
+                                chat_id,
+                                full_path,
+                                caption=f"✅ Uploaded: `{fname}`",
+                                progress=lambda cur, tot: upload_progress(cur, tot, updater, task, "video", fname, 1, 1)
+                            )
+                        sent = [file_cache.file_entry(message)]
+                        break
+                    except FloodWait as e:
+                        log.info(f"Flood wait. Waiting for {e.value} seconds...")
+                        await asyncio.sleep(e.value)
+                    except RPCError as e:
+                        log.error(f"RPC Error during upload: {e}")
+                        retries -= 1
+                        if retries > 0:
+                            log.info(f"Retrying upload... {retries} attempts left.")
+                            await asyncio.sleep(5) # Wait before retrying
+                        else:
+                            raise e # Re-raise if all retries fail
+            else:
+                # Send as documents for multi-part files or non-video formats;
+                # parts upload side by side and are posted in order
+                names = []
+                for _, _, part_name in parts:
+                    part_name = sanitize_filename(part_name)
+                    if len(part_name) > 150:
+                        ext = os.path.splitext(part_name)[1]
+                        part_name = part_name[:150] + ext
+                    names.append(part_name)
+
+                async def parts_progress(done, total, speed, eta, in_flight):
+                    if not updater.closed:
+                        await safe_edit_text(st, f"{progress_text(done, total, speed, eta, in_flight, total_parts)}\n\n`{url}`", reply_markup=cancel_btn(tid))
+
+                # Parts delivered before a restart are not sent again
+                delivered = journal.parts(task, filesize)
+                async with scheduler.upload_slot():
+                    await upload_parts(
+                        app, chat_id,
+                        names=names,
+                        sizes=[length for _, length, _ in parts],
+                        open_part=lambda idx: FileRange(full_path, parts[idx - 1][0], parts[idx - 1][1], names[idx - 1]),
+                        caption=lambda idx, name: f"✅ Uploaded part {idx}/{total_parts}: `{name}`",
+                        progress=parts_progress,
+                        should_cancel=task.is_cancelled,
+                        skip={int(idx) for idx in delivered},
+                        on_sent=lambda idx, message: journal.delivered(task, idx, [file_cache.file_entry(message)]),
+                    )
+                sent = journal.entries(task, total_parts)
+
+            # The original is only needed until the last range is delivered
+            os.remove(full_path)
+            await file_cache.put(key, sent, filesize)
+            flight.resolve(sent)
+            journal.state(task, "done")
+
+            updater.stop()
+            await safe_edit_text(st, "✅ All parts uploaded successfully!")
+
+        async def show_position(position):
+            await safe_edit_text(st, queue_text(position), reply_markup=cancel_btn(tid))
 
-        # Calculate speed and ETA
-        elapsed = now - updater.start_time
-        speed = (cur - updater.last_uploaded_bytes) / (now - updater.last_update) if now > updater.last_update else 0
-        eta = (tot - cur) / speed if speed > 0 else "N/A"
+        try:
+            size = task.data.get("size", 0)
+            async with scheduler.job(user_id, size=size, priority=priority_for(size),
+                                     on_position=show_position,
+                                     should_cancel=task.is_cancelled):
+                # Merging keeps the video and audio streams on disk next to
+                # the merged output, so merged formats need about twice the size
+                reservation = await staging.reserve(
+                    user_id, size * 2 if fmt.startswith("merged_") or "+" in fmt else size,
+                    on_wait=lambda reason: safe_edit_text(st, staging.wait_text(reason), reply_markup=cancel_btn(tid)),
+                    should_cancel=task.is_cancelled,
+                )
+                journal.state(task, "downloading")
+                await work()
+
+        except (DownloadCancelled, asyncio.CancelledError):
+            failure = Exception("The download was cancelled.")
+            # The progress callback raises this, so we catch it here to stop the task
+            updater.stop()
+            await safe_edit_text(st, "❌ Download/Upload cancelled.")
+        except staging.StagingFull as e:
+            failure = e
+            updater.stop()
+            await safe_edit_text(st, f"❌ Not enough disk space: {e}")
+        except Exception as e:
+            failure = e
+            # Catch any other unexpected errors and report them
+            log.error(f"An error occurred in the runner: {e}", exc_info=True)
+            updater.stop()
+            await safe_edit_text(st, f"❌ Error: {e}")
+        finally:
+            singleflight.release(flight, failure)
+            staging.release(reservation)
+            updater.stop()
+            tasks.remove(task)
+            # Cleanup: remove all files after a successful or failed task
+            for fpath in fpaths:
+                if os.path.exists(fpath):
+                    os.remove(fpath)
+
+    task.bind(asyncio.create_task(runner()))
+
+def upload_progress(cur, tot, updater, task, file_type, name, part, total_parts):
+    """
+    A unified progress callback for both video and document uploads.
+    """
+    # Check for the cancel flag. If set, we stop the upload process.
+    if task.is_cancelled():
+        raise DownloadCancelled()
 
-        # Update the last recorded bytes and time
-        updater.last_uploaded_bytes = cur
-        updater.last_update = now
+    now = time.time()
+    # Only update every 2 seconds to avoid FloodWait errors
+    if now - updater.last_update < 2:
+        return
 
-        frac = cur / tot * 100 if tot else 0
-        bar = get_progress_bar(frac)
+    # Calculate speed and ETA
+    elapsed = now - updater.start_time
+    speed = (cur - updater.last_uploaded_bytes) / (now - updater.last_update) if now > updater.last_update else 0
+    eta = (tot - cur) / speed if speed > 0 else "N/A"
 
-        if file_type == "document" and total_parts > 1:
-            progress_text = f"**Uploading part {part}/{total_parts}**:\n"
-            progress_text += f"`{name}`\n"
-        else:
-            progress_text = f"**Uploading**:\n`{name}`\n"
+    # Update the last recorded bytes and time
+    updater.last_uploaded_bytes = cur
+    updater.last_update = now
 
-        progress_text += f"{bar} **{frac:.1f}%**\n"
-        progress_text += f"**Size:** {humanbytes(cur)} / {humanbytes(tot)}\n"
-        progress_text += f"**Speed:** {humanbytes(speed)}/s • **ETA:** {int(eta)}s"
+    frac = cur / tot * 100 if tot else 0
+    bar = get_progress_bar(frac)
 
-        updater.queue.put_nowait(progress_text)
+    if file_type == "document" and total_parts > 1:
+        progress_text = f"**Uploading part {part}/{total_parts}**:\n"
+        progress_text += f"`{name}`\n"
+    else:
+        progress_text = f"**Uploading**:\n`{name}`\n"
+
+    progress_text += f"{bar} **{frac:.1f}%**\n"
+    progress_text += f"**Size:** {humanbytes(cur)} / {humanbytes(tot)}\n"
+    progress_text += f"**Speed:** {humanbytes(speed)}/s • **ETA:** {int(eta)}s"
+
+    updater.post(progress_text)
+
+def warm_ytdl_pool():
+    """
+    Builds cookie-less instances of the common profiles ahead of the first
+    /ytdl, so that one doesn't pay for extractor and opener setup.
+    Blocking; run it in a thread.
+    """
+    ytdl_pool.warm("list", LIST_OPTS)
+    engine = engine_for("")
+    ytdl_pool.warm(f"download:{engine}", {**DOWNLOAD_OPTS, **engine_opts(engine)})
 
 
 def list_formats(url, cookies=None):
@@ -353,17 +522,12 @@ def list_formats(url, cookies=None):
     Lists available formats for a given URL, including both video and audio.
     This function uses a blocking library (yt-dlp) and should be run in a thread.
     """
-    opts = {
-        "quiet": True,
-        "skip_download": True,
-        "cookiefile": cookies if cookies else None,
-        "noplaylist": True, # Ensure we don't process playlists
-    }
-    with yt_dlp.YoutubeDL(opts) as ydl:
+    with ytdl_pool.checkout("list", LIST_OPTS, cookies) as ydl:
         try:
-            info = ydl.extract_info(url, download=False)
+            # Cached, so the download step can reuse this extraction
+            info = info_cache.extract(ydl, url, cookies)
         except DownloadError:
-            return []
+            return [], {}
 
         formats = info.get("formats", [])
         unique_fmts = {}
@@ -406,13 +570,24 @@ def list_formats(url, cookies=None):
 
         # Sort formats by resolution (descending) and audio first
         sorted_list = sorted(unique_fmts.values(), key=lambda x: (x['res'] == 0, -x['res'], x['size']), reverse=False)
-        return sorted_list
+        # Predicted sizes of the merged buttons, the best pick that fits in
+        # one upload, and the smallest download for when nothing does
+        plan = {
+            "merged": format_select.merged_sizes(info),
+            "fit": format_select.best_under(info, MAX_SIZE),
+            "smallest": format_select.smallest(info),
+        }
+        return sorted_list, plan
 
 
-def download_media(url, path, cookies, progress_hook, fmt_id):
+def download_media(url, path, cookies, progress_hook, fmt_id, engine=None):
     """
     Download media using yt-dlp and return the path to the downloaded file.
     This is a blocking function.
+
+    :param engine: Download engine ("native" or "aria2c"); by default the
+                   one configured for the URL's site.
+    :return: (file path, title, summary of the mp4 post-processing or None)
     """
     # --- Use a dictionary to map custom IDs to yt-dlp format strings ---
     fmt_map = {
@@ -425,33 +600,64 @@ def download_media(url, path, cookies, progress_hook, fmt_id):
     format_string = fmt_map.get(fmt_id, fmt_id)
     # --------------------------------------------------------------------------
 
-    opts = {
-        "format": format_string,
-        "outtmpl": os.path.join(path, "%(title)s.%(ext)s"),
-        "cookiefile": cookies if cookies else None,
-        "progress_hooks": [progress_hook],
-    }
-
-    # If we are merging, we need to explicitly tell yt-dlp to use FFmpeg.
-    # --- Check if the format ID is in our map to determine if merging is needed ---
-    if fmt_id in fmt_map:
-        opts["postprocessors"] = [{
-            'key': 'FFmpegVideoConvertor',
-            'preferedformat': 'mp4',
-        }]
-    # ------------------------------------------------------------------------------------
-
-    with yt_dlp.YoutubeDL(opts) as ydl:
-        info = ydl.extract_info(url, download=True)
+    # --- Merged formats use the profile that merges into mp4/mkv ---
+    merge = fmt_id in fmt_map or "+" in format_string
+    timer = remux.PostprocessorTimer()
+    engine = engine_for(url, engine)
+    log.info(f"Downloading {url} ({fmt_id}) with the {engine} engine")
+    with ytdl_pool.checkout(
+        f"{'merge' if merge else 'download'}:{engine}",
+        {**(MERGE_OPTS if merge else DOWNLOAD_OPTS), **engine_opts(engine)},
+        cookies,
+        format=format_string,
+        outtmpl=os.path.join(path, "%(title)s.%(ext)s"),
+        progress_hook=progress_hook,
+        postprocessor_hook=timer,
+    ) as ydl:
+        cached = info_cache.get(url, cookies)
+        info = None
+        if cached is not None:
+            # Reuse the extraction from list_formats instead of scraping again
+            try:
+                info = ydl.process_ie_result(cached, download=True)
+            except DownloadError as e:
+                if isinstance(e.exc_info[1], DownloadCancelled):
+                    raise
+                log.warning(f"Cached info for {url} failed ({e}); extracting again")
+                info_cache.invalidate(url, cookies)
+        if info is None:
+            info = ydl.extract_info(url, download=True)
         
-        # --- The 'full_path' needs to be handled differently for merged files. ---
-        # yt-dlp automatically handles the filename for merged formats.
-        if fmt_id in fmt_map:
-            full_path = ydl.prepare_filename(info)
-        else:
-            full_path = ydl.prepare_filename(info)
-        # --------------------------------------------------------------------------------
-        return full_path, info.get("title")
+        # yt-dlp sets the final extension of merged files in info itself
+        full_path = ydl.prepare_filename(info)
+        post = None
+        if merge:
+            # Stream copy into mp4 where possible, transcode only if enabled
+            full_path, post = remux.finish(ydl, info, full_path, timer)
+            log.info(f"{os.path.basename(full_path)}: {post}")
+        return full_path, info.get("title"), post
+
+
+async def fetch_formats(url, cookies=None, task=None):
+    """
+    list_formats off the event loop: in a thread, or in a worker process
+    with YTDL_ISOLATION=process (see ytdl_workers).
+    """
+    if ytdl_workers.ISOLATION == "process":
+        return await ytdl_workers.list_formats(url, cookies, task)
+    return await asyncio.to_thread(list_formats, url, cookies)
+
+
+async def fetch_media(task, url, path, cookies, progress_hook, fmt_id, engine=None):
+    """
+    download_media off the event loop: in a thread, or in a worker process
+    with YTDL_ISOLATION=process. Cancelling `task` stops the download.
+    """
+    if ytdl_workers.ISOLATION == "process":
+        # The hook runs on the event loop; cancelling kills the worker
+        return await ytdl_workers.download_media(task, url, path, cookies, progress_hook, fmt_id, engine)
+    # The progress hook stops yt-dlp soon after the token is set
+    return await tasks.to_thread(task, download_media, url, path, cookies, progress_hook, fmt_id, engine)
 
 
 def get_progress_bar(percentage):